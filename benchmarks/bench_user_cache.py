@@ -0,0 +1,80 @@
+# benchmarks/bench_user_cache.py
+"""
+比較緩存用戶對象的兩種編碼：直接 pickle User 實例與 User.to_cache_data() 緊湊元組
+
+Django 緩存後端（Redis、memcached 等）寫入前都會 pickle 緩存值，
+因此這裡以 pickle 後的大小和 dumps/loads 耗時作為衡量標準。
+
+運行方式:
+    python benchmarks/bench_user_cache.py
+"""
+import os
+import pickle
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(SSO_LOGGING_LEVEL='INFO')
+
+from lungfung_sso.models import User
+
+# 典型的 SSO 驗證響應
+TOKEN = 'eyJhbGciOiJSUzI1NiIsInR5cCI6IkpXVCIsImtpZCI6ImsxIn0.' + 'x' * 600 + '.' + 'y' * 342
+USER_DATA = {
+    'id': 1024,
+    'username': 'chan.taiman',
+    'email': 'chan.taiman@lungfung.hk',
+    'first_name': 'Tai Man',
+    'last_name': 'Chan',
+    'is_active': True,
+    'is_staff': False,
+    'is_superuser': False,
+    'modules': ['TCS', 'TCS_INV', 'TCS_CUS'],
+    'permissions': {
+        'TCS': {'permissions': ['view_tcs', 'manage_tcs']},
+        'TCS_INV': {'permissions': ['view_tcs_inv', 'create_tcs_inv', 'edit_tcs_inv']},
+    },
+    'profile': {
+        'full_name': 'Chan Tai Man',
+        'staff_number': 'LF-00123',
+        'phone_number': '+852 1234 5678',
+        'department': 'IT',
+        'position': 'Developer',
+        'avatar_url': 'https://sso.lungfung.hk/media/avatars/1024.png',
+        'email': 'chan.taiman@lungfung.hk',
+        'first_name': 'Tai Man',
+        'last_name': 'Chan',
+        'date_joined': '2020-01-01T00:00:00+08:00',
+        'last_login': '2025-12-01T09:00:00+08:00',
+        'preferences': {'language': 'zh-hant', 'timezone': 'Asia/Hong_Kong'},
+    },
+    'groups': [{'id': i, 'name': f'group-{i}'} for i in range(5)],
+}
+
+NUMBER = 20000
+
+
+def bench(label, value, decode):
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    dumps = timeit.timeit(lambda: pickle.dumps(value, pickle.HIGHEST_PROTOCOL), number=NUMBER)
+    loads = timeit.timeit(lambda: decode(pickle.loads(data)), number=NUMBER)
+    print(f"{label:<12}{len(data):>10}{dumps / NUMBER * 1e6:>14.2f}{loads / NUMBER * 1e6:>14.2f}")
+    return len(data)
+
+
+def main():
+    user = User(USER_DATA)
+    user.token = TOKEN
+
+    print(f"{'編碼':<12}{'大小(字節)':>10}{'dumps(µs)':>14}{'loads(µs)':>14}")
+    pickled = bench('pickle', user, lambda value: value)
+    compact = bench('compact', user.to_cache_data(), lambda value: User.from_cache_data(value, TOKEN))
+    print(f"緊湊編碼大小為 pickle 的 {compact / pickled:.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -50,7 +50,10 @@ def __getattr__(name):
         'SSOPermission': ('permissions', 'SSOPermission'),
         'SSOperationPermission': ('permissions', 'SSOperationPermission'),
         'check_permission': ('permissions', 'check_permission'),
+        'check_permissions_many': ('permissions', 'check_permissions_many'),
         'module_permission_required': ('permissions', 'module_permission_required'),
+        'PermissionSet': ('permission_set', 'PermissionSet'),
+        'get_permission_set': ('permission_set', 'get_permission_set'),
         'User': ('models', 'User'),
         'UserAdapter': ('user_adapter', 'UserAdapter'),
         'cache_user_data': ('cache', 'cache_user_data'),
@@ -58,8 +61,22 @@ def __getattr__(name):
         'get_token_verification_cache': ('cache', 'get_token_verification_cache'),
         'set_token_verification_cache': ('cache', 'set_token_verification_cache'),
         'get_user_permissions_cache': ('cache', 'get_user_permissions_cache'),
+        'get_user_permissions_entry': ('cache', 'get_user_permissions_entry'),
         'set_user_permissions_cache': ('cache', 'set_user_permissions_cache'),
         'invalidate_token_cache': ('cache', 'invalidate_token_cache'),
+        'delete_token_verification_cache': ('cache', 'delete_token_verification_cache'),
+        'clear_local_cache': ('cache', 'clear_local_cache'),
+        'get_token_rejection_cache': ('cache', 'get_token_rejection_cache'),
+        'set_token_rejection_cache': ('cache', 'set_token_rejection_cache'),
+        'aget_token_verification_cache': ('cache', 'aget_token_verification_cache'),
+        'aset_token_verification_cache': ('cache', 'aset_token_verification_cache'),
+        'aget_user_permissions_cache': ('cache', 'aget_user_permissions_cache'),
+        'aset_user_permissions_cache': ('cache', 'aset_user_permissions_cache'),
+        'ainvalidate_token_cache': ('cache', 'ainvalidate_token_cache'),
+        'invalidate_cache_type': ('cache', 'invalidate_cache_type'),
+        'invalidate_module_cache': ('cache', 'invalidate_module_cache'),
+        'warm_up_login': ('warmup', 'warm_up_login'),
+        'warm_up_permissions': ('warmup', 'warm_up_permissions'),
         # 日誌服務組件 (需要 Django)
         'FileLogService': ('logging_service', 'FileLogService'),
         'RequestLoggingMiddleware': ('logging_service', 'RequestLoggingMiddleware'),
@@ -126,7 +143,10 @@ __all__ = [
     'SSOPermission', 
     'SSOperationPermission',
     'check_permission',
+    'check_permissions_many',
     'module_permission_required',
+    'PermissionSet',
+    'get_permission_set',
     
     # 模型
     'User',
@@ -149,8 +169,22 @@ __all__ = [
     'get_token_verification_cache',
     'set_token_verification_cache',
     'get_user_permissions_cache',
+    'get_user_permissions_entry',
     'set_user_permissions_cache',
     'invalidate_token_cache',
+    'delete_token_verification_cache',
+    'clear_local_cache',
+    'get_token_rejection_cache',
+    'set_token_rejection_cache',
+    'aget_token_verification_cache',
+    'aset_token_verification_cache',
+    'aget_user_permissions_cache',
+    'aset_user_permissions_cache',
+    'ainvalidate_token_cache',
+    'invalidate_cache_type',
+    'invalidate_module_cache',
+    'warm_up_login',
+    'warm_up_permissions',
     
     # 設置助手
     'configure_sso_settings',
@@ -6,5 +6,11 @@ class LungfungSsoConfig(AppConfig):
     verbose_name = 'LungFung SSO'
     
     def ready(self):
-        """當 Django 應用準備就緒時執行"""
-        pass
\ No newline at end of file
+        """
+        當 Django 應用準備就緒時執行
+        
+        預先構建設置快照和權限編號表，MANAGE_SYSTEM / VIEW_SYSTEM 展開後的子模組權限
+        在此計算一次；設置變更時（setting_changed）在下次使用時重新構建。
+        """
+        from .permission_set import get_codename_table
+        get_codename_table()
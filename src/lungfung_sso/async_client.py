@@ -0,0 +1,118 @@
+# lungfung_sso/async_client.py
+"""
+SSO 服務異步客戶端
+
+供 ASGI 部署下的異步中間件使用。安裝 httpx 時使用帶連接池的 httpx.AsyncClient，
+等待 SSO 響應期間不佔用線程；未安裝時回退到線程池中執行同步會話。
+
+與同步會話共用同一個熔斷器，網絡錯誤統一轉換為 requests.ConnectionError，
+調用方可以沿用同步代碼的異常處理。
+"""
+import asyncio
+import logging
+import time
+import weakref
+
+import requests
+from asgiref.sync import sync_to_async
+from .circuit_breaker import CircuitBreaker, CircuitOpenError, is_service_failure
+from .conf import get_sso_config
+
+try:
+    import httpx
+    HTTPX_AVAILABLE = True
+except ImportError:
+    httpx = None
+    HTTPX_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSSOClient:
+    """
+    SSO 服務異步 HTTP 客戶端
+
+    每個事件循環各自持有一個 httpx.AsyncClient（連接池不能跨事件循環共享），
+    連接池大小沿用 SSO_CONNECTION_POOL_SIZE。
+
+    參數:
+        breaker (CircuitBreaker, optional): 與同步會話共用的熔斷器
+    """
+
+    def __init__(self, breaker=None):
+        self.breaker = breaker
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _get_client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            config = get_sso_config()
+            pool_size = config.connection_pool_size
+            client = httpx.AsyncClient(
+                verify=config.verify_ssl,
+                limits=httpx.Limits(
+                    max_connections=pool_size,
+                    max_keepalive_connections=pool_size
+                )
+            )
+            self._clients[loop] = client
+            logger.info(f"已創建SSO服務的異步客戶端：連接池大小={pool_size}")
+        return client
+
+    async def request(self, method, url, **kwargs):
+        """
+        發送請求，參數與 requests.Session.request 相同（json、params、headers、timeout、verify）
+
+        返回:
+            響應對象，提供 status_code、text 和 json()
+
+        可能引發的異常:
+            requests.ConnectionError: 網絡錯誤或熔斷器打開（CircuitOpenError）時
+        """
+        if not HTTPX_AVAILABLE:
+            # 未安裝 httpx 時回退到線程池中的同步會話（仍受熔斷器保護）
+            from .middleware import get_sso_session
+            session = get_sso_session()
+            return await sync_to_async(session.request, thread_sensitive=False)(method, url, **kwargs)
+
+        # httpx 的 SSL 驗證在客戶端級別配置
+        kwargs.pop('verify', None)
+
+        permit = self.breaker.allow_request() if self.breaker is not None else True
+        if not permit:
+            raise CircuitOpenError(f"SSO 熔斷器已打開，快速失敗: {method} {url}")
+        probe = permit == CircuitBreaker.PROBE
+
+        start = time.monotonic()
+        try:
+            response = await self._get_client().request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            if self.breaker is not None:
+                self.breaker.record(False, time.monotonic() - start, probe)
+            raise requests.ConnectionError(str(e)) from e
+        except BaseException:
+            if self.breaker is not None:
+                self.breaker.record(False, time.monotonic() - start, probe)
+            raise
+        if self.breaker is not None:
+            self.breaker.record(not is_service_failure(response.status_code), time.monotonic() - start, probe)
+        return response
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+
+_async_sso_client = None
+
+
+def get_async_sso_client():
+    """獲取或創建SSO服務的異步客戶端，與同步會話共用熔斷器"""
+    global _async_sso_client
+    if _async_sso_client is None:
+        from .middleware import get_sso_session
+        _async_sso_client = AsyncSSOClient(getattr(get_sso_session(), 'breaker', None))
+    return _async_sso_client
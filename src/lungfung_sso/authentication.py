@@ -1,5 +1,4 @@
 # apps/core/authentication.py
-from django.conf import settings
 from django.core.cache import cache
 from rest_framework.authentication import BaseAuthentication
 from rest_framework.exceptions import AuthenticationFailed
@@ -8,10 +7,24 @@ import json
 import logging
 from .exceptions import TokenError, TokenExpiredError
 from .models import User
-from .cache import get_token_verification_cache, set_token_verification_cache, get_user_permissions_cache, set_user_permissions_cache
+from .cache import (
+    get_token_verification_cache, set_token_verification_cache, delete_token_verification_cache,
+    get_user_permissions_cache, set_user_permissions_cache, get_token_and_permissions_cache,
+    get_token_rejection_cache, set_token_rejection_cache,
+    get_last_known_good_user, get_last_known_good_permissions,
+    REJECTION_EXPIRED, REJECTION_INVALID,
+)
+from .conf import get_sso_config
+from .middleware import get_sso_session
+from .jwt_verification import verify_token_locally
+from .singleflight import SingleFlight
+from .circuit_breaker import is_service_failure
 
 logger = logging.getLogger(__name__)
 
+# 按 token 合併並發的 SSO 驗證請求
+_token_verification_flight = SingleFlight()
+
 class SSOAuthentication(BaseAuthentication):
     """
     單點登錄認證後端
@@ -43,8 +56,23 @@ class SSOAuthentication(BaseAuthentication):
                 logger.debug("未找到令牌，跳過 SSO 認證")
                 return None
                 
+            # 令牌驗證結果和權限數據盡量在一次緩存往返中讀取
+            user, permissions_data = get_token_and_permissions_cache(
+                token,
+                revalidate=self._revalidate_token,
+                permissions_revalidate=lambda user_id: self._fetch_user_permissions(user_id, token)
+            )
+            if user:
+                logger.debug(f"使用緩存的令牌驗證結果，用戶: {user.username}")
+                if permissions_data:
+                    logger.debug(f"使用緩存的用戶權限數據，用戶ID: {user.id}")
+                    user.set_permissions(permissions_data)
+                else:
+                    self._load_user_permissions(user, check_cache=False)
+                return (user, None)
+            
             # 從令牌獲取用戶
-            user = self._get_user_from_token(token)
+            user = self._verify_token_or_degrade(token)
             if not user:
                 logger.warning("令牌驗證失敗，無法獲取用戶")
                 raise TokenError("無效的認證令牌")
@@ -109,20 +137,80 @@ class SSOAuthentication(BaseAuthentication):
             TokenError: 令牌無效時
             TokenExpiredError: 令牌已過期時
         """
-        # 檢查緩存
-        cached_user = get_token_verification_cache(token)
+        # 檢查緩存，軟過期的結果照常使用並在後台重新驗證
+        cached_user = get_token_verification_cache(token, revalidate=self._revalidate_token)
         if cached_user:
             logger.debug(f"使用緩存的令牌驗證結果，用戶: {cached_user.username}")
             return cached_user
+        
+        return self._verify_token_or_degrade(token)
+    
+    def _verify_token_or_degrade(self, token):
+        """
+        驗證令牌，SSO 不可用時回退到最後已知有效的驗證結果
+        
+        參數:
+            token: 認證令牌
+            
+        返回:
+            User: 用戶對象
+            
+        可能引發的異常:
+            TokenError: 令牌無效，或 SSO 不可用且沒有可用的降級結果時
+            TokenExpiredError: 令牌已過期時
+        """
+        try:
+            return self._verify_token(token)
+        except TokenError as e:
+            # SSO 不可用（包括熔斷器打開）時嘗試使用最後已知有效的驗證結果
+            if e.code == 'sso_service_error':
+                degraded_user = get_last_known_good_user(token)
+                if degraded_user:
+                    return degraded_user
+            raise
+    
+    def _verify_token(self, token):
+        """
+        不經過驗證結果緩存，直接驗證令牌並緩存結果
+        
+        參數:
+            token: 認證令牌
+            
+        返回:
+            User: 用戶對象
+            
+        可能引發的異常:
+            TokenError: 令牌無效或 SSO 服務不可用時（後者 code 為 'sso_service_error'）
+            TokenExpiredError: 令牌已過期時
+        """
+        # 最近被拒絕的令牌直接拋出異常，不再請求 SSO 服務
+        rejection = get_token_rejection_cache(token)
+        if rejection == REJECTION_EXPIRED:
+            raise TokenExpiredError("認證令牌已過期")
+        elif rejection is not None:
+            raise TokenError("無效的認證令牌")
+        
+        # 啟用本地驗證時先在本地驗證簽名，過期或無效時直接拋出異常
+        user_data = verify_token_locally(token)
+        if user_data is not None:
+            logger.debug(f"令牌已通過本地簽名驗證，用戶: {user_data.get('username', 'unknown')}")
+            user = User(user_data)
+            user.token = token
+            set_token_verification_cache(token, user)
+            return user
             
         # 驗證令牌
         try:
             logger.debug(f"驗證令牌: {token[:10]}...")
-            verify_response = requests.post(
-                f"{settings.SSO_SERVICE['URL']}{settings.SSO_SERVICE['TOKEN_VERIFY_URL']}",
+            config = get_sso_config()
+            # 同一令牌的並發驗證只發送一次請求，其他線程共享響應或異常
+            verify_response = _token_verification_flight.do(
+                token,
+                get_sso_session().post,
+                config.token_verify_url,
                 json={'token': token},
-                verify=settings.SSO_SERVICE['VERIFY_SSL'],
-                timeout=5
+                verify=config.verify_ssl,
+                timeout=config.request_timeout
             )
             
             logger.debug(f"SSO 響應狀態: {verify_response.status_code}")
@@ -133,6 +221,7 @@ class SSOAuthentication(BaseAuthentication):
                 
                 # 建立用戶對象
                 user = User(user_data)
+                user.token = token
                 
                 # 緩存驗證結果
                 set_token_verification_cache(token, user)
@@ -143,18 +232,41 @@ class SSOAuthentication(BaseAuthentication):
                 logger.warning(f"令牌已過期: {json.dumps(error_data)}")
                 
                 if error_data.get('code') == 'token_expired':
+                    set_token_rejection_cache(token, REJECTION_EXPIRED)
                     raise TokenExpiredError("認證令牌已過期")
                 else:
+                    set_token_rejection_cache(token, REJECTION_INVALID)
                     raise TokenError("無效的認證令牌")
             else:
                 logger.error(f"令牌驗證失敗: HTTP {verify_response.status_code}, 響應: {verify_response.text}")
+                # SSO 服務端錯誤 (5xx)、超時 (408)、限流 (429) 不緩存，只緩存明確的拒絕
+                if is_service_failure(verify_response.status_code):
+                    raise TokenError(f"令牌驗證失敗: {verify_response.text}", code='sso_service_error')
+                if verify_response.status_code in (400, 403):
+                    set_token_rejection_cache(token, REJECTION_INVALID)
                 raise TokenError(f"令牌驗證失敗: {verify_response.text}")
                 
         except requests.RequestException as e:
             logger.error(f"SSO 服務連接錯誤: {str(e)}")
-            raise TokenError(f"無法連接 SSO 服務: {str(e)}")
+            raise TokenError(f"無法連接 SSO 服務: {str(e)}", code='sso_service_error')
+    
+    def _revalidate_token(self, token):
+        """
+        後台重新驗證已軟過期的令牌緩存
+        
+        SSO 明確拒絕時刪除舊的驗證結果；SSO 不可用時保留舊值直到硬過期。
+        
+        參數:
+            token: 認證令牌
+        """
+        try:
+            self._verify_token(token)
+        except TokenError as e:
+            if e.code != 'sso_service_error':
+                delete_token_verification_cache(token)
+                logger.info(f"後台重新驗證發現令牌已失效: {e.message}")
             
-    def _load_user_permissions(self, user):
+    def _load_user_permissions(self, user, check_cache=True):
         """
         加載用戶權限
         
@@ -163,6 +275,7 @@ class SSOAuthentication(BaseAuthentication):
         
         參數:
             user: 用戶對象
+            check_cache (bool): 是否檢查權限緩存；調用方已確認未命中時為 False
             
         返回:
             None
@@ -171,8 +284,12 @@ class SSOAuthentication(BaseAuthentication):
             logger.warning("用戶對象缺少 id 屬性，無法加載權限")
             return
             
-        # 檢查緩存
-        permissions_data = get_user_permissions_cache(user.id)
+        # 檢查緩存，軟過期的數據照常使用並在後台重新獲取
+        token = user.token
+        permissions_data = check_cache and get_user_permissions_cache(
+            user.id,
+            revalidate=lambda user_id: self._fetch_user_permissions(user_id, token)
+        )
         
         if permissions_data:
             logger.debug(f"使用緩存的用戶權限數據，用戶ID: {user.id}")
@@ -180,28 +297,47 @@ class SSOAuthentication(BaseAuthentication):
             return
             
         # 從 SSO 服務獲取權限
+        permissions_data = self._fetch_user_permissions(user.id, token)
+        if permissions_data:
+            # 設置用戶權限
+            user.set_permissions(permissions_data)
+    
+    def _fetch_user_permissions(self, user_id, token):
+        """
+        從 SSO 服務獲取用戶權限數據並存入緩存
+        
+        參數:
+            user_id: 用戶ID
+            token: 用於請求 SSO 的認證令牌
+            
+        返回:
+            dict 或 None: 權限數據，獲取失敗時返回 None
+        """
         try:
-            logger.debug(f"從 SSO 服務獲取用戶權限，用戶ID: {user.id}")
-            permissions_response = requests.get(
-                f"{settings.SSO_SERVICE['URL']}{settings.SSO_SERVICE['USER_PERMISSIONS_URL']}",
-                params={'user_id': user.id},
-                headers={'Authorization': f'Bearer {user.token}'},
-                verify=settings.SSO_SERVICE['VERIFY_SSL'],
-                timeout=5
+            logger.debug(f"從 SSO 服務獲取用戶權限，用戶ID: {user_id}")
+            config = get_sso_config()
+            permissions_response = get_sso_session().get(
+                config.user_permissions_url,
+                params={'user_id': user_id},
+                headers={'Authorization': f'Bearer {token}'},
+                verify=config.verify_ssl,
+                timeout=config.request_timeout
             )
             
             if permissions_response.status_code == 200:
                 permissions_data = permissions_response.json()
-                logger.info(f"成功獲取用戶權限，用戶ID: {user.id}")
-                
-                # 設置用戶權限
-                user.set_permissions(permissions_data)
+                logger.info(f"成功獲取用戶權限，用戶ID: {user_id}")
                 
                 # 緩存權限數據
-                set_user_permissions_cache(user.id, permissions_data)
+                set_user_permissions_cache(user_id, permissions_data)
+                return permissions_data
             else:
                 logger.error(f"獲取用戶權限失敗: HTTP {permissions_response.status_code}, 響應: {permissions_response.text}")
+                if is_service_failure(permissions_response.status_code):
+                    return get_last_known_good_permissions(user_id)
         except requests.RequestException as e:
             logger.error(f"獲取用戶權限時發生錯誤: {str(e)}")
+            return get_last_known_good_permissions(user_id)
         except Exception as e:
-            logger.error(f"處理用戶權限時發生意外錯誤: {str(e)}", exc_info=True)
\ No newline at end of file
+            logger.error(f"處理用戶權限時發生意外錯誤: {str(e)}", exc_info=True)
+        return None
\ No newline at end of file
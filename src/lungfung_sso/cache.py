@@ -5,8 +5,28 @@
 提供統一的緩存管理功能，用於緩存用戶數據、令牌驗證結果等。
 所有緩存鍵均使用統一的前綴和命名規範，以避免衝突並方便管理。
 """
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
+import asyncio
+import copy
+import hashlib
+import itertools
 import logging
+import math
+import os
+import pickle
+import random
+import threading
+import time
+
+from .invalidation import (
+    INVALIDATE_ALL, INVALIDATE_GENERATION, INVALIDATE_KEYS, INVALIDATE_USER, get_invalidation_bus,
+)
+from .metrics import (
+    PROMETHEUS_AVAILABLE, cache_errors, cache_evictions, cache_hits, cache_latency,
+    cache_misses, cache_payload_size, cache_sets,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -22,62 +42,653 @@ def _get_settings_value(key, default):
         # Django 設置未配置
         return default
 
+class _MockCache:
+    """Django 不可用時使用的空緩存對象"""
+    def get(self, key, default=None):
+        return default
+    def set(self, key, value, timeout=None):
+        pass
+    def delete(self, key):
+        pass
+    def clear(self):
+        pass
+    def add(self, key, value, timeout=None):
+        return True
+    def incr(self, key, delta=1):
+        raise ValueError(key)
+    def get_many(self, keys):
+        return {}
+    def delete_many(self, keys):
+        pass
+    async def aget(self, key, default=None):
+        return default
+    async def aset(self, key, value, timeout=None):
+        pass
+    async def adelete(self, key):
+        pass
+    async def aadd(self, key, value, timeout=None):
+        return True
+    async def aget_many(self, keys):
+        return {}
+
+# SSO 緩存使用的 Django 緩存別名，可指向獨立的 Redis DB 或本地內存後端，
+# 與應用緩存分開連接池和淘汰策略，應用的 cache.clear() 也不會清除認證狀態
+CACHE_ALIAS = _get_settings_value('SSO_CACHE_ALIAS', 'default')
+
+_sso_cache = None
+
+def _is_detailed_logging():
+    """SSO_LOGGING_LEVEL 是否為 DEBUG，從編譯後的設置快照讀取"""
+    try:
+        from .conf import get_sso_config
+        return get_sso_config().detailed_logging
+    except Exception:
+        # Django 未安裝或設置未配置
+        return False
+
 def _get_cache():
-    """安全地獲取 Django 緩存"""
+    """
+    安全地獲取 SSO 緩存（SSO_CACHE_ALIAS 對應的 Django 緩存）
+    
+    首次成功解析後復用同一個代理對象。代理與 django.core.cache.cache 相同，
+    按線程取得實際的緩存連接，可以在線程間共享。
+    """
+    global _sso_cache
+    if _sso_cache is not None:
+        return _sso_cache
     try:
-        from django.core.cache import cache
-        return cache
+        from django.conf import settings
+        from django.core.cache import caches, DEFAULT_CACHE_ALIAS
+        from django.utils.connection import ConnectionProxy
+        
+        alias = CACHE_ALIAS
+        if alias not in settings.CACHES:
+            logger.error(f"SSO_CACHE_ALIAS '{alias}' 未在 CACHES 中配置，使用默認緩存")
+            alias = DEFAULT_CACHE_ALIAS
+        _sso_cache = ConnectionProxy(caches, alias)
+        # 本進程開始使用 SSO 緩存時開始接收其他進程的失效廣播
+        get_invalidation_bus(_apply_invalidation)
+        return _sso_cache
     except ImportError:
         # Django 未安裝，返回一個模擬緩存對象
-        class MockCache:
-            def get(self, key, default=None):
-                return default
-            def set(self, key, value, timeout=None):
-                pass
-            def delete(self, key):
-                pass
-            def clear(self):
-                pass
-        return MockCache()
+        return _MockCache()
     except Exception:
-        # Django 設置未配置，返回模擬緩存對象
-        class MockCache:
-            def get(self, key, default=None):
-                return default
-            def set(self, key, value, timeout=None):
-                pass
-            def delete(self, key):
-                pass
-            def clear(self):
-                pass
-        return MockCache()
+        # Django 設置未配置，返回模擬緩存對象（不保存，設置完成後重新解析）
+        return _MockCache()
+
+def _reset_after_fork():
+    # fork 後重新解析緩存，以便子進程啟動自己的失效總線
+    global _sso_cache
+    _sso_cache = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
 
 # 從設置中獲取緩存配置
 CACHE_KEY_PREFIX = _get_settings_value('CACHE_KEY_PREFIX', 'sso_')
 
+# 緩存鍵命名空間版本，遞增後所有舊條目立即失效
+CACHE_KEY_VERSION = _get_settings_value('SSO_CACHE_KEY_VERSION', 1)
+
+# 進程內緩存世代計數器的秒數，其他進程遞增世代後最多延遲這麼久生效
+GENERATION_CACHE_TTL = _get_settings_value('SSO_CACHE_GENERATION_TTL', 5)
+
+# 滾動升級期間，新格式的令牌和權限緩存鍵未命中時回退讀取舊版（未版本化、令牌明文）緩存鍵
+READ_LEGACY_KEYS = _get_settings_value('SSO_CACHE_READ_LEGACY_KEYS', False)
+
 # 從設置中獲取緩存鍵類型
 CACHE_TYPE_TOKEN = _get_settings_value('CACHE_TYPE_TOKEN', 'token')
 CACHE_TYPE_PERMISSIONS = _get_settings_value('CACHE_TYPE_PERMISSIONS', 'permissions')
 CACHE_TYPE_USER = _get_settings_value('CACHE_TYPE_USER', 'user')
+CACHE_TYPE_TOKEN_REJECTION = _get_settings_value('CACHE_TYPE_TOKEN_REJECTION', 'token_rejected')
+CACHE_TYPE_TOKEN_REFRESH = _get_settings_value('CACHE_TYPE_TOKEN_REFRESH', 'token_refresh')
+CACHE_TYPE_TOKEN_REFRESH_LOCK = _get_settings_value('CACHE_TYPE_TOKEN_REFRESH_LOCK', 'token_refresh_lock')
+CACHE_TYPE_USER_TOKENS = _get_settings_value('CACHE_TYPE_USER_TOKENS', 'user_tokens')
+CACHE_TYPE_GENERATION = _get_settings_value('CACHE_TYPE_GENERATION', 'generation')
+
+# 只存在於進程內 L1 的緩存類型，僅用作監控指標標籤
+CACHE_TYPE_TOKEN_USER_IDS = 'token_user_ids'
+
+# 負緩存原因
+REJECTION_INVALID = 'invalid'
+REJECTION_EXPIRED = 'expired'
+REJECTION_REFRESH_FAILED = 'refresh_failed'
+# 提前刷新因超時、連接錯誤或 SSO 服務端錯誤失敗，冷卻期內不再提前刷新
+REJECTION_REFRESH_COOLDOWN = 'refresh_cooldown'
 
 # 獲取默認緩存超時設置
 TOKEN_CACHE_TTL = _get_settings_value('TOKEN_VERIFICATION_CACHE_TTL', 300)
 USER_CACHE_TTL = _get_settings_value('USER_CACHE_TIMEOUT', 300)
 PERMISSIONS_CACHE_TTL = _get_settings_value('PERMISSIONS_CACHE_TIMEOUT', USER_CACHE_TTL)
+REJECTION_CACHE_TTL = _get_settings_value('SSO_NEGATIVE_CACHE_TTL', 30)
+
+# 跨工作進程合併 token 刷新：刷新鎖的最長持有時間和刷新結果的保留時間
+REFRESH_LOCK_TIMEOUT = _get_settings_value('SSO_REFRESH_LOCK_TIMEOUT', 10)
+REFRESH_RESULT_TTL = _get_settings_value('SSO_REFRESH_RESULT_TTL', 30)
+# 刷新失敗（超時、連接錯誤、SSO 服務端錯誤等）在結果槽中保留的時間
+REFRESH_FAILURE_TTL = _get_settings_value('SSO_REFRESH_FAILURE_TTL', 5)
+
+# 每個用戶的令牌索引最多記錄的令牌數，超出時丟棄最早過期的條目
+USER_TOKEN_INDEX_MAX_ENTRIES = _get_settings_value('SSO_USER_TOKEN_INDEX_MAX_ENTRIES', 100)
+
+# 用戶令牌索引的更新通過共享緩存中的鎖串行化：鎖的最長持有時間和等待鎖時的輪詢間隔（秒）
+USER_TOKEN_INDEX_LOCK_TIMEOUT = 2
+USER_TOKEN_INDEX_LOCK_INTERVAL = 0.01
+
+# 進程內 L1 緩存配置（位於共享緩存之前），條目數為 0 時禁用
+LOCAL_CACHE_TTL = _get_settings_value('SSO_LOCAL_CACHE_TTL', 30)
+LOCAL_CACHE_MAX_ENTRIES = _get_settings_value('SSO_LOCAL_CACHE_MAX_ENTRIES', 1024)
+
+# 每 N 次共享緩存寫入記錄一次條目大小，測量需要額外 pickle 一次；0 表示不記錄
+CACHE_PAYLOAD_SAMPLE_RATE = _get_settings_value('SSO_CACHE_PAYLOAD_SAMPLE_RATE', 100)
+
+
+class LocalCache:
+    """
+    進程內有界 TTL/LRU 緩存
+
+    作為 Django 共享緩存前的 L1 層，避免重複請求的網絡往返和反序列化。
+    超過條目上限時淘汰最久未使用的條目。線程安全。
+
+    參數:
+        max_entries (int): 最大條目數
+        ttl (int): 條目存活秒數
+        name (str, optional): 監控指標中的緩存類型標籤，提供時記錄淘汰次數
+    """
+
+    def __init__(self, max_entries, ttl, name=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.name = name
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.ttl > 0
+
+    def get(self, key):
+        """獲取未過期的值，未命中時返回 None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        """設置值，過期時間不超過 L1 TTL"""
+        if not self.enabled:
+            return
+        ttl = min(timeout, self.ttl) if timeout else self.ttl
+        evicted = 0
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                evicted += 1
+        if evicted and self.name:
+            cache_evictions.labels(self.name).inc(evicted)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_where(self, predicate):
+        """刪除所有值滿足 predicate 的條目，返回刪除數量"""
+        with self._lock:
+            keys = [key for key, (_, value) in self._data.items() if predicate(value)]
+            for key in keys:
+                del self._data[key]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# 軟過期後條目仍可返回的秒數（期間在後台重新驗證），為 0 時禁用 stale-while-revalidate
+STALE_TTL = _get_settings_value('SSO_CACHE_STALE_TTL', 60)
+REVALIDATE_WORKERS = _get_settings_value('SSO_CACHE_REVALIDATE_WORKERS', 2)
+REVALIDATE_MAX_PENDING = _get_settings_value('SSO_CACHE_REVALIDATE_MAX_PENDING', 100)
+
+# SSO 不可用時，軟過期後仍可作為最後已知有效值使用的秒數，為 0 時禁用降級模式
+DEGRADED_GRACE_PERIOD = _get_settings_value('SSO_DEGRADED_MODE_GRACE_PERIOD', 0)
+
+# 寫入時隨機縮短 TTL 的最大比例，避免同一批登錄的條目在同一秒過期
+TTL_JITTER = _get_settings_value('SSO_CACHE_TTL_JITTER', 0.1)
+
+# XFetch 概率提前重新驗證：delta 為重新驗證的預估耗時（秒），beta 越大越早觸發，為 0 時禁用
+EARLY_RECOMPUTE_DELTA = _get_settings_value('SSO_CACHE_EARLY_RECOMPUTE_DELTA', 1.0)
+EARLY_RECOMPUTE_BETA = _get_settings_value('SSO_CACHE_EARLY_RECOMPUTE_BETA', 1.0)
+
+
+class CacheEntry:
+    """
+    帶軟過期時間的共享緩存條目
+
+    共享緩存中的硬過期時間為 軟過期 + max(STALE_TTL, DEGRADED_GRACE_PERIOD)。
+    軟過期後 STALE_TTL 內條目仍可返回，同時在後台重新驗證；之後才需要同步請求 SSO。
+    SSO 不可用時，DEGRADED_GRACE_PERIOD 內的條目可作為最後已知有效值使用。
+    """
+
+    __slots__ = ('value', 'soft_expires_at')
+
+    def __init__(self, value, soft_expires_at):
+        self.value = value
+        self.soft_expires_at = soft_expires_at
+
+
+class RefreshFailure:
+    """
+    寫入刷新結果槽的失敗結果，等待同一 refresh token 刷新結果的請求直接返回該錯誤
+
+    參數:
+        error (str): refresh_access_token 返回的錯誤信息
+    """
+
+    __slots__ = ('error',)
+
+    def __init__(self, error):
+        self.error = error
+
+
+_revalidation_executor = None
+_revalidating = set()
+_revalidation_lock = threading.Lock()
+
+
+def _schedule_revalidation(cache_key, revalidate, identifier):
+    """
+    在有界線程池中調度後台重新驗證，同一緩存鍵同時只有一個任務
+
+    返回:
+        bool: 是否已調度
+    """
+    global _revalidation_executor
+    with _revalidation_lock:
+        if cache_key in _revalidating or len(_revalidating) >= REVALIDATE_MAX_PENDING:
+            return False
+        _revalidating.add(cache_key)
+        if _revalidation_executor is None:
+            _revalidation_executor = ThreadPoolExecutor(
+                max_workers=REVALIDATE_WORKERS,
+                thread_name_prefix='lungfung-sso-revalidate'
+            )
+
+    def run():
+        try:
+            revalidate(identifier)
+        except Exception as e:
+            logger.error(f"後台重新驗證緩存失敗: {str(e)}")
+        finally:
+            with _revalidation_lock:
+                _revalidating.discard(cache_key)
+
+    _revalidation_executor.submit(run)
+    return True
+
+
+def _apply_jitter(timeout):
+    """將 TTL 隨機縮短最多 SSO_CACHE_TTL_JITTER 比例，不會超過配置的 TTL"""
+    if TTL_JITTER <= 0:
+        return timeout
+    return timeout * (1 - random.uniform(0, TTL_JITTER))
+
+
+def _should_recompute_early(remaining):
+    """
+    XFetch 算法：剩餘新鮮時間越短，提前重新驗證的概率越高
+
+    每次讀取時觸發的概率為 exp(-remaining / (delta * beta))，
+    使同一批條目的重新驗證分散到過期前的一段時間內，而不是集中在過期那一刻。
+    """
+    if EARLY_RECOMPUTE_DELTA <= 0 or EARLY_RECOMPUTE_BETA <= 0:
+        return False
+    return -EARLY_RECOMPUTE_DELTA * EARLY_RECOMPUTE_BETA * math.log(1.0 - random.random()) >= remaining
+
+
+def _wrap_entry(value, timeout):
+    """
+    包裝緩存值，軟過期時間應用 TTL 抖動
+
+    返回:
+        tuple: (CacheEntry, 共享緩存中的硬過期秒數)
+    """
+    timeout = _apply_jitter(timeout)
+    return CacheEntry(value, time.time() + timeout), math.ceil(timeout + max(STALE_TTL, DEGRADED_GRACE_PERIOD))
+
+
+def _unwrap_entry(cache_key, cached, revalidate, identifier):
+    """
+    解包共享緩存條目
+
+    軟過期的條目在提供了 revalidate 回調時照常返回並調度後台重新驗證，
+    否則視為未命中；臨近軟過期的新鮮條目按 XFetch 概率提前調度重新驗證。
+    舊格式（未包裝）的條目按新鮮條目處理。
+
+    返回:
+        tuple: (value, fresh_seconds) - fresh_seconds 為剩餘的新鮮時間，過期為 0
+    """
+    if not isinstance(cached, CacheEntry):
+        return cached, None
+
+    remaining = cached.soft_expires_at - time.time()
+    if remaining > 0:
+        if revalidate is not None and _should_recompute_early(remaining):
+            if _schedule_revalidation(cache_key, revalidate, identifier):
+                logger.debug("緩存條目即將過期，提前在後台重新驗證")
+        return cached.value, remaining
+
+    # 超過 STALE_TTL 的條目只為降級模式保留
+    if revalidate is None or -remaining >= STALE_TTL:
+        return None, 0
+
+    if _schedule_revalidation(cache_key, revalidate, identifier):
+        logger.debug("緩存條目已軟過期，返回舊值並在後台重新驗證")
+    return cached.value, 0
+
+
+def _get_last_known_good(key_type, cache_key):
+    """獲取降級寬限期內的最後已知有效值"""
+    if DEGRADED_GRACE_PERIOD <= 0:
+        return None
+    try:
+        cached = _get_cache().get(cache_key)
+    except Exception as e:
+        cache_errors.labels(key_type, 'get').inc()
+        logger.error(f"讀取最後已知有效緩存失敗: {str(e)}")
+        return None
+    if not isinstance(cached, CacheEntry):
+        return cached
+    if time.time() - cached.soft_expires_at > DEGRADED_GRACE_PERIOD:
+        return None
+    return cached.value
+
+
+def _record_lookup(key_type, value, tier='shared'):
+    """記錄一次緩存查詢的命中（按 local/shared 層級）或未命中"""
+    if value is None:
+        cache_misses.labels(key_type).inc()
+    else:
+        cache_hits.labels(key_type, tier).inc()
+
+
+# 共享緩存寫入計數，用於條目大小抽樣
+_set_counter = itertools.count()
+
+
+def _record_set(key_type, value):
+    """
+    記錄一次共享緩存寫入；安裝 prometheus_client 時每 SSO_CACHE_PAYLOAD_SAMPLE_RATE 次寫入
+    抽樣記錄一次條目序列化後的大小，避免每次寫入都重複 pickle
+    """
+    cache_sets.labels(key_type).inc()
+    if PROMETHEUS_AVAILABLE and CACHE_PAYLOAD_SAMPLE_RATE > 0 and next(_set_counter) % CACHE_PAYLOAD_SAMPLE_RATE == 0:
+        try:
+            cache_payload_size.labels(key_type).observe(len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+        except Exception:
+            # 緩存後端可能使用其他序列化方式，無法 pickle 時不記錄大小
+            pass
+
+
+# 令牌 -> 用戶對象的 L1 緩存
+_local_token_cache = LocalCache(LOCAL_CACHE_MAX_ENTRIES, min(LOCAL_CACHE_TTL, TOKEN_CACHE_TTL), CACHE_TYPE_TOKEN)
+
+# 令牌緩存鍵 -> 用戶ID 的旁路索引，值很小，保留到令牌驗證結果過期為止。
+# 已知用戶ID時可以在同一次 get_many 中同時讀取令牌和權限條目。
+# 索引只存在於本進程，是盡力而為的優化：冷啟動或被淘汰後缺失的映射在下一次從共享緩存
+# 讀取令牌條目時重新填充（見 _finish_token_lookup），缺失期間只是多一次緩存往返。
+# 它不參與失效：INVALIDATE_USER 按 L1 中用戶對象的 id 刪除令牌條目，共享緩存中的條目
+# 由發起方通過用戶令牌索引（get_user_tokens_cache_key）刪除，都不依賴這份旁路索引。
+_local_token_user_ids = LocalCache(LOCAL_CACHE_MAX_ENTRIES * 4, TOKEN_CACHE_TTL, CACHE_TYPE_TOKEN_USER_IDS)
+
+
+def clear_local_cache():
+    """清空當前進程的 L1 緩存"""
+    _local_token_cache.clear()
+    _local_token_user_ids.clear()
+
+
+def _broadcast_invalidation(kind, value=None):
+    """向其他工作進程廣播失效消息，未配置 SSO_INVALIDATION_BUS 時不做任何事"""
+    bus = get_invalidation_bus(_apply_invalidation)
+    if bus is not None:
+        bus.publish(kind, value)
+
+
+def _apply_invalidation(kind, value):
+    """處理其他工作進程廣播的失效消息，只刪除本進程 L1 中的條目"""
+    if kind == INVALIDATE_KEYS:
+        for key in value:
+            _local_token_cache.delete(key)
+            _local_token_user_ids.delete(key)
+    elif kind == INVALIDATE_USER:
+        _local_token_cache.delete_where(lambda user: getattr(user, 'id', None) == value)
+        _local_token_user_ids.delete_where(lambda user_id: user_id == value)
+    elif kind == INVALIDATE_GENERATION:
+        _local_generations.delete(value)
+    elif kind == INVALIDATE_ALL:
+        clear_local_cache()
+        _local_generations.clear()
+    logger.debug(f"已處理緩存失效廣播: {kind}")
+
+# 世代計數器的進程內緩存
+_local_generations = LocalCache(1024, GENERATION_CACHE_TTL, CACHE_TYPE_GENERATION)
+
+
+def _get_generation_key(scope):
+    return f"{CACHE_KEY_PREFIX}v{CACHE_KEY_VERSION}_{CACHE_TYPE_GENERATION}_{scope}"
+
+def _initial_generation():
+    # 以毫秒時間戳作為初始值，計數器被淘汰後重新初始化也不會回到用過的世代
+    return int(time.time() * 1000)
+
+def get_generation(scope):
+    """
+    獲取緩存世代計數器的當前值
+    
+    讀取結果在進程內緩存 SSO_CACHE_GENERATION_TTL 秒，不會為每次緩存訪問增加網絡往返。
+    
+    參數:
+        scope (str): 計數器範圍，緩存類型（如 'permissions'）
+        
+    返回:
+        int: 當前世代；緩存不可用時返回 0
+    """
+    generation = _local_generations.get(scope)
+    if generation is not None:
+        return generation
+    
+    key = _get_generation_key(scope)
+    try:
+        cache = _get_cache()
+        generation = cache.get(key)
+        if generation is None:
+            cache.add(key, _initial_generation(), None)
+            generation = cache.get(key)
+    except Exception as e:
+        logger.error(f"讀取緩存世代失敗: {str(e)}")
+        generation = None
+    
+    if generation is None:
+        return 0
+    _local_generations.set(scope, generation)
+    return generation
+
+async def aget_generation(scope):
+    """get_generation 的異步版本，進程內緩存未命中時通過 aget/aadd 讀取，不阻塞事件循環"""
+    generation = _local_generations.get(scope)
+    if generation is not None:
+        return generation
+    
+    key = _get_generation_key(scope)
+    try:
+        cache = _get_cache()
+        generation = await cache.aget(key)
+        if generation is None:
+            await cache.aadd(key, _initial_generation(), None)
+            generation = await cache.aget(key)
+    except Exception as e:
+        logger.error(f"讀取緩存世代失敗: {str(e)}")
+        generation = None
+    
+    if generation is None:
+        return 0
+    _local_generations.set(scope, generation)
+    return generation
+
+def bump_generation(scope):
+    """
+    遞增緩存世代計數器，使該範圍內的所有緩存條目在邏輯上失效
+    
+    不需要掃描或刪除任何鍵；舊條目不再被讀取，到期後自然淘汰。
+    當前進程立即生效；其他進程在 SSO_CACHE_GENERATION_TTL 秒內生效，
+    配置了 SSO_INVALIDATION_BUS 時通過廣播立即生效。
+    
+    參數:
+        scope (str): 計數器範圍，緩存類型
+        
+    返回:
+        int or None: 新的世代，失敗時返回 None
+    """
+    key = _get_generation_key(scope)
+    cache = _get_cache()
+    try:
+        try:
+            generation = cache.incr(key)
+        except ValueError:
+            # 計數器不存在（從未使用或已被淘汰）
+            generation = _initial_generation()
+            if not cache.add(key, generation, None):
+                generation = cache.incr(key)
+    except Exception as e:
+        logger.error(f"遞增緩存世代失敗: {str(e)}")
+        return None
+    
+    _local_generations.delete(scope)
+    _broadcast_invalidation(INVALIDATE_GENERATION, scope)
+    logger.info(f"緩存世代已遞增: {scope} -> {generation}")
+    return generation
+
+def invalidate_cache_type(key_type):
+    """
+    使某一類型的所有緩存條目失效，例如整個部門的 SSO 角色變更後使所有權限緩存失效
+    
+    參數:
+        key_type (str): 緩存類型，如 CACHE_TYPE_PERMISSIONS、CACHE_TYPE_TOKEN
+        
+    返回:
+        int or None: 新的世代
+    """
+    return bump_generation(key_type)
+
+def invalidate_module_cache(module_code):
+    """
+    使與某個模塊相關的緩存條目失效，例如重新部署 SSO_PERMISSIONS 配置後
+    
+    權限緩存按用戶存放，每個條目包含該用戶所有模塊的權限，無法只讓單個模塊的部分失效；
+    因此這裡等同於 invalidate_cache_type(CACHE_TYPE_PERMISSIONS)，使所有用戶的權限緩存失效。
+    令牌驗證緩存不受影響。
+    
+    參數:
+        module_code (str): 模塊代碼，僅用於日誌
+        
+    返回:
+        int or None: 權限緩存的新世代
+    """
+    logger.info(f"模塊 {module_code} 的權限配置變更，使所有權限緩存失效")
+    return bump_generation(CACHE_TYPE_PERMISSIONS)
 
 def get_cache_key(key_type, identifier):
     """
     生成標準化的緩存鍵
     
+    格式為 {前綴}v{版本}_{類型}_g{類型世代}_{標識符}。令牌類標識符應先經過 get_token_digest 處理。
+    
     參數:
         key_type (str): 緩存鍵類型，如 'token', 'permissions', 'user'
-        identifier (str): 標識符，如用戶ID、令牌值等
+        identifier (str): 標識符，如用戶ID、令牌摘要等
         
     返回:
         str: 標準化的緩存鍵
     """
+    return _format_cache_key(key_type, identifier, get_generation(key_type))
+
+async def aget_cache_key(key_type, identifier):
+    """get_cache_key 的異步版本，世代通過 aget_generation 讀取"""
+    return _format_cache_key(key_type, identifier, await aget_generation(key_type))
+
+def _format_cache_key(key_type, identifier, generation):
+    return f"{CACHE_KEY_PREFIX}v{CACHE_KEY_VERSION}_{key_type}_g{generation}_{identifier}"
+
+def get_token_digest(token_value):
+    """
+    計算令牌的定長摘要，用作緩存鍵的標識符
+    
+    完整的 JWT 通常有數百字節，直接放入緩存鍵會超出 memcached 的 250 字節限制，
+    也會浪費 Redis 內存和帶寬。
+    
+    參數:
+        token_value (str): 令牌值
+        
+    返回:
+        str: 64 個字符的 SHA-256 十六進制摘要
+    """
+    return hashlib.sha256(token_value.encode('utf-8')).hexdigest()
+
+def _get_legacy_cache_key(key_type, identifier):
+    """舊版緩存鍵（未版本化、令牌明文），只在遷移期間讀取和刪除"""
     return f"{CACHE_KEY_PREFIX}{key_type}_{identifier}"
 
+def _get_shared(key_type, cache_key, identifier):
+    """讀取共享緩存並記錄耗時，啟用 SSO_CACHE_READ_LEGACY_KEYS 時新鍵未命中回退讀取舊版鍵"""
+    cache = _get_cache()
+    try:
+        with cache_latency.labels(key_type, 'get').time():
+            cached = cache.get(cache_key)
+            if cached is None and READ_LEGACY_KEYS:
+                cached = cache.get(_get_legacy_cache_key(key_type, identifier))
+                if cached is not None:
+                    logger.debug("從舊版緩存鍵讀取到條目")
+    except Exception:
+        cache_errors.labels(key_type, 'get').inc()
+        raise
+    return cached
+
+async def _aget_shared(key_type, cache_key, identifier):
+    """_get_shared 的異步版本"""
+    cache = _get_cache()
+    try:
+        with cache_latency.labels(key_type, 'get').time():
+            cached = await cache.aget(cache_key)
+            if cached is None and READ_LEGACY_KEYS:
+                cached = await cache.aget(_get_legacy_cache_key(key_type, identifier))
+                if cached is not None:
+                    logger.debug("從舊版緩存鍵讀取到條目")
+    except Exception:
+        cache_errors.labels(key_type, 'get').inc()
+        raise
+    return cached
+
+def _delete_legacy(legacy_key):
+    if READ_LEGACY_KEYS:
+        _get_cache().delete(legacy_key)
+
+async def _adelete_legacy(legacy_key):
+    if READ_LEGACY_KEYS:
+        await _get_cache().adelete(legacy_key)
+
 def get_token_cache_key(token_value):
     """
     生成令牌驗證結果的緩存鍵
@@ -88,7 +699,19 @@ def get_token_cache_key(token_value):
     返回:
         str: 緩存鍵
     """
-    return get_cache_key(CACHE_TYPE_TOKEN, token_value)
+    return get_cache_key(CACHE_TYPE_TOKEN, get_token_digest(token_value))
+
+def get_token_rejection_cache_key(token_value):
+    """
+    生成令牌負緩存（驗證被拒絕）的緩存鍵
+    
+    參數:
+        token_value (str): 令牌值
+        
+    返回:
+        str: 緩存鍵
+    """
+    return get_cache_key(CACHE_TYPE_TOKEN_REJECTION, get_token_digest(token_value))
 
 def get_permissions_cache_key(user_id):
     """
@@ -114,6 +737,119 @@ def get_user_cache_key(user_id):
     """
     return get_cache_key(CACHE_TYPE_USER, user_id)
 
+def get_user_tokens_cache_key(user_id):
+    """
+    生成用戶令牌索引的緩存鍵
+    
+    參數:
+        user_id (int): 用戶ID
+        
+    返回:
+        str: 緩存鍵
+    """
+    return get_cache_key(CACHE_TYPE_USER_TOKENS, user_id)
+
+async def aget_token_cache_key(token_value):
+    """get_token_cache_key 的異步版本"""
+    return await aget_cache_key(CACHE_TYPE_TOKEN, get_token_digest(token_value))
+
+async def aget_token_rejection_cache_key(token_value):
+    """get_token_rejection_cache_key 的異步版本"""
+    return await aget_cache_key(CACHE_TYPE_TOKEN_REJECTION, get_token_digest(token_value))
+
+async def aget_permissions_cache_key(user_id):
+    """get_permissions_cache_key 的異步版本"""
+    return await aget_cache_key(CACHE_TYPE_PERMISSIONS, user_id)
+
+async def aget_user_tokens_cache_key(user_id):
+    """get_user_tokens_cache_key 的異步版本"""
+    return await aget_cache_key(CACHE_TYPE_USER_TOKENS, user_id)
+
+def _update_token_index(index, cache_key, hard_timeout):
+    """
+    將令牌緩存鍵加入用戶令牌索引
+    
+    索引為 {令牌緩存鍵: 過期時間戳}。已記錄且剩餘時間超過一半的條目不重複寫入，
+    穩定狀態下（後台重新驗證等）不會產生額外的寫操作。
+    
+    返回:
+        tuple: (index, timeout) - 需要寫回的索引及其超時時間；無需寫入時 index 為 None
+    """
+    now = time.time()
+    expires_at = now + hard_timeout
+    if index and index.get(cache_key, 0) - now > hard_timeout / 2:
+        return None, None
+    
+    index = {key: exp for key, exp in (index or {}).items() if exp > now}
+    index[cache_key] = expires_at
+    if len(index) > USER_TOKEN_INDEX_MAX_ENTRIES:
+        index = dict(sorted(index.items(), key=lambda item: item[1])[-USER_TOKEN_INDEX_MAX_ENTRIES:])
+    return index, max(index.values()) - now
+
+def _index_user_token(user_obj, cache_key, hard_timeout):
+    """
+    在用戶令牌索引中記錄令牌緩存鍵，供 invalidate_user_cache 精確刪除
+    
+    索引的讀取-修改-寫回在 {索引鍵}:lock 的 add 鎖內進行，同一用戶同時登錄的多個令牌
+    不會互相覆蓋。等待超過 USER_TOKEN_INDEX_LOCK_TIMEOUT 秒（持有者異常退出，鎖即將過期）
+    時不加鎖寫入。索引寫入失敗只記錄日誌，不影響令牌驗證結果的緩存。
+    """
+    user_id = getattr(user_obj, 'id', None)
+    if user_id is None:
+        return
+    try:
+        index_key = get_user_tokens_cache_key(user_id)
+        cache = _get_cache()
+        index, _ = _update_token_index(cache.get(index_key), cache_key, hard_timeout)
+        if index is None:
+            return
+        
+        lock_key = f"{index_key}:lock"
+        deadline = time.monotonic() + USER_TOKEN_INDEX_LOCK_TIMEOUT
+        acquired = cache.add(lock_key, 1, USER_TOKEN_INDEX_LOCK_TIMEOUT)
+        while not acquired and time.monotonic() < deadline:
+            time.sleep(USER_TOKEN_INDEX_LOCK_INTERVAL)
+            acquired = cache.add(lock_key, 1, USER_TOKEN_INDEX_LOCK_TIMEOUT)
+        try:
+            index, index_timeout = _update_token_index(cache.get(index_key), cache_key, hard_timeout)
+            if index is not None:
+                cache.set(index_key, index, index_timeout)
+        finally:
+            if acquired:
+                cache.delete(lock_key)
+    except Exception as e:
+        cache_errors.labels(CACHE_TYPE_USER_TOKENS, 'set').inc()
+        logger.error(f"更新用戶令牌索引失敗，用戶ID: {user_id}: {str(e)}")
+
+async def _aindex_user_token(user_obj, cache_key, hard_timeout):
+    """_index_user_token 的異步版本"""
+    user_id = getattr(user_obj, 'id', None)
+    if user_id is None:
+        return
+    try:
+        index_key = await aget_user_tokens_cache_key(user_id)
+        cache = _get_cache()
+        index, _ = _update_token_index(await cache.aget(index_key), cache_key, hard_timeout)
+        if index is None:
+            return
+        
+        lock_key = f"{index_key}:lock"
+        deadline = time.monotonic() + USER_TOKEN_INDEX_LOCK_TIMEOUT
+        acquired = await cache.aadd(lock_key, 1, USER_TOKEN_INDEX_LOCK_TIMEOUT)
+        while not acquired and time.monotonic() < deadline:
+            await asyncio.sleep(USER_TOKEN_INDEX_LOCK_INTERVAL)
+            acquired = await cache.aadd(lock_key, 1, USER_TOKEN_INDEX_LOCK_TIMEOUT)
+        try:
+            index, index_timeout = _update_token_index(await cache.aget(index_key), cache_key, hard_timeout)
+            if index is not None:
+                await cache.aset(index_key, index, index_timeout)
+        finally:
+            if acquired:
+                await cache.adelete(lock_key)
+    except Exception as e:
+        cache_errors.labels(CACHE_TYPE_USER_TOKENS, 'set').inc()
+        logger.error(f"更新用戶令牌索引失敗，用戶ID: {user_id}: {str(e)}")
+
 def cache_user_data(timeout=None):
     """
     裝飾器：緩存用戶數據
@@ -137,7 +873,9 @@ def cache_user_data(timeout=None):
                 return view_func(request, *args, **kwargs)
                 
             cache_key = get_user_cache_key(request.user.id)
-            user_data = _get_cache().get(cache_key)
+            with cache_latency.labels(CACHE_TYPE_USER, 'get').time():
+                user_data = _get_cache().get(cache_key)
+            _record_lookup(CACHE_TYPE_USER, user_data)
             
             if user_data is None:
                 logger.debug(f"用戶數據緩存未命中，為用戶ID: {request.user.id} 創建緩存")
@@ -163,11 +901,13 @@ def cache_user_data(timeout=None):
                 # 使用配置的超時時間或默認值
                 cache_timeout = timeout or USER_CACHE_TTL
                 
-                _get_cache().set(
-                    cache_key, 
-                    user_data, 
-                    cache_timeout
-                )
+                with cache_latency.labels(CACHE_TYPE_USER, 'set').time():
+                    _get_cache().set(
+                        cache_key, 
+                        user_data, 
+                        cache_timeout
+                    )
+                _record_set(CACHE_TYPE_USER, user_data)
                 logger.debug(f"用戶數據已緩存，過期時間: {cache_timeout}秒")
             else:
                 logger.debug(f"使用緩存的用戶數據，用戶ID: {request.user.id}")
@@ -177,6 +917,18 @@ def cache_user_data(timeout=None):
         return wrapped_view
     return decorator
 
+def _encode_user(user_obj):
+    """將用戶對象編碼為緊湊元組（見 User.to_cache_data），其他對象原樣返回"""
+    to_cache_data = getattr(user_obj, 'to_cache_data', None)
+    return to_cache_data() if to_cache_data is not None else user_obj
+
+def _decode_user(value, token_value):
+    """從緊湊元組重建用戶對象；舊格式的 User 實例原樣返回"""
+    if not isinstance(value, tuple):
+        return value
+    from .models import User
+    return User.from_cache_data(value, token_value)
+
 def set_token_verification_cache(token_value, user_obj, timeout=None):
     """
     設置令牌驗證結果緩存
@@ -193,35 +945,369 @@ def set_token_verification_cache(token_value, user_obj, timeout=None):
     cache_timeout = timeout or TOKEN_CACHE_TTL
     
     try:
-        _get_cache().set(cache_key, user_obj, cache_timeout)
+        entry, hard_timeout = _wrap_entry(_encode_user(user_obj), cache_timeout)
+        with cache_latency.labels(CACHE_TYPE_TOKEN, 'set').time():
+            _get_cache().set(cache_key, entry, hard_timeout)
+        _record_set(CACHE_TYPE_TOKEN, entry)
+        _index_user_token(user_obj, cache_key, hard_timeout)
+        _local_token_cache.set(cache_key, copy.copy(user_obj), cache_timeout)
+        _local_token_user_ids.set(cache_key, getattr(user_obj, 'id', None), cache_timeout)
         logger.debug(f"令牌驗證結果已緩存，過期時間: {cache_timeout}秒")
         return True
     except Exception as e:
+        cache_errors.labels(CACHE_TYPE_TOKEN, 'set').inc()
         logger.error(f"設置令牌驗證緩存失敗: {str(e)}")
         return False
 
-def get_token_verification_cache(token_value):
+def get_token_verification_cache(token_value, revalidate=None):
     """
     獲取令牌驗證結果緩存
     
     參數:
         token_value (str): 令牌值
+        revalidate (callable, optional): 後台重新驗證回調，以 token_value 調用。
+            提供時軟過期的條目會照常返回並在後台刷新，否則軟過期視為未命中
         
     返回:
         User or None: 用戶對象，如果緩存未命中則返回None
     """
     cache_key = get_token_cache_key(token_value)
-    cached_user = _get_cache().get(cache_key)
     
-    log_level = _get_settings_value('SSO_LOGGING_LEVEL', 'DEBUG' if _get_settings_value('DEBUG', False) else 'INFO')
+    cached_user = _get_local_user(cache_key)
+    if cached_user is not None:
+        return cached_user
+    
+    cached = _get_shared(CACHE_TYPE_TOKEN, cache_key, token_value)
+    return _finish_token_lookup(cache_key, cached, revalidate, token_value)
+
+async def aget_token_verification_cache(token_value, revalidate=None):
+    """
+    get_token_verification_cache 的異步版本
+    
+    L1 命中時不涉及任何 I/O；未命中時異步讀取共享緩存。
+    revalidate 回調仍在後台線程池中同步執行。
+    """
+    cache_key = await aget_token_cache_key(token_value)
+    
+    cached_user = _get_local_user(cache_key)
+    if cached_user is not None:
+        return cached_user
+    
+    cached = await _aget_shared(CACHE_TYPE_TOKEN, cache_key, token_value)
+    return _finish_token_lookup(cache_key, cached, revalidate, token_value)
+
+def _get_local_user(cache_key):
+    """查詢進程內 L1 緩存，返回淺拷貝以免請求間共享屬性修改"""
+    cached_user = _local_token_cache.get(cache_key)
+    if cached_user is not None:
+        cache_hits.labels(CACHE_TYPE_TOKEN, 'local').inc()
+        logger.debug("令牌驗證 L1 緩存命中")
+        return copy.copy(cached_user)
+    return None
+
+def _finish_token_lookup(cache_key, cached, revalidate, token_value):
+    """處理從共享緩存讀取的令牌驗證條目"""
+    cached_user, fresh_seconds = _unwrap_entry(cache_key, cached, revalidate, token_value)
+    cached_user = _decode_user(cached_user, token_value)
+    _record_lookup(CACHE_TYPE_TOKEN, cached_user or None)
+    # 只有新鮮的條目才放入 L1，且不超過其剩餘新鮮時間
+    if cached_user and fresh_seconds != 0:
+        _local_token_cache.set(cache_key, copy.copy(cached_user), fresh_seconds)
     if cached_user:
-        if log_level == 'DEBUG':
+        _local_token_user_ids.set(cache_key, getattr(cached_user, 'id', None))
+    
+    if cached_user:
+        if _is_detailed_logging():
             logger.debug(f"令牌驗證緩存命中，用戶: {cached_user.username}")
     else:
         logger.debug("令牌驗證緩存未命中")
         
     return cached_user
 
+async def aset_token_verification_cache(token_value, user_obj, timeout=None):
+    """set_token_verification_cache 的異步版本"""
+    cache_key = await aget_token_cache_key(token_value)
+    cache_timeout = timeout or TOKEN_CACHE_TTL
+    
+    try:
+        entry, hard_timeout = _wrap_entry(_encode_user(user_obj), cache_timeout)
+        with cache_latency.labels(CACHE_TYPE_TOKEN, 'set').time():
+            await _get_cache().aset(cache_key, entry, hard_timeout)
+        _record_set(CACHE_TYPE_TOKEN, entry)
+        await _aindex_user_token(user_obj, cache_key, hard_timeout)
+        _local_token_cache.set(cache_key, copy.copy(user_obj), cache_timeout)
+        _local_token_user_ids.set(cache_key, getattr(user_obj, 'id', None), cache_timeout)
+        logger.debug(f"令牌驗證結果已緩存，過期時間: {cache_timeout}秒")
+        return True
+    except Exception as e:
+        cache_errors.labels(CACHE_TYPE_TOKEN, 'set').inc()
+        logger.error(f"設置令牌驗證緩存失敗: {str(e)}")
+        return False
+
+def get_last_known_good_user(token_value):
+    """
+    SSO 不可用時獲取令牌最後一次驗證成功的用戶對象（降級模式）
+    
+    只返回軟過期後 SSO_DEGRADED_MODE_GRACE_PERIOD 秒內的條目，
+    且令牌本身的 exp 聲明尚未過期。
+    
+    參數:
+        token_value (str): 令牌值
+        
+    返回:
+        User or None: 用戶對象，未啟用降級模式或沒有可用條目時返回None
+    """
+    if DEGRADED_GRACE_PERIOD <= 0 or _token_expired(token_value):
+        return None
+    
+    cached = _get_last_known_good(CACHE_TYPE_TOKEN, get_token_cache_key(token_value))
+    cached_user = _decode_user(cached, token_value)
+    if cached_user:
+        logger.warning(f"SSO 不可用，使用最後已知有效的令牌驗證結果，用戶: {cached_user.username}")
+    return cached_user
+
+async def aget_last_known_good_user(token_value):
+    """get_last_known_good_user 的異步版本"""
+    if DEGRADED_GRACE_PERIOD <= 0 or _token_expired(token_value):
+        return None
+    
+    from asgiref.sync import sync_to_async
+    return await sync_to_async(get_last_known_good_user, thread_sensitive=False)(token_value)
+
+def _token_expired(token_value):
+    """令牌的 exp 聲明是否已過期（不驗證簽名）"""
+    from .jwt_verification import get_unverified_expiry
+    
+    expiry = get_unverified_expiry(token_value)
+    return expiry is not None and expiry <= time.time()
+
+def set_token_rejection_cache(token_value, reason, timeout=None):
+    """
+    設置令牌負緩存，記錄令牌驗證或刷新被拒絕的結果
+    
+    參數:
+        token_value (str): 令牌值（access token 或 refresh token）
+        reason (str): 拒絕原因，REJECTION_INVALID、REJECTION_EXPIRED、REJECTION_REFRESH_FAILED
+            或 REJECTION_REFRESH_COOLDOWN
+        timeout (int, optional): 緩存超時時間（秒）。如果為None，則使用 settings.SSO_NEGATIVE_CACHE_TTL
+        
+    返回:
+        bool: 緩存是否設置成功
+    """
+    cache_key = get_token_rejection_cache_key(token_value)
+    cache_timeout = timeout or REJECTION_CACHE_TTL
+    
+    try:
+        with cache_latency.labels(CACHE_TYPE_TOKEN_REJECTION, 'set').time():
+            _get_cache().set(cache_key, reason, cache_timeout)
+        _record_set(CACHE_TYPE_TOKEN_REJECTION, reason)
+        _local_token_cache.set(cache_key, reason, cache_timeout)
+        logger.debug(f"令牌負緩存已設置，原因: {reason}，過期時間: {cache_timeout}秒")
+        return True
+    except Exception as e:
+        cache_errors.labels(CACHE_TYPE_TOKEN_REJECTION, 'set').inc()
+        logger.error(f"設置令牌負緩存失敗: {str(e)}")
+        return False
+
+async def aset_token_rejection_cache(token_value, reason, timeout=None):
+    """set_token_rejection_cache 的異步版本"""
+    cache_key = await aget_token_rejection_cache_key(token_value)
+    cache_timeout = timeout or REJECTION_CACHE_TTL
+    
+    try:
+        with cache_latency.labels(CACHE_TYPE_TOKEN_REJECTION, 'set').time():
+            await _get_cache().aset(cache_key, reason, cache_timeout)
+        _record_set(CACHE_TYPE_TOKEN_REJECTION, reason)
+        _local_token_cache.set(cache_key, reason, cache_timeout)
+        logger.debug(f"令牌負緩存已設置，原因: {reason}，過期時間: {cache_timeout}秒")
+        return True
+    except Exception as e:
+        cache_errors.labels(CACHE_TYPE_TOKEN_REJECTION, 'set').inc()
+        logger.error(f"設置令牌負緩存失敗: {str(e)}")
+        return False
+
+def get_token_rejection_cache(token_value):
+    """
+    獲取令牌負緩存
+    
+    參數:
+        token_value (str): 令牌值
+        
+    返回:
+        str or None: 拒絕原因，如果緩存未命中則返回None
+    """
+    cache_key = get_token_rejection_cache_key(token_value)
+    
+    reason = _local_token_cache.get(cache_key)
+    if reason is not None:
+        cache_hits.labels(CACHE_TYPE_TOKEN_REJECTION, 'local').inc()
+    else:
+        with cache_latency.labels(CACHE_TYPE_TOKEN_REJECTION, 'get').time():
+            reason = _get_cache().get(cache_key)
+        _fill_local_rejection(cache_key, reason)
+    
+    if reason is not None:
+        logger.debug(f"令牌負緩存命中，原因: {reason}")
+    return reason
+
+async def aget_token_rejection_cache(token_value):
+    """get_token_rejection_cache 的異步版本"""
+    cache_key = await aget_token_rejection_cache_key(token_value)
+    
+    reason = _local_token_cache.get(cache_key)
+    if reason is not None:
+        cache_hits.labels(CACHE_TYPE_TOKEN_REJECTION, 'local').inc()
+    else:
+        with cache_latency.labels(CACHE_TYPE_TOKEN_REJECTION, 'get').time():
+            reason = await _get_cache().aget(cache_key)
+        _fill_local_rejection(cache_key, reason)
+    
+    if reason is not None:
+        logger.debug(f"令牌負緩存命中，原因: {reason}")
+    return reason
+
+def _fill_local_rejection(cache_key, reason):
+    _record_lookup(CACHE_TYPE_TOKEN_REJECTION, reason)
+    if reason is not None:
+        _local_token_cache.set(cache_key, reason, REJECTION_CACHE_TTL)
+
+async def _aget_refresh_keys(refresh_token):
+    """_get_refresh_keys 的異步版本"""
+    digest = get_token_digest(refresh_token)
+    return (
+        await aget_cache_key(CACHE_TYPE_TOKEN_REFRESH, digest),
+        await aget_cache_key(CACHE_TYPE_TOKEN_REFRESH_LOCK, digest),
+    )
+
+def _get_refresh_keys(refresh_token):
+    return (
+        get_cache_key(CACHE_TYPE_TOKEN_REFRESH, get_token_digest(refresh_token)),
+        get_cache_key(CACHE_TYPE_TOKEN_REFRESH_LOCK, get_token_digest(refresh_token)),
+    )
+
+def acquire_refresh_lock(refresh_token):
+    """
+    獲取 refresh token 的跨進程刷新鎖
+    
+    基於緩存的原子 add 操作，鎖在 SSO_REFRESH_LOCK_TIMEOUT 秒後自動過期。
+    
+    參數:
+        refresh_token (str): refresh token
+        
+    返回:
+        bool: 是否獲得鎖；緩存不可用時返回 True，由當前請求自行刷新
+    """
+    _, lock_key = _get_refresh_keys(refresh_token)
+    try:
+        return _get_cache().add(lock_key, 1, REFRESH_LOCK_TIMEOUT)
+    except Exception as e:
+        logger.error(f"獲取刷新鎖失敗: {str(e)}")
+        return True
+
+async def aacquire_refresh_lock(refresh_token):
+    """acquire_refresh_lock 的異步版本"""
+    _, lock_key = await _aget_refresh_keys(refresh_token)
+    try:
+        return await _get_cache().aadd(lock_key, 1, REFRESH_LOCK_TIMEOUT)
+    except Exception as e:
+        logger.error(f"獲取刷新鎖失敗: {str(e)}")
+        return True
+
+def release_refresh_lock(refresh_token):
+    """釋放 refresh token 的跨進程刷新鎖"""
+    _, lock_key = _get_refresh_keys(refresh_token)
+    try:
+        _get_cache().delete(lock_key)
+    except Exception as e:
+        logger.error(f"釋放刷新鎖失敗: {str(e)}")
+
+async def arelease_refresh_lock(refresh_token):
+    """release_refresh_lock 的異步版本"""
+    _, lock_key = await _aget_refresh_keys(refresh_token)
+    try:
+        await _get_cache().adelete(lock_key)
+    except Exception as e:
+        logger.error(f"釋放刷新鎖失敗: {str(e)}")
+
+def set_refresh_result(refresh_token, access_token):
+    """
+    記錄 refresh token 剛刷新得到的 access token，供並發請求直接使用
+    
+    參數:
+        refresh_token (str): refresh token
+        access_token (str): 新的 access token
+    """
+    result_key, _ = _get_refresh_keys(refresh_token)
+    try:
+        _get_cache().set(result_key, access_token, REFRESH_RESULT_TTL)
+    except Exception as e:
+        logger.error(f"設置刷新結果緩存失敗: {str(e)}")
+
+async def aset_refresh_result(refresh_token, access_token):
+    """set_refresh_result 的異步版本"""
+    result_key, _ = await _aget_refresh_keys(refresh_token)
+    try:
+        await _get_cache().aset(result_key, access_token, REFRESH_RESULT_TTL)
+    except Exception as e:
+        logger.error(f"設置刷新結果緩存失敗: {str(e)}")
+
+def set_refresh_failure(refresh_token, error):
+    """
+    記錄 refresh token 的刷新失敗，SSO_REFRESH_FAILURE_TTL 秒內並發請求直接得到同一錯誤，
+    不再各自等待到超時後重複請求 SSO
+    
+    參數:
+        refresh_token (str): refresh token
+        error (str): 錯誤信息
+    """
+    result_key, _ = _get_refresh_keys(refresh_token)
+    try:
+        _get_cache().set(result_key, RefreshFailure(error), REFRESH_FAILURE_TTL)
+    except Exception as e:
+        logger.error(f"設置刷新失敗結果緩存失敗: {str(e)}")
+
+async def aset_refresh_failure(refresh_token, error):
+    """set_refresh_failure 的異步版本"""
+    result_key, _ = await _aget_refresh_keys(refresh_token)
+    try:
+        await _get_cache().aset(result_key, RefreshFailure(error), REFRESH_FAILURE_TTL)
+    except Exception as e:
+        logger.error(f"設置刷新失敗結果緩存失敗: {str(e)}")
+
+def get_refresh_state(refresh_token):
+    """
+    獲取 refresh token 的刷新狀態
+    
+    參數:
+        refresh_token (str): refresh token
+        
+    返回:
+        tuple: (access_token, error, locked) - 最近刷新得到的 access token（沒有時為 None），
+               最近一次刷新失敗的錯誤信息（沒有時為 None），以及是否有其他請求正在刷新
+    """
+    result_key, lock_key = _get_refresh_keys(refresh_token)
+    try:
+        values = _get_cache().get_many([result_key, lock_key])
+    except Exception as e:
+        logger.error(f"讀取刷新狀態失敗: {str(e)}")
+        return None, None, False
+    return _split_refresh_result(values.get(result_key)) + (lock_key in values,)
+
+async def aget_refresh_state(refresh_token):
+    """get_refresh_state 的異步版本"""
+    result_key, lock_key = await _aget_refresh_keys(refresh_token)
+    try:
+        values = await _get_cache().aget_many([result_key, lock_key])
+    except Exception as e:
+        logger.error(f"讀取刷新狀態失敗: {str(e)}")
+        return None, None, False
+    return _split_refresh_result(values.get(result_key)) + (lock_key in values,)
+
+def _split_refresh_result(result):
+    if isinstance(result, RefreshFailure):
+        return None, result.error
+    return result, None
+
 def set_user_permissions_cache(user_id, permissions_data, timeout=None):
     """
     設置用戶權限數據緩存
@@ -238,33 +1324,163 @@ def set_user_permissions_cache(user_id, permissions_data, timeout=None):
     cache_timeout = timeout or PERMISSIONS_CACHE_TTL
     
     try:
-        _get_cache().set(cache_key, permissions_data, cache_timeout)
+        entry, hard_timeout = _wrap_entry(permissions_data, cache_timeout)
+        with cache_latency.labels(CACHE_TYPE_PERMISSIONS, 'set').time():
+            _get_cache().set(cache_key, entry, hard_timeout)
+        _record_set(CACHE_TYPE_PERMISSIONS, entry)
+        logger.debug(f"用戶權限數據已緩存，用戶ID: {user_id}，過期時間: {cache_timeout}秒")
+        return True
+    except Exception as e:
+        cache_errors.labels(CACHE_TYPE_PERMISSIONS, 'set').inc()
+        logger.error(f"設置用戶權限緩存失敗: {str(e)}")
+        return False
+
+async def aset_user_permissions_cache(user_id, permissions_data, timeout=None):
+    """set_user_permissions_cache 的異步版本"""
+    cache_key = await aget_permissions_cache_key(user_id)
+    cache_timeout = timeout or PERMISSIONS_CACHE_TTL
+    
+    try:
+        entry, hard_timeout = _wrap_entry(permissions_data, cache_timeout)
+        with cache_latency.labels(CACHE_TYPE_PERMISSIONS, 'set').time():
+            await _get_cache().aset(cache_key, entry, hard_timeout)
+        _record_set(CACHE_TYPE_PERMISSIONS, entry)
         logger.debug(f"用戶權限數據已緩存，用戶ID: {user_id}，過期時間: {cache_timeout}秒")
         return True
     except Exception as e:
+        cache_errors.labels(CACHE_TYPE_PERMISSIONS, 'set').inc()
         logger.error(f"設置用戶權限緩存失敗: {str(e)}")
         return False
 
-def get_user_permissions_cache(user_id):
+def get_user_permissions_cache(user_id, revalidate=None):
     """
     獲取用戶權限數據緩存
     
     參數:
         user_id (int): 用戶ID
+        revalidate (callable, optional): 後台重新獲取回調，以 user_id 調用。
+            提供時軟過期的條目會照常返回並在後台刷新，否則軟過期視為未命中
         
     返回:
         dict or None: 權限數據，如果緩存未命中則返回None
     """
+    return get_user_permissions_entry(user_id, revalidate)[0]
+
+def get_user_permissions_entry(user_id, revalidate=None):
+    """
+    獲取用戶權限數據緩存及其版本
+    
+    版本在每次寫入權限緩存時生成，同一用戶的版本不變即表示權限數據未變，
+    可用於緩存由權限數據派生的結果（參見 permission_set.get_permission_set）。
+    
+    參數:
+        user_id (int): 用戶ID
+        revalidate (callable, optional): 後台重新獲取回調，見 get_user_permissions_cache
+        
+    返回:
+        tuple: (permissions_data, version) - 緩存未命中時均為 None；舊格式條目的版本為 None
+    """
     cache_key = get_permissions_cache_key(user_id)
-    permissions_data = _get_cache().get(cache_key)
+    cached = _get_shared(CACHE_TYPE_PERMISSIONS, cache_key, user_id)
+    return _finish_permissions_lookup(cache_key, cached, revalidate, user_id)
+
+async def aget_user_permissions_cache(user_id, revalidate=None):
+    """get_user_permissions_cache 的異步版本"""
+    cache_key = await aget_permissions_cache_key(user_id)
+    cached = await _aget_shared(CACHE_TYPE_PERMISSIONS, cache_key, user_id)
+    return _finish_permissions_lookup(cache_key, cached, revalidate, user_id)[0]
+
+def _entry_version(cached):
+    """共享緩存條目的版本：寫入時生成的軟過期時間戳，舊格式條目沒有版本"""
+    return cached.soft_expires_at if isinstance(cached, CacheEntry) else None
+
+def _finish_permissions_lookup(cache_key, cached, revalidate, user_id):
+    """
+    處理從共享緩存讀取的權限條目
+    
+    返回:
+        tuple: (permissions_data, version)
+    """
+    permissions_data, _ = _unwrap_entry(cache_key, cached, revalidate, user_id)
+    _record_lookup(CACHE_TYPE_PERMISSIONS, permissions_data)
     
-    log_level = _get_settings_value('SSO_LOGGING_LEVEL', 'DEBUG' if _get_settings_value('DEBUG', False) else 'INFO')
     if permissions_data:
-        if log_level == 'DEBUG':
+        if _is_detailed_logging():
             logger.debug(f"用戶權限緩存命中，用戶ID: {user_id}")
-    else:
-        logger.debug(f"用戶權限緩存未命中，用戶ID: {user_id}")
+        return permissions_data, _entry_version(cached)
+    
+    logger.debug(f"用戶權限緩存未命中，用戶ID: {user_id}")
+    return None, None
+
+def get_token_and_permissions_cache(token_value, revalidate=None, permissions_revalidate=None):
+    """
+    批量讀取令牌驗證結果及其用戶的權限數據
+    
+    L1 命中或旁路索引中已知該令牌的用戶ID時，令牌條目和權限條目通過一次 get_many 讀取；
+    否則先讀取令牌條目，得到用戶ID後再讀取權限條目。
+    
+    參數:
+        token_value (str): 令牌值
+        revalidate (callable, optional): 令牌條目軟過期時的後台重新驗證回調，見 get_token_verification_cache
+        permissions_revalidate (callable, optional): 權限條目軟過期時的後台重新獲取回調，以用戶ID調用
         
+    返回:
+        tuple: (user, permissions_data) - 令牌緩存未命中時均為 None；
+               permissions_data 為 None 表示權限緩存未命中
+    """
+    cache_key = get_token_cache_key(token_value)
+    cached_user = _get_local_user(cache_key)
+    user_id = cached_user.id if cached_user is not None else _local_token_user_ids.get(cache_key)
+    
+    keys = []
+    if cached_user is None:
+        keys.append(cache_key)
+    permissions_key = get_permissions_cache_key(user_id) if user_id is not None else None
+    if permissions_key is not None:
+        keys.append(permissions_key)
+    
+    # 令牌條目在 L1 命中時只讀取權限條目
+    key_type = CACHE_TYPE_TOKEN if cached_user is None else CACHE_TYPE_PERMISSIONS
+    try:
+        with cache_latency.labels(key_type, 'get_many').time():
+            values = _get_cache().get_many(keys)
+    except Exception as e:
+        cache_errors.labels(key_type, 'get_many').inc()
+        logger.error(f"批量讀取令牌和權限緩存失敗: {str(e)}")
+        values = {}
+    
+    if cached_user is None:
+        cached = values.get(cache_key)
+        if cached is None and READ_LEGACY_KEYS:
+            cached = _get_shared(CACHE_TYPE_TOKEN, cache_key, token_value)
+        cached_user = _finish_token_lookup(cache_key, cached, revalidate, token_value)
+        if cached_user is None:
+            return None, None
+    
+    if cached_user.id is None:
+        return cached_user, None
+    if permissions_key is None or cached_user.id != user_id:
+        # 旁路索引未知或已過期，需要第二次往返
+        return cached_user, get_user_permissions_cache(cached_user.id, revalidate=permissions_revalidate)
+    
+    cached = values.get(permissions_key)
+    if cached is None and READ_LEGACY_KEYS:
+        cached = _get_shared(CACHE_TYPE_PERMISSIONS, permissions_key, user_id)
+    return cached_user, _finish_permissions_lookup(permissions_key, cached, permissions_revalidate, user_id)[0]
+
+def get_last_known_good_permissions(user_id):
+    """
+    SSO 不可用時獲取用戶最後一次成功獲取的權限數據（降級模式）
+    
+    參數:
+        user_id (int): 用戶ID
+        
+    返回:
+        dict or None: 權限數據，未啟用降級模式或沒有可用條目時返回None
+    """
+    permissions_data = _get_last_known_good(CACHE_TYPE_PERMISSIONS, get_permissions_cache_key(user_id))
+    if permissions_data:
+        logger.warning(f"SSO 不可用，使用最後已知有效的權限數據，用戶ID: {user_id}")
     return permissions_data
 
 def invalidate_user_cache(user_id):
@@ -277,20 +1493,28 @@ def invalidate_user_cache(user_id):
     返回:
         None
     """
-    # 刪除用戶數據緩存
-    _get_cache().delete(get_user_cache_key(user_id))
+    # 用戶令牌索引記錄了該用戶所有已緩存的令牌驗證結果
+    index_key = get_user_tokens_cache_key(user_id)
+    token_keys = list(_get_cache().get(index_key) or {})
     
-    # 刪除用戶權限緩存
-    _get_cache().delete(get_permissions_cache_key(user_id))
+    # 一次批量刪除用戶數據、權限、令牌驗證結果和索引本身
+    _get_cache().delete_many([
+        get_user_cache_key(user_id),
+        get_permissions_cache_key(user_id),
+        index_key,
+    ] + token_keys)
+    _delete_legacy(_get_legacy_cache_key(CACHE_TYPE_PERMISSIONS, user_id))
     
-    # 注意：無法直接刪除與用戶相關的令牌緩存，因為不知道令牌值
-    # 這些緩存將在過期後自動失效
+    # 刪除本進程 L1 緩存中該用戶的令牌條目，並通知其他工作進程
+    _local_token_cache.delete_where(lambda user: getattr(user, 'id', None) == user_id)
+    _local_token_user_ids.delete_where(lambda cached_id: cached_id == user_id)
+    _broadcast_invalidation(INVALIDATE_USER, user_id)
     
     logger.info(f"用戶ID: {user_id} 的緩存已失效")
 
-def invalidate_token_cache(token_value):
+def delete_token_verification_cache(token_value):
     """
-    使令牌驗證結果緩存失效
+    刪除令牌的驗證結果緩存（不影響負緩存）
     
     參數:
         token_value (str): 令牌值
@@ -300,4 +1524,40 @@ def invalidate_token_cache(token_value):
     """
     cache_key = get_token_cache_key(token_value)
     _get_cache().delete(cache_key)
+    _delete_legacy(_get_legacy_cache_key(CACHE_TYPE_TOKEN, token_value))
+    _local_token_cache.delete(cache_key)
+    _broadcast_invalidation(INVALIDATE_KEYS, [cache_key])
+
+async def adelete_token_verification_cache(token_value):
+    """delete_token_verification_cache 的異步版本"""
+    cache_key = await aget_token_cache_key(token_value)
+    await _get_cache().adelete(cache_key)
+    await _adelete_legacy(_get_legacy_cache_key(CACHE_TYPE_TOKEN, token_value))
+    _local_token_cache.delete(cache_key)
+    _broadcast_invalidation(INVALIDATE_KEYS, [cache_key])
+
+def invalidate_token_cache(token_value):
+    """
+    使令牌驗證結果緩存失效
+    
+    參數:
+        token_value (str): 令牌值
+        
+    返回:
+        None
+    """
+    delete_token_verification_cache(token_value)
+    rejection_key = get_token_rejection_cache_key(token_value)
+    _get_cache().delete(rejection_key)
+    _local_token_cache.delete(rejection_key)
+    _broadcast_invalidation(INVALIDATE_KEYS, [rejection_key])
+    logger.info(f"令牌緩存已失效")
+
+async def ainvalidate_token_cache(token_value):
+    """invalidate_token_cache 的異步版本"""
+    await adelete_token_verification_cache(token_value)
+    rejection_key = await aget_token_rejection_cache_key(token_value)
+    await _get_cache().adelete(rejection_key)
+    _local_token_cache.delete(rejection_key)
+    _broadcast_invalidation(INVALIDATE_KEYS, [rejection_key])
     logger.info(f"令牌緩存已失效")
\ No newline at end of file
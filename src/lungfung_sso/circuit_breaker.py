@@ -0,0 +1,177 @@
+# lungfung_sso/circuit_breaker.py
+"""
+SSO 服務熔斷器
+
+統計最近若干次 SSO 請求的結果，錯誤（連接錯誤、5xx、408、429）或慢請求比例超過閾值時
+打開熔斷器，在重置時間內直接快速失敗，避免工作線程全部阻塞在 SSO 請求上。
+重置時間過後進入半開狀態，只放行一個探測請求，成功則關閉，失敗則再次打開；
+打開前已經發出、之後才完成的請求不影響半開狀態的判斷。
+
+相關設置:
+    SSO_CIRCUIT_BREAKER_ENABLED (bool): 是否啟用熔斷器，默認 True
+    SSO_CIRCUIT_BREAKER_WINDOW (int): 統計窗口的請求數，默認 20
+    SSO_CIRCUIT_BREAKER_MIN_CALLS (int): 觸發熔斷前的最少請求數，默認 10
+    SSO_CIRCUIT_BREAKER_FAILURE_RATE (float): 觸發熔斷的失敗比例，默認 0.5
+    SSO_CIRCUIT_BREAKER_SLOW_CALL_THRESHOLD (float): 視為失敗的慢請求耗時（秒），默認 3
+    SSO_CIRCUIT_BREAKER_RESET_TIMEOUT (float): 打開後進入半開狀態的等待秒數，默認 30
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+# SSO 暫時無法處理請求（超時、限流）的狀態碼，與 5xx 一樣不代表令牌或請求本身無效
+TRANSIENT_STATUS_CODES = frozenset((408, 429))
+
+
+def is_service_failure(status_code):
+    """SSO 響應是否表示服務暫時不可用（5xx、408、429），而不是對請求的明確拒絕"""
+    return status_code >= 500 or status_code in TRANSIENT_STATUS_CODES
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """熔斷器打開時的快速失敗異常，可按普通連接錯誤處理"""
+
+
+class CircuitBreaker:
+    """
+    基於滑動窗口的熔斷器
+
+    參數:
+        window_size (int): 統計窗口的請求數
+        min_calls (int): 觸發熔斷前的最少請求數
+        failure_rate (float): 觸發熔斷的失敗比例
+        slow_call_threshold (float): 視為失敗的慢請求耗時（秒）
+        reset_timeout (float): 打開後進入半開狀態的等待秒數
+        on_state_change (callable, optional): 狀態變化回調，以新狀態調用
+    """
+
+    CLOSED = 'closed'
+    HALF_OPEN = 'half_open'
+    OPEN = 'open'
+
+    # allow_request 放行半開狀態的探測請求時的返回值
+    PROBE = 'probe'
+
+    def __init__(self, window_size=20, min_calls=10, failure_rate=0.5,
+                 slow_call_threshold=3, reset_timeout=30, on_state_change=None):
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_threshold = slow_call_threshold
+        self.reset_timeout = reset_timeout
+        self.on_state_change = on_state_change
+
+        self._outcomes = deque(maxlen=window_size)
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        return self._state
+
+    def _transition(self, new_state):
+        if new_state == self._state:
+            return
+        logger.warning(f"SSO 熔斷器狀態變化: {self._state} -> {new_state}")
+        self._state = new_state
+        if new_state == self.OPEN:
+            self._opened_at = time.monotonic()
+        if new_state == self.CLOSED:
+            self._outcomes.clear()
+        if self.on_state_change is not None:
+            try:
+                self.on_state_change(new_state)
+            except Exception as e:
+                logger.error(f"熔斷器狀態回調失敗: {str(e)}")
+
+    def allow_request(self):
+        """
+        是否放行請求
+
+        返回:
+            bool or str: 關閉狀態返回 True；半開狀態的探測請求返回 PROBE，
+                調用方需要把 probe=True 傳給該請求的 record；拒絕時返回 False
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._transition(self.HALF_OPEN)
+            # 半開狀態只放行一個探測請求
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return self.PROBE
+
+    def record(self, success, duration, probe=False):
+        """
+        記錄一次請求結果
+
+        只有探測請求的結果決定半開狀態關閉還是重新打開；熔斷器不在關閉狀態時，
+        其他請求（打開前已經發出的）的結果被忽略。
+
+        參數:
+            success (bool): 請求是否成功（無連接錯誤且非 5xx）
+            duration (float): 請求耗時（秒）
+            probe (bool): 是否為 allow_request 返回 PROBE 放行的探測請求
+        """
+        failed = not success or duration >= self.slow_call_threshold
+        with self._lock:
+            if probe:
+                self._probe_in_flight = False
+                if self._state == self.HALF_OPEN:
+                    self._transition(self.OPEN if failed else self.CLOSED)
+                return
+            if self._state != self.CLOSED:
+                return
+
+            self._outcomes.append(failed)
+            if (self._state == self.CLOSED
+                    and len(self._outcomes) >= self.min_calls
+                    and sum(self._outcomes) / len(self._outcomes) >= self.failure_rate):
+                self._transition(self.OPEN)
+
+
+class CircuitBreakerSession:
+    """
+    帶熔斷器的 requests Session 包裝
+
+    熔斷器打開時請求直接拋出 CircuitOpenError；其餘屬性（mount 等）透傳給原始 Session。
+    """
+
+    def __init__(self, session, breaker):
+        self._session = session
+        self.breaker = breaker
+
+    def request(self, method, url, **kwargs):
+        permit = self.breaker.allow_request()
+        if not permit:
+            raise CircuitOpenError(f"SSO 熔斷器已打開，快速失敗: {method} {url}")
+        probe = permit == CircuitBreaker.PROBE
+
+        start = time.monotonic()
+        try:
+            response = self._session.request(method, url, **kwargs)
+        except Exception:
+            self.breaker.record(False, time.monotonic() - start, probe)
+            raise
+        self.breaker.record(not is_service_failure(response.status_code), time.monotonic() - start, probe)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
@@ -0,0 +1,211 @@
+# lungfung_sso/conf.py
+"""
+編譯後的 SSO 設置快照
+
+中間件、認證、權限和緩存模組在請求熱路徑上只讀取 get_sso_config() 返回的不可變快照，
+不再逐次 getattr(settings, ...)。快照基於 configure_sso_settings 生成的 SSO_SERVICE、
+SSO_MODULES、SSO_PERMISSIONS 等設置構建，預先拼接好 SSO 接口 URL、編譯豁免路徑匹配器、
+生成子模組權限矩陣和日誌標誌。
+
+設置在運行期間被修改（例如測試中的 override_settings）時，Django 發出 setting_changed
+信號，快照隨之失效並在下次訪問時重新構建。
+"""
+import re
+from types import MappingProxyType
+
+from django.conf import settings
+from django.core.signals import setting_changed
+
+# 跳過認證的路徑前綴和精確路徑
+SKIP_PATH_PREFIXES = ('/static/', '/media/')
+LOGIN_CALLBACK_PATH = '/auth/callback/'
+SKIP_PATHS = frozenset(('/auth/login/', LOGIN_CALLBACK_PATH))
+
+# 外部系統回調 API 的默認豁免模式（子串匹配）
+DEFAULT_AUTH_EXEMPT_PATTERNS = (
+    '/api/callback/',  # 通用回調 API
+    '/api/webhooks/',  # Webhook API
+)
+
+# 本地驗證的令牌必須帶有的用戶聲明，缺少任一聲明時回退到 SSO 遠端驗證，
+# 保證本地構建的用戶對象與 SSO 驗證接口返回的一致（兩者共用同一個緩存鍵）
+DEFAULT_JWT_USER_CLAIMS = ('username', 'modules', 'permissions', 'profile')
+
+DEFAULT_PARENT_PERMISSIONS = {
+    'VIEW_SYSTEM': 'view_default_system',
+    'MANAGE_SYSTEM': 'manage_default_system',
+}
+
+DEFAULT_CHILD_PERMISSION_TYPES = {
+    'VIEW': 'view',
+    'ADD': 'add',
+    'CHANGE': 'change',
+    'DELETE': 'delete',
+}
+
+
+def format_permission(parent_module, module, action):
+    """
+    格式化權限字符串
+
+    父模組權限直接返回 action；action 已包含模組信息（如 'delete_tc_customer'）時
+    返回 module.action，否則返回 module.action_module。
+    """
+    if module == parent_module:
+        return action
+    if action.endswith(f'_{module}') or f'_{module}_' in action:
+        return f"{module}.{action}"
+    return f"{module}.{action}_{module}"
+
+
+class SSOConfig:
+    """
+    不可變的 SSO 設置快照
+
+    所有屬性在構造時計算，之後不能修改。通過 get_sso_config() 獲取當前快照。
+    """
+
+    __slots__ = (
+        'debug', 'log_level', 'detailed_logging',
+        'service_url', 'verify_ssl', 'request_timeout',
+        'token_verify_url', 'token_refresh_url', 'user_permissions_url', 'jwks_url',
+        'token_cache_ttl', 'user_cache_timeout',
+        'auth_exempt_patterns', '_exempt_matcher',
+        'cookie_domain', 'cookie_secure',
+        'proactive_refresh_window', 'proactive_refresh_cooldown', 'warm_up_on_login',
+        'connection_pool_size',
+        'local_jwt_verification', 'jwks_refresh_interval',
+        'jwt_algorithms', 'jwt_audience', 'jwt_issuer', 'jwt_leeway', 'jwt_user_claims',
+        'parent_module', 'child_modules', 'child_module_codes',
+        'parent_permissions', 'child_permission_types', 'child_permission_matrix',
+        'manage_system_permission', 'view_system_permission',
+        'manage_system_permissions', 'view_system_permissions',
+    )
+
+    def __init__(self, source=None):
+        source = settings if source is None else source
+        values = {}
+
+        def get(key, default):
+            return getattr(source, key, default)
+
+        # 日誌
+        values['debug'] = bool(get('DEBUG', False))
+        values['log_level'] = get('SSO_LOGGING_LEVEL', 'DEBUG' if values['debug'] else 'INFO')
+        values['detailed_logging'] = values['log_level'] == 'DEBUG'
+
+        # SSO 服務接口
+        service = get('SSO_SERVICE', {})
+        values['service_url'] = service.get('URL', '')
+        values['verify_ssl'] = service.get('VERIFY_SSL', True)
+        values['request_timeout'] = get('SSO_REQUEST_TIMEOUT', 5)
+        values['token_verify_url'] = f"{values['service_url']}{service.get('TOKEN_VERIFY_URL', '/api/auth/verify/')}"
+        values['token_refresh_url'] = f"{values['service_url']}{service.get('TOKEN_REFRESH_URL', '/api/auth/token/refresh/')}"
+        values['user_permissions_url'] = f"{values['service_url']}{service.get('USER_PERMISSIONS_URL', '/api/core/permissions/user/')}"
+        values['jwks_url'] = f"{values['service_url']}{service.get('JWKS_URL', '/api/auth/jwks/')}"
+
+        # 緩存
+        values['token_cache_ttl'] = get('TOKEN_VERIFICATION_CACHE_TTL', 300)
+        values['user_cache_timeout'] = get('USER_CACHE_TIMEOUT', 300)
+
+        # 中間件
+        patterns = tuple(get('SSO_AUTH_EXEMPT_PATTERNS', DEFAULT_AUTH_EXEMPT_PATTERNS))
+        values['auth_exempt_patterns'] = patterns
+        values['_exempt_matcher'] = re.compile('|'.join(map(re.escape, patterns))) if patterns else None
+        values['cookie_domain'] = 'localhost' if values['debug'] else '.lungfung.hk'
+        values['cookie_secure'] = not values['debug']
+        values['proactive_refresh_window'] = get('SSO_PROACTIVE_REFRESH_WINDOW', 60)
+        values['proactive_refresh_cooldown'] = get('SSO_PROACTIVE_REFRESH_COOLDOWN', 30)
+        values['warm_up_on_login'] = get('SSO_WARM_UP_ON_LOGIN', True)
+        values['connection_pool_size'] = get('SSO_CONNECTION_POOL_SIZE', 20)
+
+        # 本地 JWT 驗證
+        values['local_jwt_verification'] = get('SSO_LOCAL_JWT_VERIFICATION', False)
+        values['jwks_refresh_interval'] = get('SSO_JWKS_REFRESH_INTERVAL', 3600)
+        values['jwt_algorithms'] = tuple(get('SSO_JWT_ALGORITHMS', ('RS256',)))
+        values['jwt_audience'] = get('SSO_JWT_AUDIENCE', None)
+        values['jwt_issuer'] = get('SSO_JWT_ISSUER', None)
+        values['jwt_leeway'] = get('SSO_JWT_LEEWAY', 0)
+        values['jwt_user_claims'] = tuple(get('SSO_JWT_USER_CLAIMS', DEFAULT_JWT_USER_CLAIMS))
+
+        # 模組和權限
+        modules = get('SSO_MODULES', {})
+        permissions = get('SSO_PERMISSIONS', {})
+        parent_module = modules.get('PARENT_MODULE', 'DEFAULT')
+        child_modules = dict(modules.get('CHILD_MODULES', {}))
+        child_permission_types = dict(permissions.get('CHILD_PERMISSION_TYPES', DEFAULT_CHILD_PERMISSION_TYPES))
+        values['parent_module'] = parent_module
+        values['child_modules'] = MappingProxyType(child_modules)
+        values['child_module_codes'] = tuple(child_modules.values())
+        parent_permissions = dict(permissions.get('PARENT_PERMISSIONS', DEFAULT_PARENT_PERMISSIONS))
+        values['parent_permissions'] = MappingProxyType(parent_permissions)
+        values['child_permission_types'] = MappingProxyType(child_permission_types)
+        # (子模組代碼, 權限類型) -> 完整權限字符串
+        matrix = {
+            (module, action): format_permission(parent_module, module, action)
+            for module in values['child_module_codes']
+            for action in child_permission_types.values()
+        }
+        values['child_permission_matrix'] = MappingProxyType(matrix)
+
+        # 父模組系統權限及其展開後得到的子模組權限
+        view_perm = child_permission_types.get('VIEW', 'view')
+        values['manage_system_permission'] = parent_permissions.get('MANAGE_SYSTEM', 'manage_default_system')
+        values['view_system_permission'] = parent_permissions.get('VIEW_SYSTEM', 'view_default_system')
+        values['manage_system_permissions'] = frozenset(matrix.values())
+        values['view_system_permissions'] = frozenset(
+            format_permission(parent_module, module, view_perm) for module in values['child_module_codes']
+        )
+
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SSOConfig 是不可變的")
+
+    def __delattr__(self, name):
+        raise AttributeError("SSOConfig 是不可變的")
+
+    def is_skipped_path(self, path):
+        """靜態文件、登錄和登錄回調路徑跳過認證"""
+        return path.startswith(SKIP_PATH_PREFIXES) or path in SKIP_PATHS
+
+    def match_exempt_pattern(self, path):
+        """返回 path 匹配的 SSO_AUTH_EXEMPT_PATTERNS 模式，不匹配時返回 None"""
+        if self._exempt_matcher is None:
+            return None
+        match = self._exempt_matcher.search(path)
+        return match.group(0) if match else None
+
+    def format_permission(self, module, action):
+        """格式化權限字符串，子模組的標準權限類型直接查權限矩陣"""
+        permission = self.child_permission_matrix.get((module, action))
+        if permission is None:
+            permission = format_permission(self.parent_module, module, action)
+        return permission
+
+
+_config = None
+
+
+def get_sso_config():
+    """
+    獲取當前的 SSO 設置快照，首次調用時構建
+
+    返回:
+        SSOConfig: 不可變的設置快照
+    """
+    global _config
+    config = _config
+    if config is None:
+        config = _config = SSOConfig()
+    return config
+
+
+def reset_sso_config(**kwargs):
+    """使設置快照失效，下次 get_sso_config() 時重新構建"""
+    global _config
+    _config = None
+
+
+setting_changed.connect(reset_sso_config, dispatch_uid='lungfung_sso_reset_config')
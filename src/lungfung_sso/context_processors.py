@@ -0,0 +1,67 @@
+# lungfung_sso/context_processors.py
+"""
+模板上下文處理器
+
+在 TEMPLATES 的 context_processors 中加入 'lungfung_sso.context_processors.sso_permissions' 後，
+模板中可以通過 {{ sso_perms.模組.權限 }} 檢查 SSO 權限，例如:
+    {% if sso_perms.tc_sales_invoice.add %}...{% endif %}
+    {% if sso_perms.TCS.manage_taicheng_system %}...{% endif %}
+
+只有模板實際訪問到的權限才會被檢查；同一請求中的檢查共用一次權限解析（見 check_permission）。
+"""
+from .permissions import check_permission, check_permissions_many
+
+
+class SSOModulePerms:
+    """單個模組的權限，按權限名稱延遲檢查"""
+
+    def __init__(self, user, module):
+        self.user = user
+        self.module = module
+
+    def __repr__(self):
+        return f"<SSOModulePerms: {self.module}>"
+
+    def __getitem__(self, action):
+        return check_permission(self.user, self.module, action)
+
+    def __contains__(self, action):
+        return self[action]
+
+    def __iter__(self):
+        # 與 Django 的 PermLookupDict 一致，防止模板 {% for %} 無限迭代
+        raise TypeError("SSOModulePerms is not iterable.")
+
+
+class SSOPermWrapper:
+    """
+    用戶的 SSO 權限，sso_perms[模組][權限] 在訪問時才檢查
+
+    需要一次取得大量結果時使用 many()，例如在視圖中為導航菜單預先計算。
+    """
+
+    def __init__(self, user):
+        self.user = user
+
+    def __repr__(self):
+        return f"<SSOPermWrapper: {self.user!r}>"
+
+    def __getitem__(self, module):
+        return SSOModulePerms(self.user, module)
+
+    def __iter__(self):
+        raise TypeError("SSOPermWrapper is not iterable.")
+
+    def many(self, checks):
+        """批量檢查，參見 check_permissions_many"""
+        return check_permissions_many(self.user, checks)
+
+
+def sso_permissions(request):
+    """
+    向模板上下文添加 sso_perms
+
+    返回:
+        dict: {'sso_perms': SSOPermWrapper}
+    """
+    return {'sso_perms': SSOPermWrapper(getattr(request, 'user', None))}
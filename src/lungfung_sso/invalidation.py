@@ -0,0 +1,297 @@
+# lungfung_sso/invalidation.py
+"""
+跨進程緩存失效廣播
+
+進程內 L1 緩存的失效只發生在執行失效操作的工作進程中。失效總線把失效消息廣播給
+同一部署的所有工作進程，各進程收到後刪除自己 L1 中對應的條目，使較長的
+SSO_LOCAL_CACHE_TTL 在多工作進程部署中也是安全的。
+
+內置兩種後端，通過 SSO_INVALIDATION_BUS 選擇:
+    'redis': RedisInvalidationBus，基於共享緩存服務器的 Redis pub/sub，適用於多主機部署
+    'local_socket': LocalSocketInvalidationBus，基於 Unix 域數據報套接字，適用於單主機多工作進程
+也可以設置為 InvalidationBus 子類的導入路徑。未設置時不廣播。
+
+廣播是盡力而為的（至多一次）：丟失的消息由 L1 的 TTL 兜底，接收連接中斷時清空本進程 L1。
+"""
+import atexit
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    redis = None
+    REDIS_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# 失效消息類型
+INVALIDATE_KEYS = 'keys'
+INVALIDATE_USER = 'user'
+INVALIDATE_GENERATION = 'generation'
+INVALIDATE_ALL = 'all'
+
+# 每條消息最多攜帶的鍵數，保證數據報不超過 macOS 默認的 2048 字節上限
+MAX_KEYS_PER_MESSAGE = 16
+
+# 接收連接中斷後重試的等待秒數
+RECONNECT_DELAY = 1.0
+
+
+def _get_settings_value(key, default):
+    """安全地獲取 Django 設置值"""
+    try:
+        from django.conf import settings
+        return getattr(settings, key, default)
+    except Exception:
+        return default
+
+
+class InvalidationBus:
+    """
+    失效總線基類
+
+    子類實現 _send(data) 發送一條已編碼的消息，以及 _listen(dispatch) 阻塞接收消息並
+    逐條調用 dispatch(data)；_listen 拋出異常時會在 RECONNECT_DELAY 秒後重新調用。
+    """
+
+    def __init__(self):
+        # 區分消息來源，忽略本進程自己發出的消息
+        self.origin = uuid.uuid4().hex
+        self._handler = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def publish(self, kind, value=None):
+        """
+        向其他工作進程廣播失效消息，失敗時只記錄日誌
+
+        參數:
+            kind (str): 消息類型，INVALIDATE_KEYS、INVALIDATE_USER、INVALIDATE_GENERATION 或 INVALIDATE_ALL
+            value: 消息內容（鍵列表、用戶ID 或世代範圍），需可 JSON 序列化
+        """
+        if kind == INVALIDATE_KEYS:
+            chunks = [value[i:i + MAX_KEYS_PER_MESSAGE] for i in range(0, len(value), MAX_KEYS_PER_MESSAGE)]
+        else:
+            chunks = [value]
+        try:
+            for chunk in chunks:
+                self._send(json.dumps({'origin': self.origin, 'kind': kind, 'value': chunk}).encode('utf-8'))
+        except Exception as e:
+            logger.error(f"廣播緩存失效消息失敗: {str(e)}")
+
+    def start(self, handler):
+        """
+        在後台線程中接收其他進程的失效消息
+
+        參數:
+            handler (callable): 以 (kind, value) 調用
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._handler = handler
+            self._thread = threading.Thread(
+                target=self._run,
+                name='lungfung-sso-invalidation',
+                daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self._listen(self._dispatch)
+            except Exception as e:
+                logger.error(f"接收緩存失效消息失敗，{RECONNECT_DELAY}秒後重試: {str(e)}")
+            # 中斷期間可能漏掉了消息，清空本進程 L1 以免返回已失效的條目
+            self._handler(INVALIDATE_ALL, None)
+            time.sleep(RECONNECT_DELAY)
+
+    def _dispatch(self, data):
+        try:
+            message = json.loads(data)
+        except ValueError:
+            logger.warning("收到無法解析的緩存失效消息")
+            return
+        if message.get('origin') == self.origin:
+            return
+        try:
+            self._handler(message.get('kind'), message.get('value'))
+        except Exception as e:
+            logger.error(f"處理緩存失效消息失敗: {str(e)}")
+
+    def _send(self, data):
+        raise NotImplementedError
+
+    def _listen(self, dispatch):
+        raise NotImplementedError
+
+
+class RedisInvalidationBus(InvalidationBus):
+    """
+    基於 Redis pub/sub 的失效總線
+
+    默認連接 SSO 緩存（SSO_CACHE_ALIAS）所在的 Redis 服務器，
+    也可以通過 SSO_INVALIDATION_REDIS_URL 指定。需要安裝 redis。
+    """
+
+    def __init__(self, url=None, channel=None):
+        super().__init__()
+        if not REDIS_AVAILABLE:
+            raise ImportError("RedisInvalidationBus 需要安裝 redis: pip install 'lungfung-sso[redis]'")
+        from .cache import CACHE_KEY_PREFIX
+
+        self.url = url or _get_settings_value('SSO_INVALIDATION_REDIS_URL', None) or self._get_cache_location()
+        if not self.url:
+            raise ValueError("未設置 SSO_INVALIDATION_REDIS_URL，且 SSO 緩存不是 Redis 後端")
+        self.channel = channel or f"{CACHE_KEY_PREFIX}invalidation"
+        self._client = redis.Redis.from_url(self.url)
+
+    @staticmethod
+    def _get_cache_location():
+        from .cache import CACHE_ALIAS
+
+        config = _get_settings_value('CACHES', {}).get(CACHE_ALIAS, {})
+        location = config.get('LOCATION')
+        if isinstance(location, (list, tuple)):
+            location = location[0] if location else None
+        if isinstance(location, str) and location.startswith(('redis://', 'rediss://', 'unix://')):
+            return location
+        return None
+
+    def _send(self, data):
+        self._client.publish(self.channel, data)
+
+    def _listen(self, dispatch):
+        pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(self.channel)
+            for message in pubsub.listen():
+                dispatch(message['data'])
+        finally:
+            pubsub.close()
+
+
+class LocalSocketInvalidationBus(InvalidationBus):
+    """
+    基於 Unix 域數據報套接字的失效總線
+
+    每個進程在 SSO_INVALIDATION_SOCKET_DIR 目錄中綁定一個套接字，廣播時逐個發送給目錄中
+    其他進程的套接字；已退出進程遺留的套接字文件在發送失敗時刪除。只適用於單主機部署。
+    """
+
+    def __init__(self, directory=None):
+        super().__init__()
+        self.directory = directory or _get_settings_value(
+            'SSO_INVALIDATION_SOCKET_DIR',
+            os.path.join(tempfile.gettempdir(), 'lungfung-sso-invalidation')
+        )
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        self._pid = os.getpid()
+        self.path = os.path.join(self.directory, f"{self._pid}-{self.origin[:8]}.sock")
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(self.path)
+        # 接收方緩衝區已滿時不阻塞請求線程，丟棄該條消息
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sender.setblocking(False)
+        atexit.register(self.close)
+
+    def _send(self, data):
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if path == self.path or not name.endswith('.sock'):
+                continue
+            try:
+                self._sender.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # 進程已退出
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except BlockingIOError:
+                logger.warning(f"緩存失效消息接收方繁忙，已丟棄: {name}")
+
+    def _listen(self, dispatch):
+        while True:
+            dispatch(self._socket.recv(65536))
+
+    def close(self):
+        """關閉套接字並刪除套接字文件"""
+        # fork 出的子進程退出時不能刪除父進程的套接字文件
+        if self._pid == os.getpid():
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        self._socket.close()
+        self._sender.close()
+
+
+BUS_BACKENDS = {
+    'redis': RedisInvalidationBus,
+    'local_socket': LocalSocketInvalidationBus,
+}
+
+# 當前進程的失效總線；fork 後子進程重新創建（套接字、連接和監聽線程都不能跨 fork 使用）
+_bus = None
+_bus_disabled = False
+_bus_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    global _bus, _bus_disabled, _bus_lock
+    _bus = None
+    _bus_disabled = False
+    _bus_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_invalidation_bus(handler):
+    """
+    獲取當前進程的失效總線，首次調用時創建並開始接收廣播
+
+    參數:
+        handler (callable): 收到其他進程的消息時以 (kind, value) 調用
+
+    返回:
+        InvalidationBus or None: 未設置 SSO_INVALIDATION_BUS 或創建失敗時返回 None
+    """
+    global _bus, _bus_disabled
+    if _bus is not None or _bus_disabled:
+        return _bus
+
+    backend = _get_settings_value('SSO_INVALIDATION_BUS', None)
+    if not backend:
+        _bus_disabled = True
+        return None
+
+    with _bus_lock:
+        if _bus is not None or _bus_disabled:
+            return _bus
+        try:
+            bus_class = BUS_BACKENDS.get(backend)
+            if bus_class is None:
+                from django.utils.module_loading import import_string
+                bus_class = import_string(backend)
+            bus = bus_class()
+            bus.start(handler)
+        except Exception as e:
+            logger.error(f"創建緩存失效總線失敗，跨進程失效已禁用: {str(e)}")
+            _bus_disabled = True
+            return None
+        logger.info(f"緩存失效總線已啟動: {type(bus).__name__}")
+        _bus = bus
+    return _bus
@@ -0,0 +1,264 @@
+# lungfung_sso/jwt_verification.py
+"""
+本地 JWT 驗證模組
+
+在本地驗證 access token 的簽名、exp、iss 和 aud，避免每次緩存未命中時都向
+SSO 服務發送驗證請求。簽名公鑰集 (JWKS) 只從 SSO 服務獲取一次，
+之後由後台線程定期刷新。
+
+遇到未知的 kid 或令牌中缺少必要的用戶聲明時返回 None，
+由調用方回退到 SSO 遠端驗證。
+
+相關設置:
+    SSO_LOCAL_JWT_VERIFICATION (bool): 是否啟用本地驗證，默認 False
+    SSO_JWT_ALGORITHMS (list): 允許的簽名算法，默認 ['RS256']
+    SSO_JWT_ISSUER (str): 期望的 iss 聲明，None 表示不檢查
+    SSO_JWT_AUDIENCE (str): 期望的 aud 聲明，None 表示不檢查
+    SSO_JWT_LEEWAY (int): exp 驗證的時鐘偏差容忍秒數，默認 0
+    SSO_JWT_USER_CLAIMS (list): 本地驗證必須帶有的用戶聲明，
+        默認 ['username', 'modules', 'permissions', 'profile']
+    SSO_JWKS_REFRESH_INTERVAL (int): JWKS 後台刷新間隔（秒），默認 3600
+"""
+import logging
+import threading
+import time
+
+import jwt
+from asgiref.sync import sync_to_async
+from .conf import get_sso_config
+from .exceptions import TokenError, TokenExpiredError
+
+logger = logging.getLogger(__name__)
+
+# 遇到未知 kid 時觸發刷新的最小間隔（秒），避免偽造 kid 造成刷新風暴
+UNKNOWN_KID_REFRESH_COOLDOWN = 30
+
+
+def is_local_verification_enabled():
+    """是否啟用本地 JWT 驗證"""
+    return get_sso_config().local_jwt_verification
+
+
+class SigningKeyStore:
+    """
+    SSO 簽名公鑰集緩存
+
+    首次使用時同步獲取一次 JWKS，之後由守護線程按
+    SSO_JWKS_REFRESH_INTERVAL 定期刷新；遇到未知 kid 時提前喚醒刷新線程。
+    """
+
+    def __init__(self, session):
+        self._session = session
+        self._keys = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._last_refresh = 0.0
+        self._wakeup = threading.Event()
+        self._refresh_thread = None
+
+    def refresh(self):
+        """
+        從 SSO 服務獲取最新的 JWKS
+
+        返回:
+            bool: 是否刷新成功
+        """
+        self._last_refresh = time.time()
+        config = get_sso_config()
+        try:
+            response = self._session.get(
+                config.jwks_url,
+                verify=config.verify_ssl,
+                timeout=config.request_timeout
+            )
+            if response.status_code != 200:
+                logger.error(f"獲取 JWKS 失敗: HTTP {response.status_code}")
+                return False
+
+            jwk_set = jwt.PyJWKSet.from_dict(response.json())
+            keys = {}
+            for jwk in jwk_set.keys:
+                keys[jwk.key_id] = jwk
+            # 整體替換，讀取方無需加鎖
+            self._keys = keys
+            logger.info(f"JWKS 已刷新，共 {len(keys)} 個簽名公鑰")
+            return True
+        except Exception as e:
+            logger.error(f"刷新 JWKS 時發生錯誤: {str(e)}")
+            return False
+
+    @property
+    def loaded(self):
+        """是否已完成首次 JWKS 獲取"""
+        return self._loaded
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            self.refresh()
+            self._loaded = True
+            self._start_refresh_thread()
+
+    def _start_refresh_thread(self):
+        if self._refresh_thread is not None and self._refresh_thread.is_alive():
+            return
+        self._refresh_thread = threading.Thread(
+            target=self._refresh_loop,
+            name='lungfung-sso-jwks-refresh',
+            daemon=True
+        )
+        self._refresh_thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            interval = get_sso_config().jwks_refresh_interval
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+            self.refresh()
+
+    def get_key(self, kid):
+        """
+        按 kid 獲取簽名公鑰
+
+        參數:
+            kid (str): JWT 頭部中的 kid，可以為 None
+
+        返回:
+            PyJWK or None: 公鑰，未知 kid 時返回 None
+        """
+        self._ensure_loaded()
+        keys = self._keys
+
+        if kid is None:
+            # 沒有 kid 時只在公鑰唯一的情況下使用
+            return next(iter(keys.values())) if len(keys) == 1 else None
+
+        key = keys.get(kid)
+        if key is None and time.time() - self._last_refresh > UNKNOWN_KID_REFRESH_COOLDOWN:
+            logger.info(f"未知的 JWT kid: {kid}，觸發 JWKS 後台刷新")
+            self._wakeup.set()
+        return key
+
+
+_key_store = None
+_key_store_lock = threading.Lock()
+
+
+def get_signing_key_store():
+    """獲取或創建進程內共享的簽名公鑰集緩存"""
+    global _key_store
+    if _key_store is None:
+        with _key_store_lock:
+            if _key_store is None:
+                from .middleware import get_sso_session
+                _key_store = SigningKeyStore(get_sso_session())
+    return _key_store
+
+
+def _claims_to_user_data(claims):
+    """
+    將 JWT 聲明轉換為與 SSO 驗證接口相同格式的用戶數據
+
+    SimpleJWT 默認使用 user_id 聲明，這裡將其映射為 id。
+    本地驗證的用戶對象與遠端驗證結果存入同一個令牌緩存鍵，如果令牌中沒有 username
+    或缺少 SSO_JWT_USER_CLAIMS 中的任一聲明（如 permissions、modules、profile），
+    返回 None 以回退到遠端驗證，避免緩存字段不完整的用戶對象。
+    """
+    if not claims.get('username'):
+        return None
+    missing = [claim for claim in get_sso_config().jwt_user_claims if claim not in claims]
+    if missing:
+        logger.debug(f"令牌缺少用戶聲明: {', '.join(missing)}")
+        return None
+
+    user_data = dict(claims)
+    if user_data.get('id') is None:
+        user_data['id'] = claims.get('user_id')
+    return user_data
+
+
+def get_unverified_expiry(token_value):
+    """
+    讀取令牌的 exp 聲明（不驗證簽名）
+
+    參數:
+        token_value (str): 令牌值
+
+    返回:
+        int or None: exp 時間戳，無法解析時返回 None
+    """
+    try:
+        claims = jwt.decode(token_value, options={'verify_signature': False})
+    except jwt.InvalidTokenError:
+        return None
+    expiry = claims.get('exp')
+    return expiry if isinstance(expiry, (int, float)) else None
+
+
+def verify_token_locally(token_value):
+    """
+    在本地驗證 access token
+
+    參數:
+        token_value (str): 令牌值
+
+    返回:
+        dict or None: 用戶數據；未啟用本地驗證、未知 kid 或聲明不足時返回 None
+
+    可能引發的異常:
+        TokenExpiredError: 令牌已過期時
+        TokenError: 令牌簽名或聲明無效時
+    """
+    if not is_local_verification_enabled():
+        return None
+
+    try:
+        header = jwt.get_unverified_header(token_value)
+    except jwt.InvalidTokenError as e:
+        logger.warning(f"無法解析 JWT 頭部: {str(e)}")
+        raise TokenError()
+
+    jwk = get_signing_key_store().get_key(header.get('kid'))
+    if jwk is None:
+        logger.debug("沒有可用的簽名公鑰，回退到 SSO 遠端驗證")
+        return None
+
+    config = get_sso_config()
+    try:
+        claims = jwt.decode(
+            token_value,
+            jwk.key,
+            algorithms=config.jwt_algorithms,
+            audience=config.jwt_audience,
+            issuer=config.jwt_issuer,
+            leeway=config.jwt_leeway,
+            options={'require': ['exp'], 'verify_aud': config.jwt_audience is not None}
+        )
+    except jwt.ExpiredSignatureError:
+        logger.debug("本地驗證：令牌已過期")
+        raise TokenExpiredError()
+    except jwt.InvalidTokenError as e:
+        logger.warning(f"本地驗證：令牌無效: {str(e)}")
+        raise TokenError()
+
+    user_data = _claims_to_user_data(claims)
+    if user_data is None:
+        logger.debug("令牌缺少用戶聲明，回退到 SSO 遠端驗證")
+    return user_data
+
+
+async def averify_token_locally(token_value):
+    """
+    verify_token_locally 的異步版本
+
+    簽名公鑰已加載時驗證只涉及 CPU 計算，直接在事件循環中執行；
+    首次獲取 JWKS 需要網絡請求，放到線程池中執行。
+    """
+    if not is_local_verification_enabled():
+        return None
+    if not get_signing_key_store().loaded:
+        return await sync_to_async(verify_token_locally, thread_sensitive=False)(token_value)
+    return verify_token_locally(token_value)
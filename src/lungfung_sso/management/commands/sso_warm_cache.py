@@ -0,0 +1,71 @@
+# lungfung_sso/management/commands/sso_warm_cache.py
+"""
+預熱 SSO 權限緩存
+
+部署或清空緩存後運行，為最近活躍的用戶預取權限數據，避免他們的第一個請求同步請求 SSO。
+
+使用示例:
+    python manage.py sso_warm_cache 1 2 3
+    python manage.py sso_warm_cache --file active_users.txt --concurrency 8
+    some-query | python manage.py sso_warm_cache --file -
+"""
+import os
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from lungfung_sso.warmup import DEFAULT_CONCURRENCY, warm_up_permissions
+
+
+class Command(BaseCommand):
+    help = '為指定用戶預取 SSO 權限數據並存入緩存'
+
+    def add_arguments(self, parser):
+        parser.add_argument('user_ids', nargs='*', help='用戶ID')
+        parser.add_argument(
+            '--file',
+            help='用戶ID列表文件，每行一個；"-" 表示從標準輸入讀取'
+        )
+        parser.add_argument(
+            '--token',
+            help='請求 SSO 使用的服務令牌，默認為 SSO_WARM_UP_TOKEN 設置或環境變量'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=DEFAULT_CONCURRENCY,
+            help=f'同時請求 SSO 的最大數量（默認 {DEFAULT_CONCURRENCY}）'
+        )
+
+    def handle(self, *args, **options):
+        user_ids = list(options['user_ids'])
+        if options['file']:
+            user_ids.extend(self._read_user_ids(options['file']))
+        if not user_ids:
+            raise CommandError('請提供用戶ID或 --file')
+
+        token = (
+            options['token']
+            or getattr(settings, 'SSO_WARM_UP_TOKEN', None)
+            or os.environ.get('SSO_WARM_UP_TOKEN')
+        )
+        if not token:
+            raise CommandError('請通過 --token 或 SSO_WARM_UP_TOKEN 提供服務令牌')
+
+        succeeded, failed = warm_up_permissions(user_ids, token, options['concurrency'])
+
+        self.stdout.write(self.style.SUCCESS(f'已預熱 {len(succeeded)} 個用戶的權限緩存'))
+        if failed:
+            self.stderr.write(f'{len(failed)} 個用戶預熱失敗: {", ".join(map(str, failed))}')
+
+    def _read_user_ids(self, path):
+        try:
+            if path == '-':
+                lines = sys.stdin.read().splitlines()
+            else:
+                with open(path, encoding='utf-8') as f:
+                    lines = f.read().splitlines()
+        except OSError as e:
+            raise CommandError(f'無法讀取用戶ID文件: {e}')
+        return [line.strip() for line in lines if line.strip() and not line.startswith('#')]
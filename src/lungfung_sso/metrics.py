@@ -0,0 +1,99 @@
+# lungfung_sso/metrics.py
+"""
+SSO 緩存監控指標
+
+安裝 prometheus_client 時導出 Prometheus 指標，未安裝時使用空操作的模擬對象，
+調用方無需判斷。所有緩存指標均以緩存類型（cache_type，即 CACHE_TYPE_*）為標籤。
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 緩存讀寫耗時的分桶（秒），覆蓋進程內命中到遠程緩存超時
+CACHE_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# 緩存條目序列化後大小的分桶（字節）
+CACHE_PAYLOAD_BUCKETS = (128, 256, 512, 1024, 2048, 4096, 8192, 16384, 65536, 262144)
+
+try:
+    from prometheus_client import Counter, Histogram
+
+    cache_hits = Counter(
+        'simple_docking_sso_cache_hits_total',
+        'SSO cache hits',
+        ['cache_type', 'tier']
+    )
+
+    cache_misses = Counter(
+        'simple_docking_sso_cache_misses_total',
+        'SSO cache misses',
+        ['cache_type']
+    )
+
+    cache_sets = Counter(
+        'simple_docking_sso_cache_sets_total',
+        'SSO cache writes',
+        ['cache_type']
+    )
+
+    cache_errors = Counter(
+        'simple_docking_sso_cache_errors_total',
+        'SSO cache backend errors',
+        ['cache_type', 'operation']
+    )
+
+    cache_evictions = Counter(
+        'simple_docking_sso_cache_evictions_total',
+        'SSO in-process cache LRU evictions',
+        ['cache_type']
+    )
+
+    cache_latency = Histogram(
+        'simple_docking_sso_cache_latency_seconds',
+        'SSO shared cache operation latency',
+        ['cache_type', 'operation'],
+        buckets=CACHE_LATENCY_BUCKETS
+    )
+
+    cache_payload_size = Histogram(
+        'simple_docking_sso_cache_payload_bytes',
+        'Pickled size of SSO cache entries',
+        ['cache_type'],
+        buckets=CACHE_PAYLOAD_BUCKETS
+    )
+
+    PROMETHEUS_AVAILABLE = True
+except ImportError:
+    # 創建模擬的監控對象
+    class MockMetric:
+        def inc(self, *args, **kwargs):
+            pass
+
+        def labels(self, *args, **kwargs):
+            return self
+
+        def observe(self, *args, **kwargs):
+            pass
+
+        def set(self, *args, **kwargs):
+            pass
+
+        def time(self):
+            return MockContextManager()
+
+    class MockContextManager:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+    cache_hits = MockMetric()
+    cache_misses = MockMetric()
+    cache_sets = MockMetric()
+    cache_errors = MockMetric()
+    cache_evictions = MockMetric()
+    cache_latency = MockMetric()
+    cache_payload_size = MockMetric()
+
+    PROMETHEUS_AVAILABLE = False
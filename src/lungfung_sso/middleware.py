@@ -8,8 +8,27 @@ from django.contrib.auth.models import AnonymousUser
 from django.contrib import messages
 from .exceptions import TokenError, TokenExpiredError, PermissionDeniedError
 from .models import User  # 導入統一的 User 類
-from .cache import get_token_verification_cache, set_token_verification_cache, invalidate_token_cache
+from .cache import (
+    get_token_verification_cache, set_token_verification_cache,
+    delete_token_verification_cache, adelete_token_verification_cache, get_last_known_good_user,
+    get_token_rejection_cache, set_token_rejection_cache,
+    aget_token_verification_cache, aset_token_verification_cache,
+    aget_last_known_good_user, aget_token_rejection_cache, aset_token_rejection_cache,
+    acquire_refresh_lock, release_refresh_lock, get_refresh_state, set_refresh_result, set_refresh_failure,
+    aacquire_refresh_lock, arelease_refresh_lock, aget_refresh_state, aset_refresh_result, aset_refresh_failure,
+    REFRESH_LOCK_TIMEOUT,
+    REJECTION_EXPIRED, REJECTION_INVALID, REJECTION_REFRESH_COOLDOWN, REJECTION_REFRESH_FAILED,
+)
+from .conf import LOGIN_CALLBACK_PATH, get_sso_config
+from .permission_set import drop_permission_memo
+from .jwt_verification import verify_token_locally, averify_token_locally, get_unverified_expiry
+from .singleflight import SingleFlight, AsyncSingleFlight
+from .circuit_breaker import CircuitBreaker, CircuitBreakerSession, CircuitOpenError, is_service_failure
 
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+import asyncio
+import copy
 import requests
 import time
 import logging
@@ -25,10 +44,26 @@ def get_cookie_domain():
     Returns:
         str: cookie domain 值
     """
-    if getattr(settings, 'DEBUG', False):
-        return 'localhost'
+    return get_sso_config().cookie_domain
+
+
+def _parse_refresh_response(refresh_response):
+    """解析 SSO 刷新接口的響應，返回 (new_access_token, error_message)"""
+    if refresh_response.status_code == 200:
+        data = refresh_response.json()
+        new_access_token = data.get('access')
+        if new_access_token:
+            logger.info("Access token 刷新成功")
+            return new_access_token, None
+        else:
+            logger.error("刷新響應中沒有 access token")
+            return None, "刷新響應中沒有 access token"
+    elif refresh_response.status_code == 401:
+        logger.warning("Refresh token 已過期或無效")
+        return None, "refresh_token_expired"
     else:
-        return '.lungfung.hk'
+        logger.error(f"Token 刷新失敗: HTTP {refresh_response.status_code}")
+        return None, f"刷新失敗: HTTP {refresh_response.status_code}"
 
 
 def refresh_access_token(refresh_token, sso_session):
@@ -43,33 +78,48 @@ def refresh_access_token(refresh_token, sso_session):
         tuple: (new_access_token, error_message) - 成功時返回新 token，失敗時返回 None 和錯誤信息
     """
     try:
-        sso_refresh_url = f"{settings.SSO_SERVICE['URL']}{settings.SSO_SERVICE.get('TOKEN_REFRESH_URL', '/api/auth/token/refresh/')}"
-        request_timeout = getattr(settings, 'SSO_REQUEST_TIMEOUT', 5)
+        config = get_sso_config()
         
-        logger.info(f"嘗試刷新 access token，SSO URL: {sso_refresh_url}")
+        logger.info(f"嘗試刷新 access token，SSO URL: {config.token_refresh_url}")
         
         refresh_response = sso_session.post(
-            sso_refresh_url,
+            config.token_refresh_url,
             json={'refresh': refresh_token},
-            verify=settings.SSO_SERVICE['VERIFY_SSL'],
-            timeout=request_timeout
+            verify=config.verify_ssl,
+            timeout=config.request_timeout
         )
+        return _parse_refresh_response(refresh_response)
+            
+    except requests.RequestException as e:
+        logger.error(f"Token 刷新時連接錯誤: {str(e)}")
+        return None, f"連接錯誤: {str(e)}"
+    except Exception as e:
+        logger.error(f"Token 刷新時發生意外錯誤: {str(e)}", exc_info=True)
+        return None, f"意外錯誤: {str(e)}"
+
+
+async def arefresh_access_token(refresh_token, sso_client):
+    """
+    refresh_access_token 的異步版本
+    
+    Args:
+        refresh_token: JWT refresh token
+        sso_client: AsyncSSOClient 對象
         
-        if refresh_response.status_code == 200:
-            data = refresh_response.json()
-            new_access_token = data.get('access')
-            if new_access_token:
-                logger.info("Access token 刷新成功")
-                return new_access_token, None
-            else:
-                logger.error("刷新響應中沒有 access token")
-                return None, "刷新響應中沒有 access token"
-        elif refresh_response.status_code == 401:
-            logger.warning("Refresh token 已過期或無效")
-            return None, "refresh_token_expired"
-        else:
-            logger.error(f"Token 刷新失敗: HTTP {refresh_response.status_code}")
-            return None, f"刷新失敗: HTTP {refresh_response.status_code}"
+    Returns:
+        tuple: (new_access_token, error_message)
+    """
+    try:
+        config = get_sso_config()
+        
+        logger.info(f"嘗試刷新 access token，SSO URL: {config.token_refresh_url}")
+        
+        refresh_response = await sso_client.post(
+            config.token_refresh_url,
+            json={'refresh': refresh_token},
+            timeout=config.request_timeout
+        )
+        return _parse_refresh_response(refresh_response)
             
     except requests.RequestException as e:
         logger.error(f"Token 刷新時連接錯誤: {str(e)}")
@@ -78,9 +128,135 @@ def refresh_access_token(refresh_token, sso_session):
         logger.error(f"Token 刷新時發生意外錯誤: {str(e)}", exc_info=True)
         return None, f"意外錯誤: {str(e)}"
 
+# 等待其他工作進程完成刷新時的輪詢間隔（秒）
+REFRESH_WAIT_INTERVAL = 0.05
+
+# 按 refresh token 合併並發的刷新請求
+token_refresh_flight = SingleFlight()
+async_token_refresh_flight = AsyncSingleFlight()
+
+
+def _get_refresh_wait_timeout():
+    """
+    等待其他工作進程刷新結果的最長時間
+    
+    持有刷新鎖的進程最多在 SSO_REQUEST_TIMEOUT 秒內得到結果（成功或失敗都會寫入結果槽），
+    等待更久沒有意義；同時不超過刷新鎖本身的超時時間。
+    """
+    return min(REFRESH_LOCK_TIMEOUT, get_sso_config().request_timeout + REFRESH_WAIT_INTERVAL)
+
+
+def coalesced_refresh_access_token(refresh_token, sso_session):
+    """
+    合併並發刷新的 refresh_access_token
+    
+    同一 refresh token 在進程內只有一個線程發起刷新；跨工作進程通過共享緩存中的
+    刷新鎖保證只有一個進程請求 SSO，其他請求等待並直接使用寫入結果槽的新 access token。
+    刷新失敗時錯誤信息同樣寫入結果槽（保留 SSO_REFRESH_FAILURE_TTL 秒），等待方立即得到
+    同一錯誤；refresh token 被 SSO 拒絕時另外記錄負緩存。
+    
+    Args:
+        refresh_token: JWT refresh token
+        sso_session: requests Session 對象
+        
+    Returns:
+        tuple: (new_access_token, error_message)，格式同 refresh_access_token
+    """
+    return token_refresh_flight.do(refresh_token, _refresh_once, refresh_token, sso_session)
+
+
+def _refresh_once(refresh_token, sso_session):
+    new_access_token, refresh_error, locked = get_refresh_state(refresh_token)
+    if new_access_token:
+        logger.info("使用並發請求剛刷新的 access token")
+        return new_access_token, None
+    if refresh_error:
+        logger.warning(f"並發請求剛刷新失敗，直接返回: {refresh_error}")
+        return None, refresh_error
+    
+    acquired = acquire_refresh_lock(refresh_token)
+    if not acquired:
+        logger.debug("其他工作進程正在刷新 token，等待結果")
+        deadline = time.monotonic() + _get_refresh_wait_timeout()
+        while time.monotonic() < deadline:
+            time.sleep(REFRESH_WAIT_INTERVAL)
+            new_access_token, refresh_error, locked = get_refresh_state(refresh_token)
+            if new_access_token or refresh_error or not locked:
+                break
+        if new_access_token:
+            logger.info("使用其他工作進程刷新的 access token")
+            return new_access_token, None
+        if refresh_error:
+            logger.warning(f"其他工作進程刷新失敗: {refresh_error}")
+            return None, refresh_error
+        if get_token_rejection_cache(refresh_token) == REJECTION_REFRESH_FAILED:
+            return None, "refresh_token_expired"
+        logger.warning("未等到其他工作進程的刷新結果，自行刷新")
+    
+    try:
+        new_access_token, refresh_error = refresh_access_token(refresh_token, sso_session)
+        if new_access_token:
+            set_refresh_result(refresh_token, new_access_token)
+        else:
+            # 失敗也寫入結果槽，等待中的請求立即返回而不是各自超時後重試
+            set_refresh_failure(refresh_token, refresh_error)
+            if refresh_error == "refresh_token_expired":
+                set_token_rejection_cache(refresh_token, REJECTION_REFRESH_FAILED)
+        return new_access_token, refresh_error
+    finally:
+        if acquired:
+            release_refresh_lock(refresh_token)
+
+
+async def acoalesced_refresh_access_token(refresh_token, sso_client):
+    """coalesced_refresh_access_token 的異步版本"""
+    return await async_token_refresh_flight.do(refresh_token, _arefresh_once, refresh_token, sso_client)
+
+
+async def _arefresh_once(refresh_token, sso_client):
+    new_access_token, refresh_error, locked = await aget_refresh_state(refresh_token)
+    if new_access_token:
+        logger.info("使用並發請求剛刷新的 access token")
+        return new_access_token, None
+    if refresh_error:
+        logger.warning(f"並發請求剛刷新失敗，直接返回: {refresh_error}")
+        return None, refresh_error
+    
+    acquired = await aacquire_refresh_lock(refresh_token)
+    if not acquired:
+        logger.debug("其他工作進程正在刷新 token，等待結果")
+        deadline = time.monotonic() + _get_refresh_wait_timeout()
+        while time.monotonic() < deadline:
+            await asyncio.sleep(REFRESH_WAIT_INTERVAL)
+            new_access_token, refresh_error, locked = await aget_refresh_state(refresh_token)
+            if new_access_token or refresh_error or not locked:
+                break
+        if new_access_token:
+            logger.info("使用其他工作進程刷新的 access token")
+            return new_access_token, None
+        if refresh_error:
+            logger.warning(f"其他工作進程刷新失敗: {refresh_error}")
+            return None, refresh_error
+        if await aget_token_rejection_cache(refresh_token) == REJECTION_REFRESH_FAILED:
+            return None, "refresh_token_expired"
+        logger.warning("未等到其他工作進程的刷新結果，自行刷新")
+    
+    try:
+        new_access_token, refresh_error = await arefresh_access_token(refresh_token, sso_client)
+        if new_access_token:
+            await aset_refresh_result(refresh_token, new_access_token)
+        else:
+            await aset_refresh_failure(refresh_token, refresh_error)
+            if refresh_error == "refresh_token_expired":
+                await aset_token_rejection_cache(refresh_token, REJECTION_REFRESH_FAILED)
+        return new_access_token, refresh_error
+    finally:
+        if acquired:
+            await arelease_refresh_lock(refresh_token)
+
 # 嘗試導入 prometheus_client，如果不可用則使用模擬對象
 try:
-    from prometheus_client import Counter, Histogram
+    from prometheus_client import Counter, Gauge, Histogram
     
     # 添加監控指標
     auth_requests = Counter(
@@ -94,31 +270,26 @@ try:
         'Auth request latency'
     )
     
+    sso_circuit_state = Gauge(
+        'simple_docking_sso_circuit_state',
+        'SSO circuit breaker state (0=closed, 1=half_open, 2=open)'
+    )
+    
+    sso_circuit_transitions = Counter(
+        'simple_docking_sso_circuit_transitions_total',
+        'SSO circuit breaker state transitions',
+        ['state']
+    )
+    
     PROMETHEUS_AVAILABLE = True
 except ImportError:
     # 創建模擬的監控對象
-    class MockMetric:
-        def inc(self, *args, **kwargs):
-            pass
-        
-        def labels(self, *args, **kwargs):
-            return self
-        
-        def observe(self, *args, **kwargs):
-            pass
-        
-        def time(self):
-            return MockContextManager()
-    
-    class MockContextManager:
-        def __enter__(self):
-            return self
-        
-        def __exit__(self, *args):
-            pass
+    from .metrics import MockMetric, MockContextManager
     
     auth_requests = MockMetric()
     auth_latency = MockMetric()
+    sso_circuit_state = MockMetric()
+    sso_circuit_transitions = MockMetric()
     
     PROMETHEUS_AVAILABLE = False
     logger.warning("prometheus_client not available, monitoring metrics disabled")
@@ -126,8 +297,30 @@ except ImportError:
 # 創建SSO服務的請求會話
 sso_session = None
 
+# 按 token 合併並發的 SSO 驗證請求
+token_verification_flight = SingleFlight()
+async_token_verification_flight = AsyncSingleFlight()
+
+_CIRCUIT_STATE_VALUES = {
+    CircuitBreaker.CLOSED: 0,
+    CircuitBreaker.HALF_OPEN: 1,
+    CircuitBreaker.OPEN: 2,
+}
+
+
+def _record_circuit_state(state):
+    """將熔斷器狀態寫入監控指標"""
+    sso_circuit_state.set(_CIRCUIT_STATE_VALUES[state])
+    sso_circuit_transitions.labels(state=state).inc()
+
+
 def get_sso_session():
-    """獲取或創建SSO服務的請求會話"""
+    """
+    獲取或創建SSO服務的請求會話
+    
+    啟用 SSO_CIRCUIT_BREAKER_ENABLED（默認）時返回帶熔斷器的會話，
+    熔斷器打開期間請求會立即拋出 CircuitOpenError（requests.ConnectionError 子類）。
+    """
     global sso_session
     if sso_session is None:
         # 創建會話並配置連接池
@@ -146,14 +339,40 @@ def get_sso_session():
         sso_session.mount('https://', adapter)
         
         logger.info(f"已創建SSO服務的請求會話：連接池大小={pool_maxsize}，最大重試次數={max_retries}")
+        
+        if getattr(settings, 'SSO_CIRCUIT_BREAKER_ENABLED', True):
+            breaker = CircuitBreaker(
+                window_size=getattr(settings, 'SSO_CIRCUIT_BREAKER_WINDOW', 20),
+                min_calls=getattr(settings, 'SSO_CIRCUIT_BREAKER_MIN_CALLS', 10),
+                failure_rate=getattr(settings, 'SSO_CIRCUIT_BREAKER_FAILURE_RATE', 0.5),
+                slow_call_threshold=getattr(settings, 'SSO_CIRCUIT_BREAKER_SLOW_CALL_THRESHOLD', 3),
+                reset_timeout=getattr(settings, 'SSO_CIRCUIT_BREAKER_RESET_TIMEOUT', 30),
+                on_state_change=_record_circuit_state
+            )
+            sso_session = CircuitBreakerSession(sso_session, breaker)
+            logger.info("已為SSO服務的請求會話啟用熔斷器")
     
     return sso_session
 
 class JWTAuthenticationMiddleware:
+    """
+    SSO JWT 認證中間件
+    
+    同時支持 WSGI 和 ASGI：get_response 為協程函數時以原生異步方式運行，
+    SSO 驗證和刷新請求通過異步客戶端發送，不佔用線程池。
+    """
+    sync_capable = True
+    async_capable = True
+    
     def __init__(self, get_response):
         self.get_response = get_response
         # 初始化時獲取SSO會話，只需創建一次
         self.sso_session = get_sso_session()
+        self._async_mode = iscoroutinefunction(get_response)
+        if self._async_mode:
+            from .async_client import get_async_sso_client
+            self.async_client = get_async_sso_client()
+            markcoroutinefunction(self)
         
     def _set_token_cookie(self, response, token_value):
         """
@@ -166,8 +385,9 @@ class JWTAuthenticationMiddleware:
         Returns:
             HttpResponse: 更新後的 response 對象
         """
-        cookie_domain = get_cookie_domain()
-        secure = not getattr(settings, 'DEBUG', False)
+        config = get_sso_config()
+        cookie_domain = config.cookie_domain
+        secure = config.cookie_secure
         
         response.set_cookie(
             'auth_access_token',
@@ -179,46 +399,223 @@ class JWTAuthenticationMiddleware:
             max_age=3600  # 1小時
         )
         return response
+    
+    def _get_rejection_result(self, rejection):
+        """負緩存命中時返回與原始驗證結果等價的 (status_code, user_data, detail)"""
+        status_code = 401 if rejection == REJECTION_EXPIRED else 400
+        return status_code, None, f"負緩存命中: {rejection}"
+    
+    def _get_rejection_reason(self, status_code):
+        """
+        返回應記錄的負緩存原因
         
-    def __call__(self, request):
-        start_time = time.time()
+        只緩存 SSO 對令牌的明確拒絕 (400/401/403)；服務端錯誤 (5xx)、超時 (408)、
+        限流 (429) 等與令牌本身無關的響應不緩存。
+        """
+        if status_code == 401:
+            return REJECTION_EXPIRED
+        if status_code in (400, 403):
+            return REJECTION_INVALID
+        return None
+    
+    def _verify_token(self, token_value, detailed_logging=False):
+        """
+        驗證 access token
         
-        # 獲取日誌級別
-        log_level = getattr(settings, 'SSO_LOGGING_LEVEL', 'DEBUG' if settings.DEBUG else 'INFO')
-        detailed_logging = log_level == 'DEBUG'
+        最近被 SSO 拒絕的 token 直接使用負緩存結果。
+        啟用 SSO_LOCAL_JWT_VERIFICATION 時優先在本地驗證簽名和聲明，
+        只有未知 kid 或聲明不足時才回退到 SSO 遠端驗證。
         
-        # 如果是詳細日誌模式，記錄請求信息
+        Args:
+            token_value: access token
+            detailed_logging: 是否記錄詳細日誌
+            
+        Returns:
+            tuple: (status_code, user_data, detail) - 200 時 user_data 為用戶數據，
+                   否則 detail 為錯誤描述
+        """
+        rejection = get_token_rejection_cache(token_value)
+        if rejection is not None:
+            return self._get_rejection_result(rejection)
+        
+        try:
+            user_data = verify_token_locally(token_value)
+        except TokenError as e:
+            # TokenExpiredError 也在此處理，與 SSO 服務一致返回 401
+            return 401, None, e.message
+        
+        if user_data is not None:
+            logger.debug("Token 已通過本地簽名驗證")
+            return 200, user_data, 'local'
+        
+        # 同一 token 的並發驗證只向 SSO 發送一次請求，其他線程共享結果
+        status_code, user_data, detail = token_verification_flight.do(
+            token_value, self._verify_token_remote, token_value, detailed_logging
+        )
+        
+        reason = self._get_rejection_reason(status_code)
+        if reason is not None:
+            set_token_rejection_cache(token_value, reason)
+        
+        return status_code, user_data, detail
+    
+    async def _averify_token(self, token_value, detailed_logging=False):
+        """_verify_token 的異步版本，返回值相同"""
+        rejection = await aget_token_rejection_cache(token_value)
+        if rejection is not None:
+            return self._get_rejection_result(rejection)
+        
+        try:
+            user_data = await averify_token_locally(token_value)
+        except TokenError as e:
+            return 401, None, e.message
+        
+        if user_data is not None:
+            logger.debug("Token 已通過本地簽名驗證")
+            return 200, user_data, 'local'
+        
+        # 同一事件循環中同一 token 的並發驗證只向 SSO 發送一次請求
+        status_code, user_data, detail = await async_token_verification_flight.do(
+            token_value, self._averify_token_remote, token_value, detailed_logging
+        )
+        
+        reason = self._get_rejection_reason(status_code)
+        if reason is not None:
+            await aset_token_rejection_cache(token_value, reason)
+        
+        return status_code, user_data, detail
+    
+    def _serve_degraded(self, request, user):
+        """
+        SSO 不可用時以最後已知有效的用戶繼續處理請求（降級模式）
+        
+        Args:
+            request: HttpRequest 對象
+            user: 最後已知有效的用戶對象
+        """
+        logger.warning(f"SSO 不可用，以降級模式處理請求，用戶: {user.username}")
+        request.user = user
+        auth_requests.labels(status='degraded').inc()
+    
+    def _revalidate_token(self, token_value):
+        """
+        後台重新驗證已軟過期的 token 緩存
+        
+        驗證成功時刷新緩存；SSO 明確拒絕時刪除舊的驗證結果。
+        連接錯誤、服務端錯誤、超時或限流時保留舊值，直到硬過期。
+        異步模式下同樣在後台線程池中執行。
+        
+        Args:
+            token_value: access token
+        """
+        status_code, user_data, verify_detail = self._verify_token(token_value)
+        
+        if status_code == 200:
+            user = self._build_user(user_data, token_value)
+            set_token_verification_cache(token_value, user, self._get_token_cache_ttl())
+            logger.debug(f"後台重新驗證成功，用戶: {user.username}")
+        elif not is_service_failure(status_code):
+            delete_token_verification_cache(token_value)
+            logger.info(f"後台重新驗證發現 token 已失效: HTTP {status_code}")
+        else:
+            logger.warning(f"後台重新驗證失敗，保留舊緩存: HTTP {status_code}")
+    
+    def _get_verify_url(self):
+        # 添加更詳細的日誌，記錄 SSO 服務 URL
+        sso_verify_url = get_sso_config().token_verify_url
+        logger.debug(f"即將連接 SSO 服務 URL: {sso_verify_url}")
+        return sso_verify_url
+    
+    def _parse_verify_response(self, verify_response, detailed_logging):
+        logger.debug(f"SSO 響應狀態: {verify_response.status_code}")
         if detailed_logging:
+            logger.debug(f"SSO 響應內容: {verify_response.text}")
+        
+        if verify_response.status_code == 200:
+            return 200, verify_response.json(), 'remote'
+        return verify_response.status_code, None, verify_response.text
+    
+    def _verify_token_remote(self, token_value, detailed_logging=False):
+        """
+        向 SSO 服務發送 token 驗證請求
+        
+        Args:
+            token_value: access token
+            detailed_logging: 是否記錄詳細日誌
+            
+        Returns:
+            tuple: (status_code, user_data, detail)，格式同 _verify_token
+        """
+        config = get_sso_config()
+        verify_response = self.sso_session.post(
+            self._get_verify_url(),
+            json={'token': token_value},
+            verify=config.verify_ssl,
+            timeout=config.request_timeout
+        )
+        return self._parse_verify_response(verify_response, detailed_logging)
+    
+    async def _averify_token_remote(self, token_value, detailed_logging=False):
+        """_verify_token_remote 的異步版本"""
+        verify_response = await self.async_client.post(
+            self._get_verify_url(),
+            json={'token': token_value},
+            timeout=get_sso_config().request_timeout
+        )
+        return self._parse_verify_response(verify_response, detailed_logging)
+    
+    def _get_token_cache_ttl(self):
+        return get_sso_config().token_cache_ttl
+    
+    def _build_user(self, user_data, token_value):
+        """創建用戶對象，並保存 token 以便後續權限檢查使用"""
+        user = User(user_data)
+        user.token = token_value
+        return user
+    
+    def _login_redirect(self, request, message):
+        """非 API 請求重定向到 SSO 登錄頁面，API 請求返回 None"""
+        if request.path.startswith('/api/'):
+            return None
+        next_url = quote(request.get_full_path())
+        redirect_url = f"{get_sso_config().service_url}?next={next_url}"
+        logger.info(f"{message}: {redirect_url}")
+        return redirect(redirect_url)
+    
+    def _is_detailed_logging(self):
+        return get_sso_config().detailed_logging
+    
+    def _prepare(self, request):
+        """
+        記錄請求並從 cookie 或 header 中獲取 token
+        
+        Returns:
+            tuple: (skip, token) - skip 為 True 時跳過認證
+        """
+        config = get_sso_config()
+        
+        # 如果是詳細日誌模式，記錄請求信息
+        if config.detailed_logging:
             logger.debug(f"處理請求: {request.method} {request.path}")
             logger.debug(f"請求頭: {dict(request.headers)}")
             logger.debug(f"Cookies: {request.COOKIES}")
         else:
             logger.info(f"處理請求: {request.method} {request.path}")
         
-        # 檢查是否是靜態文件請求
-        if request.path.startswith('/static/') or request.path.startswith('/media/'):
-            logger.debug("靜態文件請求，跳過認證")
-            return self.get_response(request)
-            
-        # 檢查是否是登入或注銷請求
-        if request.path in ['/auth/login/', '/auth/callback/']:
-            logger.debug(f"認證相關路徑 {request.path}，跳過認證")
-            return self.get_response(request)
+        # 靜態文件、登入和登入回調請求
+        if config.is_skipped_path(request.path):
+            logger.debug(f"靜態文件或認證相關路徑 {request.path}，跳過認證")
+            return True, None
         
         # 檢查是否是外部系統回調 API（不需要認證，使用簽名驗證）
         # 這些 API 通常用於接收來自其他系統的回調（如審批中心 APS）
-        auth_exempt_patterns = getattr(settings, 'SSO_AUTH_EXEMPT_PATTERNS', [
-            '/api/callback/',  # 通用回調 API
-            '/api/webhooks/',  # Webhook API
-        ])
-        for pattern in auth_exempt_patterns:
-            if pattern in request.path:
-                logger.debug(f"外部回調請求 {request.path}（匹配 {pattern}），跳過認證")
-                return self.get_response(request)
-        
-        # 從 cookie 或 header 中獲取 tokens
+        pattern = config.match_exempt_pattern(request.path)
+        if pattern is not None:
+            logger.debug(f"外部回調請求 {request.path}（匹配 {pattern}），跳過認證")
+            return True, None
+        
+        # 從 cookie 或 header 中獲取 token，refresh token 在需要刷新時再讀取
         access_token = request.COOKIES.get('auth_access_token')
-        refresh_token = request.COOKIES.get('auth_refresh_token')
         
         # 也檢查 Authorization header
         token = access_token
@@ -228,221 +625,511 @@ class JWTAuthenticationMiddleware:
         else:
             logger.debug("從 cookie 獲取 token")
         
-        if not token:
-            logger.warning("未找到 token，請求頭和 cookie 中都沒有")
-            auth_requests.labels(status='no_token').inc()
-            request.user = AnonymousUser()
+        return False, token
+    
+    def _handle_missing_token(self, request):
+        """
+        處理沒有 token 的請求
+        
+        Returns:
+            HttpResponse or None: 需要直接返回的響應；None 表示繼續處理請求
+        """
+        logger.warning("未找到 token，請求頭和 cookie 中都沒有")
+        auth_requests.labels(status='no_token').inc()
+        request.user = AnonymousUser()
+        
+        # 如果不是 API 請求，重定向到登錄頁面
+        if not request.path.startswith('/api/'):
+            # 檢查是否為首頁請求，如果是，允許訪問（讓視圖決定是否需要認證）
+            if request.path == '/' and get_sso_config().debug:
+                logger.debug("允許未認證用戶訪問首頁（調試模式）")
+                return None
             
-            # 如果不是 API 請求，重定向到登錄頁面
-            if not request.path.startswith('/api/'):
-                # 檢查是否為首頁請求，如果是，允許訪問（讓視圖決定是否需要認證）
-                if request.path == '/' and getattr(settings, 'DEBUG', False):
-                    logger.debug("允許未認證用戶訪問首頁（調試模式）")
-                    return self.get_response(request)
+            next_url = quote(request.get_full_path())
+            # 檢查是否存在重定向循環標記
+            if 'from_sso' in request.GET:
+                logger.warning("檢測到重定向循環，使用403響應")
+                messages.error(request, '登入過程發生錯誤：重定向循環')
+                return render(request, 'portal/403.html', status=403)
                 
-                next_url = quote(request.get_full_path())
-                # 檢查是否存在重定向循環標記
-                if 'from_sso' in request.GET:
-                    logger.warning("檢測到重定向循環，使用403響應")
-                    messages.error(request, '登入過程發生錯誤：重定向循環')
-                    return render(request, 'portal/403.html', status=403)
-                    
-                try:
-                    redirect_url = reverse('portal:login') + f"?next={next_url}"
-                    logger.info(f"重定向到登錄頁面: {redirect_url}")
-                    return redirect(redirect_url)
-                except Exception as e:
-                    logger.error(f"重定向到登錄頁面時發生錯誤: {str(e)}")
-                    # 如果無法重定向到登錄頁面，顯示錯誤提示
-                    return HttpResponse(
-                        "系統配置錯誤：無法找到登錄頁面。請聯繫管理員。",
-                        content_type="text/html",
-                        status=500
-                    )
-                
-            return self.get_response(request)
+            try:
+                redirect_url = reverse('portal:login') + f"?next={next_url}"
+                logger.info(f"重定向到登錄頁面: {redirect_url}")
+                return redirect(redirect_url)
+            except Exception as e:
+                logger.error(f"重定向到登錄頁面時發生錯誤: {str(e)}")
+                # 如果無法重定向到登錄頁面，顯示錯誤提示
+                return HttpResponse(
+                    "系統配置錯誤：無法找到登錄頁面。請聯繫管理員。",
+                    content_type="text/html",
+                    status=500
+                )
+            
+        return None
+    
+    def _get_token_value(self, token):
+        # 如果是從 header 中獲取的 token，需要去掉 'Bearer ' 前綴
+        if token.startswith('Bearer '):
+            token_value = token.split(' ')[1]
+            logger.debug("從 Bearer token 中提取值")
+        else:
+            token_value = token
+            logger.debug("使用原始 token 值")
+            
+        logger.debug(f"驗證 token: {token_value[:10]}...")
+        return token_value
+    
+    def _accept_cached_user(self, request, cached_user):
+        logger.debug(f"使用快取的 token 驗證結果，用戶: {cached_user.username}")
+        request.user = cached_user
+        auth_requests.labels(status='cache_hit').inc()
+    
+    def _accept_verified_user(self, request, token_value, user_data, verify_detail):
+        """驗證成功時設置 request.user，返回需要緩存的用戶對象"""
+        logger.info(f"Token 驗證成功，用戶: {user_data.get('username', 'unknown')}")
+        
+        # 創建用戶對象，使用統一的 User 類
+        user = self._build_user(user_data, token_value)
+        request.user = user
+        
+        auth_requests.labels(status='local_verified' if verify_detail == 'local' else 'success').inc()
+        return user
+    
+    def _accept_refreshed_user(self, request, new_access_token, user_data):
+        logger.info(f"新 Token 驗證成功，用戶: {user_data.get('username', 'unknown')}")
+        
+        user = self._build_user(user_data, new_access_token)
+        request.user = user
+        
+        auth_requests.labels(status='refreshed').inc()
+        return user
+    
+    def _accept_cached_refreshed_user(self, request, cached_user):
+        logger.info(f"新 Token 已有緩存的驗證結果，用戶: {cached_user.username}")
+        request.user = cached_user
+        auth_requests.labels(status='refreshed').inc()
+    
+    def _expired_response(self, request):
+        """刷新失敗或沒有 refresh token，重定向到登入頁面"""
+        auth_requests.labels(status='expired').inc()
+        request.user = AnonymousUser()
+        
+        # 使用 TokenExpiredError 異常
+        error = TokenExpiredError()
+        
+        response = self._login_redirect(request, "Token 過期且無法刷新，重定向到 SSO 登錄頁面")
+        if response is not None:
+            return response
+            
+        return JsonResponse({
+            'code': error.code,
+            'message': error.message
+        }, status=401)
+    
+    def _invalid_response(self, request):
+        auth_requests.labels(status='invalid').inc()
+        request.user = AnonymousUser()
+        
+        # 使用 TokenError 異常
+        error = TokenError()
+        
+        response = self._login_redirect(request, "Token 無效，重定向到 SSO 登錄頁面")
+        if response is not None:
+            return response
             
+        return JsonResponse({
+            'code': error.code,
+            'message': error.message
+        }, status=401)
+    
+    def _unavailable_response(self, request, error):
+        auth_requests.labels(status='circuit_open' if isinstance(error, CircuitOpenError) else 'error').inc()
+        request.user = AnonymousUser()
+        
+        response = self._login_redirect(request, "SSO 服務錯誤，重定向到登錄頁面")
+        if response is not None:
+            return response
+            
+        return JsonResponse({
+            'code': 'sso_service_error',
+            'message': 'SSO service is temporarily unavailable'
+        }, status=503)
+    
+    def _error_response(self, request, error):
+        logger.error(f"Token 驗證過程中發生意外錯誤: {str(error)}", exc_info=True)
+        auth_requests.labels(status='error').inc()
+        request.user = AnonymousUser()
+        
+        response = self._login_redirect(request, "發生錯誤，重定向到登錄頁面")
+        if response is not None:
+            return response
+            
+        return JsonResponse({
+            'code': 'auth_error',
+            'message': str(error)
+        }, status=500)
+    
+    def _refresh(self, request, token_value, refresh_token, detailed_logging):
+        """
+        嘗試使用 refresh token 刷新 access token 並驗證新 token
+        
+        Returns:
+            str or None: 驗證通過的新 access token
+        """
+        if refresh_token and get_token_rejection_cache(refresh_token) == REJECTION_REFRESH_FAILED:
+            logger.warning("Refresh token 最近刷新失敗，跳過刷新")
+            return None
+        if not refresh_token:
+            logger.warning("沒有 refresh token，無法刷新")
+            return None
+        
+        logger.info("Access token 已過期，嘗試使用 refresh token 刷新...")
+        new_access_token, refresh_error = coalesced_refresh_access_token(refresh_token, self.sso_session)
+        
+        if not new_access_token:
+            logger.warning(f"Token 刷新失敗: {refresh_error}")
+            return None
+        
+        # 刷新成功，使用新 token 重新驗證
+        logger.info("Token 刷新成功，使用新 token 重新驗證")
+        
+        # 清除舊 token 的驗證結果緩存；負緩存保留，舊 token 再次出現時不必重新請求 SSO
+        delete_token_verification_cache(token_value)
+        
+        # 並發請求共享同一個新 token 時，其驗證結果通常已由刷新的請求寫入緩存
+        cached_user = get_token_verification_cache(new_access_token)
+        if cached_user:
+            self._accept_cached_refreshed_user(request, cached_user)
+            return new_access_token
+        
+        # 重新驗證新 token
+        new_status_code, user_data, new_verify_detail = self._verify_token(
+            new_access_token, detailed_logging
+        )
+        if new_status_code != 200:
+            logger.error(f"新 Token 驗證失敗: HTTP {new_status_code}, {new_verify_detail}")
+            return None
+        
+        user = self._accept_refreshed_user(request, new_access_token, user_data)
+        # 緩存新 token 的驗證結果
+        set_token_verification_cache(new_access_token, user, self._get_token_cache_ttl())
+        return new_access_token
+    
+    async def _arefresh(self, request, token_value, refresh_token, detailed_logging):
+        """_refresh 的異步版本"""
+        if refresh_token and await aget_token_rejection_cache(refresh_token) == REJECTION_REFRESH_FAILED:
+            logger.warning("Refresh token 最近刷新失敗，跳過刷新")
+            return None
+        if not refresh_token:
+            logger.warning("沒有 refresh token，無法刷新")
+            return None
+        
+        logger.info("Access token 已過期，嘗試使用 refresh token 刷新...")
+        new_access_token, refresh_error = await acoalesced_refresh_access_token(refresh_token, self.async_client)
+        
+        if not new_access_token:
+            logger.warning(f"Token 刷新失敗: {refresh_error}")
+            return None
+        
+        logger.info("Token 刷新成功，使用新 token 重新驗證")
+        await adelete_token_verification_cache(token_value)
+        
+        cached_user = await aget_token_verification_cache(new_access_token)
+        if cached_user:
+            self._accept_cached_refreshed_user(request, cached_user)
+            return new_access_token
+        
+        new_status_code, user_data, new_verify_detail = await self._averify_token(
+            new_access_token, detailed_logging
+        )
+        if new_status_code != 200:
+            logger.error(f"新 Token 驗證失敗: HTTP {new_status_code}, {new_verify_detail}")
+            return None
+        
+        user = self._accept_refreshed_user(request, new_access_token, user_data)
+        await aset_token_verification_cache(new_access_token, user, self._get_token_cache_ttl())
+        return new_access_token
+    
+    def _get_refresh_ahead_token(self, request, token_value):
+        """
+        判斷是否需要提前刷新 access token
+        
+        token 的 exp 距今不超過 SSO_PROACTIVE_REFRESH_WINDOW 秒且請求帶有
+        refresh token 時返回該 refresh token，否則返回 None。
+        """
+        window = get_sso_config().proactive_refresh_window
+        refresh_token = request.COOKIES.get('auth_refresh_token')
+        if window <= 0 or not refresh_token:
+            return None
+        
+        expiry = get_unverified_expiry(token_value)
+        if expiry is None or expiry - time.time() > window:
+            return None
+        return refresh_token
+    
+    def _accept_refreshed_ahead(self, request, new_access_token):
+        """
+        提前刷新成功後，直接以當前用戶構造新 token 的驗證結果
+        
+        新 token 由 SSO 刷新接口簽發且屬於同一用戶，無需再向 SSO 驗證。
+        """
+        logger.info(f"Access token 已提前刷新，用戶: {request.user.username}")
+        user = copy.copy(request.user)
+        user.token = new_access_token
+        request.user = user
+        auth_requests.labels(status='refreshed_ahead').inc()
+        return user
+    
+    def _refresh_ahead(self, request, token_value):
+        """
+        access token 即將過期時提前刷新，避免過期後的驗證、刷新、再驗證三次往返
+        
+        刷新失敗時不影響本次請求（當前 token 仍然有效）。超時、連接錯誤或 SSO 服務端錯誤
+        導致的失敗會按 refresh token 記錄冷卻條目，SSO_PROACTIVE_REFRESH_COOLDOWN 秒內
+        不再提前刷新，避免窗口內的每個請求都重複請求故障中的 SSO。
+        
+        Returns:
+            str or None: 新的 access token
+        """
+        refresh_token = self._get_refresh_ahead_token(request, token_value)
+        if refresh_token is None:
+            return None
+        if get_token_rejection_cache(refresh_token) in (REJECTION_REFRESH_FAILED, REJECTION_REFRESH_COOLDOWN):
+            return None
+        
+        logger.info("Access token 即將過期，嘗試提前刷新...")
+        new_access_token, refresh_error = coalesced_refresh_access_token(refresh_token, self.sso_session)
+        if not new_access_token:
+            logger.warning(f"提前刷新失敗，繼續使用當前 token: {refresh_error}")
+            if refresh_error != "refresh_token_expired":
+                set_token_rejection_cache(
+                    refresh_token, REJECTION_REFRESH_COOLDOWN, get_sso_config().proactive_refresh_cooldown
+                )
+            return None
+        
+        user = self._accept_refreshed_ahead(request, new_access_token)
+        set_token_verification_cache(new_access_token, user, self._get_token_cache_ttl())
+        return new_access_token
+    
+    async def _arefresh_ahead(self, request, token_value):
+        """_refresh_ahead 的異步版本"""
+        refresh_token = self._get_refresh_ahead_token(request, token_value)
+        if refresh_token is None:
+            return None
+        if await aget_token_rejection_cache(refresh_token) in (REJECTION_REFRESH_FAILED, REJECTION_REFRESH_COOLDOWN):
+            return None
+        
+        logger.info("Access token 即將過期，嘗試提前刷新...")
+        new_access_token, refresh_error = await acoalesced_refresh_access_token(refresh_token, self.async_client)
+        if not new_access_token:
+            logger.warning(f"提前刷新失敗，繼續使用當前 token: {refresh_error}")
+            if refresh_error != "refresh_token_expired":
+                await aset_token_rejection_cache(
+                    refresh_token, REJECTION_REFRESH_COOLDOWN, get_sso_config().proactive_refresh_cooldown
+                )
+            return None
+        
+        user = self._accept_refreshed_ahead(request, new_access_token)
+        await aset_token_verification_cache(new_access_token, user, self._get_token_cache_ttl())
+        return new_access_token
+    
+    def _authenticate(self, request, token):
+        """
+        驗證 token 並設置 request.user
+        
+        Returns:
+            tuple: (response, new_access_token) - response 不為 None 時直接返回；
+                   new_access_token 不為 None 時需要在響應中設置新的 cookie
+        """
+        detailed_logging = self._is_detailed_logging()
+        token_value = None
         try:
-            # 如果是從 header 中獲取的 token，需要去掉 'Bearer ' 前綴
-            if token.startswith('Bearer '):
-                token_value = token.split(' ')[1]
-                logger.debug("從 Bearer token 中提取值")
-            else:
-                token_value = token
-                logger.debug("使用原始 token 值")
-                
-            logger.debug(f"驗證 token: {token_value[:10]}...")
+            token_value = self._get_token_value(token)
             
             # 使用新的緩存函數檢查緩存中是否有此 token 的驗證結果
-            cached_user = get_token_verification_cache(token_value)
-            
+            cached_user = get_token_verification_cache(token_value, revalidate=self._revalidate_token)
             if cached_user:
-                logger.debug(f"使用快取的 token 驗證結果，用戶: {cached_user.username}")
-                request.user = cached_user
-                auth_requests.labels(status='cache_hit').inc()
-                return self.get_response(request)
+                self._accept_cached_user(request, cached_user)
+                return None, self._refresh_ahead(request, token_value)
             
-            # 從設置中獲取超時設置
-            request_timeout = getattr(settings, 'SSO_REQUEST_TIMEOUT', 5)
+            # 如果快取中沒有，則進行驗證
+            status_code, user_data, verify_detail = self._verify_token(token_value, detailed_logging)
             
-            # 添加更詳細的日誌，記錄 SSO 服務 URL
-            sso_verify_url = f"{settings.SSO_SERVICE['URL']}{settings.SSO_SERVICE['TOKEN_VERIFY_URL']}"
-            logger.debug(f"即將連接 SSO 服務 URL: {sso_verify_url}")
+            if status_code == 200:
+                user = self._accept_verified_user(request, token_value, user_data, verify_detail)
+                # 使用新的緩存函數將用戶對象存入快取
+                set_token_verification_cache(token_value, user, self._get_token_cache_ttl())
+                logger.debug(f"用戶信息已存入快取，過期時間: {self._get_token_cache_ttl()}秒")
+                return None, self._refresh_ahead(request, token_value)
             
-            # 如果快取中沒有，則進行驗證
-            verify_response = self.sso_session.post(
-                sso_verify_url,
-                json={'token': token_value},
-                verify=settings.SSO_SERVICE['VERIFY_SSL'],
-                timeout=request_timeout
-            )
+            if status_code == 401:
+                logger.warning(f"Token 已過期: {verify_detail}")
+                new_access_token = self._refresh(
+                    request, token_value, request.COOKIES.get('auth_refresh_token'), detailed_logging
+                )
+                if new_access_token:
+                    return None, new_access_token
+                return self._expired_response(request), None
             
-            logger.debug(f"SSO 響應狀態: {verify_response.status_code}")
-            if detailed_logging:
-                logger.debug(f"SSO 響應內容: {verify_response.text}")
+            logger.error(f"Token 驗證失敗: HTTP {status_code}, 響應內容: {verify_detail}")
             
-            if verify_response.status_code == 200:
-                user_data = verify_response.json()
-                logger.info(f"Token 驗證成功，用戶: {user_data.get('username', 'unknown')}")
-                
-                # 創建用戶對象，使用統一的 User 類
-                user = User(user_data)
-                # 保存 token 到用戶對象中，以便後續權限檢查使用
-                user.token = token_value
-                request.user = user
-                
-                # 從設置中獲取緩存過期時間
-                token_cache_ttl = getattr(settings, 'TOKEN_VERIFICATION_CACHE_TTL', 300)
-                
-                # 使用新的緩存函數將用戶對象存入快取
-                set_token_verification_cache(token_value, user, token_cache_ttl)
-                logger.debug(f"用戶信息已存入快取，過期時間: {token_cache_ttl}秒")
-                
-                auth_requests.labels(status='success').inc()
-            elif verify_response.status_code == 401:
-                logger.warning(f"Token 已過期: {verify_response.text}")
-                
-                # ✅ 新增：嘗試使用 refresh token 刷新 access token
-                if refresh_token:
-                    logger.info("Access token 已過期，嘗試使用 refresh token 刷新...")
-                    new_access_token, refresh_error = refresh_access_token(refresh_token, self.sso_session)
-                    
-                    if new_access_token:
-                        # 刷新成功，使用新 token 重新驗證
-                        logger.info("Token 刷新成功，使用新 token 重新驗證")
-                        
-                        # 清除舊 token 的緩存
-                        invalidate_token_cache(token_value)
-                        
-                        # 重新驗證新 token
-                        new_verify_response = self.sso_session.post(
-                            sso_verify_url,
-                            json={'token': new_access_token},
-                            verify=settings.SSO_SERVICE['VERIFY_SSL'],
-                            timeout=request_timeout
-                        )
-                        
-                        if new_verify_response.status_code == 200:
-                            user_data = new_verify_response.json()
-                            logger.info(f"新 Token 驗證成功，用戶: {user_data.get('username', 'unknown')}")
-                            
-                            # 創建用戶對象
-                            user = User(user_data)
-                            user.token = new_access_token
-                            request.user = user
-                            
-                            # 緩存新 token 的驗證結果
-                            token_cache_ttl = getattr(settings, 'TOKEN_VERIFICATION_CACHE_TTL', 300)
-                            set_token_verification_cache(new_access_token, user, token_cache_ttl)
-                            
-                            auth_requests.labels(status='refreshed').inc()
-                            
-                            # 處理請求並在響應中設置新的 cookie
-                            response = self.get_response(request)
-                            response = self._set_token_cookie(response, new_access_token)
-                            
-                            auth_latency.observe(time.time() - start_time)
-                            logger.info(f"請求處理完成（token 已刷新），耗時: {time.time() - start_time:.3f}秒")
-                            return response
-                        else:
-                            logger.error(f"新 Token 驗證失敗: HTTP {new_verify_response.status_code}")
-                    else:
-                        logger.warning(f"Token 刷新失敗: {refresh_error}")
-                else:
-                    logger.warning("沒有 refresh token，無法刷新")
-                
-                # 刷新失敗或沒有 refresh token，重定向到登入頁面
-                auth_requests.labels(status='expired').inc()
-                request.user = AnonymousUser()
-                
-                # 使用 TokenExpiredError 異常
-                error = TokenExpiredError()
-                
-                # 如果不是 API 請求，重定向到登錄頁面
-                if not request.path.startswith('/api/'):
-                    next_url = quote(request.get_full_path())
-                    redirect_url = f"{settings.SSO_SERVICE['URL']}?next={next_url}"
-                    logger.info(f"Token 過期且無法刷新，重定向到 SSO 登錄頁面: {redirect_url}")
-                    return redirect(redirect_url)
-                    
-                return JsonResponse({
-                    'code': error.code,
-                    'message': error.message
-                }, status=401)
-            else:
-                logger.error(f"Token 驗證失敗: HTTP {verify_response.status_code}, 響應內容: {verify_response.text}")
-                auth_requests.labels(status='invalid').inc()
-                request.user = AnonymousUser()
-                
-                # 使用 TokenError 異常
-                error = TokenError()
-                
-                # 如果不是 API 請求，重定向到登錄頁面
-                if not request.path.startswith('/api/'):
-                    next_url = quote(request.get_full_path())
-                    redirect_url = f"{settings.SSO_SERVICE['URL']}?next={next_url}"
-                    logger.info(f"Token 無效，重定向到 SSO 登錄頁面: {redirect_url}")
-                    return redirect(redirect_url)
-                    
-                return JsonResponse({
-                    'code': error.code,
-                    'message': error.message
-                }, status=401)
+            # SSO 服務端錯誤、超時或限流時嘗試使用最後已知有效的驗證結果
+            if is_service_failure(status_code):
+                degraded_user = get_last_known_good_user(token_value)
+                if degraded_user:
+                    self._serve_degraded(request, degraded_user)
+                    return None, None
+            
+            return self._invalid_response(request), None
                 
         except requests.RequestException as e:
             logger.error(f"SSO 服務連接錯誤: {str(e)}")
-            auth_requests.labels(status='error').inc()
-            request.user = AnonymousUser()
             
-            # 如果不是 API 請求，重定向到登錄頁面
-            if not request.path.startswith('/api/'):
-                next_url = quote(request.get_full_path())
-                redirect_url = f"{settings.SSO_SERVICE['URL']}?next={next_url}"
-                logger.info(f"SSO 服務錯誤，重定向到登錄頁面: {redirect_url}")
-                return redirect(redirect_url)
-                
-            return JsonResponse({
-                'code': 'sso_service_error',
-                'message': 'SSO service is temporarily unavailable'
-            }, status=503)
+            # SSO 不可用（包括熔斷器打開）時嘗試使用最後已知有效的驗證結果
+            degraded_user = get_last_known_good_user(token_value) if token_value else None
+            if degraded_user:
+                self._serve_degraded(request, degraded_user)
+                return None, None
+            return self._unavailable_response(request, e), None
         except Exception as e:
-            logger.error(f"Token 驗證過程中發生意外錯誤: {str(e)}", exc_info=True)
-            auth_requests.labels(status='error').inc()
-            request.user = AnonymousUser()
+            return self._error_response(request, e), None
+    
+    async def _aauthenticate(self, request, token):
+        """_authenticate 的異步版本，返回值相同"""
+        detailed_logging = self._is_detailed_logging()
+        token_value = None
+        try:
+            token_value = self._get_token_value(token)
             
-            # 如果不是 API 請求，重定向到登錄頁面
-            if not request.path.startswith('/api/'):
-                next_url = quote(request.get_full_path())
-                redirect_url = f"{settings.SSO_SERVICE['URL']}?next={next_url}"
-                logger.info(f"發生錯誤，重定向到登錄頁面: {redirect_url}")
-                return redirect(redirect_url)
+            # L1 命中時不涉及任何 I/O；軟過期條目的重新驗證在後台線程池中執行
+            cached_user = await aget_token_verification_cache(token_value, revalidate=self._revalidate_token)
+            if cached_user:
+                self._accept_cached_user(request, cached_user)
+                return None, await self._arefresh_ahead(request, token_value)
+            
+            status_code, user_data, verify_detail = await self._averify_token(token_value, detailed_logging)
+            
+            if status_code == 200:
+                user = self._accept_verified_user(request, token_value, user_data, verify_detail)
+                await aset_token_verification_cache(token_value, user, self._get_token_cache_ttl())
+                logger.debug(f"用戶信息已存入快取，過期時間: {self._get_token_cache_ttl()}秒")
+                return None, await self._arefresh_ahead(request, token_value)
+            
+            if status_code == 401:
+                logger.warning(f"Token 已過期: {verify_detail}")
+                new_access_token = await self._arefresh(
+                    request, token_value, request.COOKIES.get('auth_refresh_token'), detailed_logging
+                )
+                if new_access_token:
+                    return None, new_access_token
+                return self._expired_response(request), None
+            
+            logger.error(f"Token 驗證失敗: HTTP {status_code}, 響應內容: {verify_detail}")
+            
+            if is_service_failure(status_code):
+                degraded_user = await aget_last_known_good_user(token_value)
+                if degraded_user:
+                    self._serve_degraded(request, degraded_user)
+                    return None, None
+            
+            return self._invalid_response(request), None
                 
-            return JsonResponse({
-                'code': 'auth_error',
-                'message': str(e)
-            }, status=500)
-        finally:
-            auth_latency.observe(time.time() - start_time)
-            logger.debug(f"請求處理完成，耗時: {time.time() - start_time:.3f}秒")
+        except requests.RequestException as e:
+            logger.error(f"SSO 服務連接錯誤: {str(e)}")
             
-        return self.get_response(request)
\ No newline at end of file
+            degraded_user = await aget_last_known_good_user(token_value) if token_value else None
+            if degraded_user:
+                self._serve_degraded(request, degraded_user)
+                return None, None
+            return self._unavailable_response(request, e), None
+        except Exception as e:
+            return self._error_response(request, e), None
+    
+    def _finish_refreshed(self, response, new_access_token, start_time):
+        # 在響應中設置新的 cookie
+        response = self._set_token_cookie(response, new_access_token)
+        logger.info(f"請求處理完成（token 已刷新），耗時: {time.time() - start_time:.3f}秒")
+        return response
+    
+    def _get_login_token(self, request, response):
+        """
+        登錄回調的響應設置了新的 access token 時返回該 token
+        
+        其他跳過認證的路徑或未啟用 SSO_WARM_UP_ON_LOGIN 時返回 None
+        """
+        if request.path != LOGIN_CALLBACK_PATH or not get_sso_config().warm_up_on_login:
+            return None
+        cookie = getattr(response, 'cookies', {}).get('auth_access_token')
+        return cookie.value if cookie is not None and cookie.value else None
+    
+    def _observe_latency(self, start_time):
+        auth_latency.observe(time.time() - start_time)
+        logger.debug(f"請求處理完成，耗時: {time.time() - start_time:.3f}秒")
+        
+    def __call__(self, request):
+        if self._async_mode:
+            return self.__acall__(request)
+        
+        start_time = time.time()
+        skip, token = self._prepare(request)
+        if skip:
+            response = self.get_response(request)
+            login_token = self._get_login_token(request, response)
+            if login_token:
+                # 在後台填充令牌驗證和權限緩存，不延遲登錄回調的響應
+                from .warmup import schedule_login_warm_up
+                schedule_login_warm_up(login_token)
+            return response
+        
+        if not token:
+            response = self._handle_missing_token(request)
+            return response if response is not None else self.get_response(request)
+        
+        try:
+            response, new_access_token = self._authenticate(request, token)
+        finally:
+            self._observe_latency(start_time)
+        
+        if response is not None:
+            return response
+        
+        try:
+            response = self.get_response(request)
+        finally:
+            # 請求範圍的權限判斷緩存不能帶到下一個請求
+            drop_permission_memo(request.user)
+        if new_access_token:
+            response = self._finish_refreshed(response, new_access_token, start_time)
+        return response
+    
+    async def __acall__(self, request):
+        """ASGI 下的請求處理，流程與 __call__ 相同"""
+        start_time = time.time()
+        skip, token = self._prepare(request)
+        if skip:
+            response = await self.get_response(request)
+            login_token = self._get_login_token(request, response)
+            if login_token:
+                from .warmup import schedule_login_warm_up
+                schedule_login_warm_up(login_token)
+            return response
+        
+        if not token:
+            response = self._handle_missing_token(request)
+            return response if response is not None else await self.get_response(request)
+        
+        try:
+            response, new_access_token = await self._aauthenticate(request, token)
+        finally:
+            self._observe_latency(start_time)
+        
+        if response is not None:
+            return response
+        
+        try:
+            response = await self.get_response(request)
+        finally:
+            drop_permission_memo(request.user)
+        if new_access_token:
+            response = self._finish_refreshed(response, new_access_token, start_time)
+        return response
@@ -1,6 +1,6 @@
 import logging
 import json
-from django.conf import settings
+from .conf import get_sso_config
 
 logger = logging.getLogger(__name__)
 
@@ -77,9 +77,7 @@ class User:
         # 添加經過驗證的標誌，所有使用此類生成的用戶都被視為已認證
         self.is_authenticated = True
         
-        # 獲取日誌級別
-        log_level = getattr(settings, 'SSO_LOGGING_LEVEL', 'DEBUG' if settings.DEBUG else 'INFO')
-        if log_level == 'DEBUG':
+        if get_sso_config().detailed_logging:
             logger.debug(f"用戶對象已建立: {self.username}")
         
     def has_perm(self, perm, obj=None):
@@ -217,6 +215,60 @@ class User:
             
         return profile
         
+    # 緩存編碼的格式版本，字段變化時遞增，舊版本的緩存數據按未命中處理
+    CACHE_FORMAT_VERSION = 1
+    
+    # 緩存編碼包含的字段（按順序），即 __init__ 從 SSO 響應派生出的屬性
+    CACHE_FIELDS = (
+        'id', 'username', 'email', 'first_name', 'last_name',
+        'is_active', 'is_staff', 'is_superuser', 'modules', 'permissions',
+        'display_name', 'avatar_url', 'department', 'position',
+        'staff_no', 'phone_number', 'full_name', 'profile',
+    )
+    
+    def to_cache_data(self):
+        """
+        將用戶對象編碼為緊湊的元組，用於寫入共享緩存
+        
+        只包含 __init__ 派生的字段，不包含原始 SSO 響應和令牌本身
+        （令牌在讀取緩存時由調用方提供）。
+        
+        返回:
+            tuple: (格式版本, 字段值...)
+        """
+        return (self.CACHE_FORMAT_VERSION,) + tuple(getattr(self, field) for field in self.CACHE_FIELDS)
+    
+    @classmethod
+    def from_cache_data(cls, data, token=''):
+        """
+        從 to_cache_data 的編碼重建用戶對象
+        
+        參數:
+            data (tuple): to_cache_data 返回的元組
+            token (str): 用戶令牌
+            
+        返回:
+            User or None: 用戶對象；格式版本不匹配時返回 None
+        """
+        if not data or data[0] != cls.CACHE_FORMAT_VERSION or len(data) != len(cls.CACHE_FIELDS) + 1:
+            return None
+        
+        # 直接設置屬性，不經過 __init__ 重新派生
+        user = cls.__new__(cls)
+        user.__dict__.update(zip(cls.CACHE_FIELDS, data[1:]))
+        user.pk = user.id
+        user.staff_number = user.staff_no
+        user.token = token
+        user.is_authenticated = True
+        return user
+    
+    def __getattr__(self, name):
+        # 從緩存重建的用戶沒有原始 SSO 響應，首次訪問時以派生字段代替
+        if name == '_user_data':
+            self._user_data = {field: self.__dict__.get(field) for field in self.CACHE_FIELDS}
+            return self._user_data
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        
     def __str__(self):
         """
         返回用戶的字符串表示
@@ -0,0 +1,320 @@
+# lungfung_sso/permission_set.py
+"""
+預編譯的用戶權限集合
+
+SSO 返回的權限數據需要展開父模組的系統權限（MANAGE_SYSTEM / VIEW_SYSTEM）並把子模組權限
+拼接為 'module.codename' 才能檢查。PermissionSet 對每份權限數據只構建一次，之後的成員測試
+都是 O(1)；構建結果按用戶ID緩存在進程內，權限緩存條目的版本變化時重新構建。
+
+權限字符串在進程內統一編號（CodenameTable），每個權限對應一個位，用戶的權限集合和視圖要求的
+權限列表都表示為整數位掩碼，"擁有所有這些權限" 只需一次按位與和比較。
+
+同一請求中的權限檢查結果另外緩存在用戶對象上（PermissionMemo），請求結束時釋放。
+"""
+import logging
+import threading
+
+from .cache import LOCAL_CACHE_MAX_ENTRIES, PERMISSIONS_CACHE_TTL, LocalCache
+from .conf import get_sso_config
+
+logger = logging.getLogger(__name__)
+
+
+class CodenameTable:
+    """
+    進程內的權限字符串編號表
+
+    以 SSO_MODULES × CHILD_PERMISSION_TYPES 生成的子模組權限和父模組權限初始化，
+    遇到新的權限字符串時追加編號。編號只增不減，已分配的位不會改變。
+
+    參數:
+        config (SSOConfig): 設置快照
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._bits = {}
+        self._codenames = []
+        self._masks = {}
+        self._module_masks = {}
+        self._lock = threading.Lock()
+        self.mask(config.parent_permissions.values())
+        self.mask(config.child_permission_matrix.values())
+
+        # 系統權限的位和展開後的子模組權限掩碼
+        self.manage_system_bit = self.bit(config.manage_system_permission)
+        self.view_system_bit = self.bit(config.view_system_permission)
+        self.manage_system_mask = self.mask(config.manage_system_permissions)
+        self.view_system_mask = self.mask(config.view_system_permissions)
+
+    def bit(self, codename):
+        """返回權限字符串對應的位，未編號時分配新的位"""
+        bit = self._bits.get(codename)
+        if bit is None:
+            with self._lock:
+                bit = self._bits.get(codename)
+                if bit is None:
+                    bit = 1 << len(self._codenames)
+                    self._codenames.append(codename)
+                    self._bits[codename] = bit
+        return bit
+
+    def mask(self, codenames):
+        """返回一組權限字符串的位掩碼"""
+        mask = 0
+        for codename in codenames:
+            mask |= self.bit(codename)
+        return mask
+
+    def compiled_mask(self, codenames):
+        """
+        返回一組權限字符串的位掩碼並記住結果，用於視圖等固定的權限列表
+
+        參數:
+            codenames (tuple): 權限字符串，需可哈希
+        """
+        mask = self._masks.get(codenames)
+        if mask is None:
+            mask = self._masks[codenames] = self.mask(codenames)
+        return mask
+
+    def module_mask(self, module, actions):
+        """
+        返回模組權限動作的位掩碼並記住結果，動作按 SSOConfig.format_permission 格式化
+
+        參數:
+            module (str): 模組代碼
+            actions (tuple): 權限動作
+        """
+        key = (module, actions)
+        mask = self._module_masks.get(key)
+        if mask is None:
+            format_permission = self.config.format_permission
+            mask = self._module_masks[key] = self.mask(format_permission(module, action) for action in actions)
+        return mask
+
+    def get_bit(self, codename):
+        """返回權限字符串對應的位，未編號時返回 None"""
+        return self._bits.get(codename)
+
+    def codenames(self, mask):
+        """按編號順序返回位掩碼中的權限字符串"""
+        codenames = self._codenames
+        result = []
+        while mask:
+            low = mask & -mask
+            result.append(codenames[low.bit_length() - 1])
+            mask ^= low
+        return result
+
+    def __len__(self):
+        return len(self._codenames)
+
+
+_table = None
+_table_lock = threading.Lock()
+
+
+def get_codename_table():
+    """
+    獲取當前設置快照對應的權限編號表，設置變更後重新創建
+
+    返回:
+        CodenameTable: 權限編號表
+    """
+    global _table
+    config = get_sso_config()
+    table = _table
+    if table is None or table.config is not config:
+        with _table_lock:
+            table = _table
+            if table is None or table.config is not config:
+                table = _table = CodenameTable(config)
+    return table
+
+
+class PermissionSet:
+    """
+    不可變的用戶權限集合，以權限編號表中的位掩碼表示
+
+    參數:
+        permissions (iterable): 完整權限字符串，父模組權限為 codename，子模組權限為 'module.codename'
+        table (CodenameTable, optional): 權限編號表，默認為當前設置對應的編號表
+    """
+
+    __slots__ = ('mask', 'table')
+
+    def __init__(self, permissions=(), table=None):
+        table = table or get_codename_table()
+        object.__setattr__(self, 'table', table)
+        object.__setattr__(self, 'mask', table.mask(permissions))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PermissionSet 是不可變的")
+
+    @classmethod
+    def _from_mask(cls, mask, table):
+        permission_set = cls.__new__(cls)
+        object.__setattr__(permission_set, 'table', table)
+        object.__setattr__(permission_set, 'mask', mask)
+        return permission_set
+
+    @property
+    def config(self):
+        """構建時使用的設置快照"""
+        return self.table.config
+
+    @classmethod
+    def from_payload(cls, permissions_data):
+        """
+        從 SSO 返回的權限數據構建權限集合
+
+        擁有 MANAGE_SYSTEM 時包含所有子模組的所有權限類型；擁有 VIEW_SYSTEM 時額外包含
+        所有子模組的查看權限。
+
+        參數:
+            permissions_data (dict): USER_PERMISSIONS_URL 返回的權限數據
+        返回:
+            PermissionSet: 權限集合
+        """
+        table = get_codename_table()
+        config = table.config
+        parent_module = config.parent_module
+        modules = permissions_data.get('permissions', [])
+
+        parent_mask = 0
+        for module_data in modules:
+            if module_data['code'] == parent_module:
+                parent_mask = table.mask(perm['codename'] for perm in module_data.get('permissions', []))
+                break
+        mask = parent_mask
+
+        if parent_mask & table.manage_system_bit:
+            # 系統管理權限已涵蓋所有子模組的所有權限類型
+            return cls._from_mask(mask | table.manage_system_mask, table)
+
+        if parent_mask & table.view_system_bit:
+            mask |= table.view_system_mask
+
+        for module_data in modules:
+            module_code = module_data['code']
+            if module_code != parent_module:
+                mask |= table.mask(f"{module_code}.{perm['codename']}" for perm in module_data.get('permissions', []))
+
+        return cls._from_mask(mask, table)
+
+    def __contains__(self, permission):
+        bit = self.table.get_bit(permission)
+        return bit is not None and self.mask & bit == bit
+
+    def __iter__(self):
+        return iter(self.table.codenames(self.mask))
+
+    def __len__(self):
+        return self.mask.bit_count()
+
+    def __repr__(self):
+        return f"<PermissionSet: {len(self)} 項權限>"
+
+    def has_all(self, permissions):
+        """
+        是否擁有所有完整權限字符串
+
+        參數:
+            permissions (iterable): 權限字符串；元組的位掩碼會被記住，視圖的權限列表應傳入元組
+        """
+        if isinstance(permissions, tuple):
+            required = self.table.compiled_mask(permissions)
+        else:
+            required = self.table.mask(permissions)
+        return self.mask & required == required
+
+    def has_module_permissions(self, module, actions):
+        """
+        是否擁有模組的所有指定權限
+
+        參數:
+            module (str): 模組代碼
+            actions (iterable): 權限動作，按 Permission.format_permission 的規則格式化
+
+        返回:
+            bool: 是否擁有所有權限
+        """
+        required = self.table.module_mask(module, tuple(actions))
+        return self.mask & required == required
+
+
+# 用戶ID -> (權限緩存版本, PermissionSet)
+_local_permission_sets = LocalCache(LOCAL_CACHE_MAX_ENTRIES, PERMISSIONS_CACHE_TTL, 'permission_set')
+
+
+def get_permission_set(user_id, permissions_data, version=None):
+    """
+    獲取權限數據對應的 PermissionSet，同一用戶的權限緩存版本未變時直接返回已構建的集合
+
+    參數:
+        user_id (int): 用戶ID
+        permissions_data (dict): 權限數據
+        version (float, optional): 權限緩存條目的版本（見 cache.get_user_permissions_entry），
+            為 None 時（如剛從 SSO 獲取的數據）只構建不緩存
+
+    返回:
+        PermissionSet: 權限集合
+    """
+    config = get_sso_config()
+    if version is not None:
+        cached = _local_permission_sets.get(user_id)
+        if cached is not None and cached[0] == version and cached[1].table.config is config:
+            return cached[1]
+
+    permission_set = PermissionSet.from_payload(permissions_data)
+    if version is not None:
+        _local_permission_sets.set(user_id, (version, permission_set))
+    if config.detailed_logging:
+        logger.debug(f"已構建用戶 {user_id} 的權限集合: {sorted(permission_set)}")
+    return permission_set
+
+
+# 請求範圍的權限判斷緩存保存在用戶對象的這個屬性中
+PERMISSION_MEMO_ATTR = '_sso_permission_memo'
+
+
+class PermissionMemo:
+    """
+    請求範圍的權限判斷緩存
+    
+    掛在請求的用戶對象上，請求結束時由 JWTAuthenticationMiddleware 釋放。
+    同一頁面中的多次權限檢查只解析一次權限集合，相同的 (模組, 權限) 檢查直接返回之前的結果。
+    
+    用戶對象會被淺拷貝後放入其他請求（見 cache._get_local_user），
+    owner 記錄創建緩存的用戶對象，拷貝得到的對象不會沿用其他請求的緩存。
+    """
+    
+    __slots__ = ('owner', 'resolved', 'permission_set', 'decisions')
+    
+    def __init__(self, owner):
+        self.owner = owner
+        self.resolved = False
+        self.permission_set = None
+        self.decisions = {}
+
+
+def get_permission_memo(user):
+    """獲取用戶對象上的請求範圍權限判斷緩存，不存在時創建"""
+    memo = getattr(user, PERMISSION_MEMO_ATTR, None)
+    if memo is None or memo.owner != id(user):
+        memo = PermissionMemo(id(user))
+        try:
+            setattr(user, PERMISSION_MEMO_ATTR, memo)
+        except AttributeError:
+            # 不允許設置屬性的用戶對象，只在本次調用中使用
+            pass
+    return memo
+
+
+def drop_permission_memo(user):
+    """釋放用戶對象上的請求範圍權限判斷緩存"""
+    try:
+        delattr(user, PERMISSION_MEMO_ATTR)
+    except AttributeError:
+        pass
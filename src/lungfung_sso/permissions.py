@@ -1,6 +1,5 @@
 # lungfung_sso/permissions.py
 from rest_framework.permissions import BasePermission
-from django.conf import settings
 import requests
 from functools import wraps
 import logging
@@ -8,8 +7,12 @@ from enum import Enum
 import json
 from django.contrib import messages
 from django.http import HttpResponseForbidden
+from .conf import get_sso_config
+from .circuit_breaker import is_service_failure
 from .exceptions import PermissionDeniedError
-from .cache import get_user_permissions_cache, set_user_permissions_cache
+from .cache import get_user_permissions_entry, set_user_permissions_cache, get_last_known_good_permissions
+from .permission_set import PermissionSet, get_permission_memo, get_permission_set
+from .middleware import get_sso_session
 from django.shortcuts import render
 
 logger = logging.getLogger(__name__)
@@ -54,18 +57,17 @@ class Module(str, Enum):
     @classmethod
     def get_parent_module(cls):
         """獲取父模組名稱"""
-        return getattr(settings, 'SSO_MODULES', {}).get('PARENT_MODULE', 'DEFAULT')
+        return get_sso_config().parent_module
     
     @classmethod
     def get_child_modules(cls):
         """獲取所有子模組"""
-        child_modules = getattr(settings, 'SSO_MODULES', {}).get('CHILD_MODULES', {})
-        return list(child_modules.values())
+        return list(get_sso_config().child_module_codes)
     
     @classmethod
     def get_child_module_mapping(cls):
         """獲取子模組名稱到代碼的映射"""
-        return getattr(settings, 'SSO_MODULES', {}).get('CHILD_MODULES', {})
+        return dict(get_sso_config().child_modules)
 
 # 從設置中獲取權限配置
 class Permission(Enum):
@@ -74,58 +76,63 @@ class Permission(Enum):
     @classmethod
     def get_parent_permissions(cls):
         """獲取父模組權限"""
-        return getattr(settings, 'SSO_PERMISSIONS', {}).get('PARENT_PERMISSIONS', {
-            'VIEW_SYSTEM': 'view_default_system',
-            'MANAGE_SYSTEM': 'manage_default_system',
-        })
+        return dict(get_sso_config().parent_permissions)
     
     @classmethod
     def get_child_permission_types(cls):
         """獲取子模組權限類型"""
-        return getattr(settings, 'SSO_PERMISSIONS', {}).get('CHILD_PERMISSION_TYPES', {
-            'VIEW': 'view',
-            'ADD': 'add',
-            'CHANGE': 'change',
-            'DELETE': 'delete',
-        })
+        return dict(get_sso_config().child_permission_types)
 
     @classmethod
     def format_permission(cls, module: str, action: str) -> str:
-        """格式化權限字符串"""
-        parent_module = Module.get_parent_module()
-        
-        # 父模組權限直接返回 action 值本身
-        if module == parent_module:
-            return action
-        
-        # 檢查 action 是否已經包含模組信息
-        # 如果 action 已經是完整格式（如 'delete_tc_customer'），直接使用
-        # 如果 action 是基本類型（如 'delete'），則需要添加模組信息
-        if action.endswith(f'_{module}') or f'_{module}_' in action:
-            # action 已經包含模組信息，直接使用 module.action 格式
-            return f"{module}.{action}"
-        else:
-            # action 是基本類型，需要構造完整的權限名稱
-            return f"{module}.{action}_{module}"
+        """格式化權限字符串，規則見 conf.format_permission"""
+        return get_sso_config().format_permission(module, action)
 
 class SSOPermission(BasePermission):
     """SSO權限檢查類"""
     
     def _get_user_permissions(self, request):
         """獲取用戶權限數據"""
+        return self._get_user_permissions_entry(request)[0]
+    
+    def _get_user_permissions_entry(self, request):
+        """
+        獲取用戶權限數據及其緩存版本
+        
+        返回:
+            tuple: (permissions_data, version) - 剛從 SSO 獲取的數據沒有版本
+        """
         if not hasattr(request.user, 'id') or not request.user.id:
             logger.warning("用戶對象缺少 id 屬性，無法獲取權限")
-            return None
+            return None, None
             
-        logger.info(f"開始獲取用戶 {request.user.username} (ID: {request.user.id}) 的權限數據")
+        logger.debug(f"開始獲取用戶 {request.user.username} (ID: {request.user.id}) 的權限數據")
         
-        # 使用緩存函數獲取權限數據
-        permissions_data = get_user_permissions_cache(request.user.id)
+        # 使用緩存函數獲取權限數據，軟過期的數據照常使用並在後台重新獲取
+        permissions_data, version = get_user_permissions_entry(
+            request.user.id,
+            revalidate=lambda user_id: self._fetch_user_permissions(request)
+        )
         
         if permissions_data:
-            logger.info(f"從緩存中獲取到用戶權限數據")
-            return permissions_data
+            return permissions_data, version
         
+        return self._fetch_user_permissions(request), None
+    
+    def _get_permission_set(self, request):
+        """
+        獲取用戶的預編譯權限集合
+        
+        返回:
+            PermissionSet or None: 無法獲取權限數據時返回 None
+        """
+        permissions_data, version = self._get_user_permissions_entry(request)
+        if not permissions_data:
+            return None
+        return get_permission_set(request.user.id, permissions_data, version)
+    
+    def _fetch_user_permissions(self, request):
+        """從 SSO 服務獲取用戶權限數據並存入緩存"""
         try:
             # 改進的 token 獲取邏輯 - 優先從 user.token 獲取
             auth_token = None
@@ -153,19 +160,20 @@ class SSOPermission(BasePermission):
                 return None
             
             # 構造請求參數
-            permissions_url = f"{settings.SSO_SERVICE['URL']}{settings.SSO_SERVICE['USER_PERMISSIONS_URL']}"
+            config = get_sso_config()
+            permissions_url = config.user_permissions_url
             headers = {'Authorization': f'Bearer {auth_token}'}
             params = {'user_id': request.user.id}  # 添加 user_id 參數
-            timeout = getattr(settings, 'SSO_REQUEST_TIMEOUT', 5)
+            timeout = config.request_timeout
             
             logger.info(f"從 SSO 服務獲取權限數據，URL: {permissions_url}, User ID: {request.user.id}")
             logger.debug(f"使用認證令牌: {auth_token[:10]}...{auth_token[-4:] if len(auth_token) > 14 else auth_token}")
             
-            response = requests.get(
+            response = get_sso_session().get(
                 permissions_url,
                 params=params,
                 headers=headers,
-                verify=settings.SSO_SERVICE['VERIFY_SSL'],
+                verify=config.verify_ssl,
                 timeout=timeout
             )
             
@@ -177,99 +185,39 @@ class SSOPermission(BasePermission):
                 logger.info(f"成功獲取權限數據")
                 
                 # 使用緩存函數設置權限數據
-                cache_timeout = getattr(settings, 'USER_CACHE_TIMEOUT', 300)
+                cache_timeout = config.user_cache_timeout
                 set_user_permissions_cache(request.user.id, permissions_data, cache_timeout)
                 logger.debug(f"權限數據已存入緩存，過期時間: {cache_timeout}秒")
                 
                 return permissions_data
             else:
                 logger.error(f"從 SSO 獲取權限失敗: HTTP {response.status_code}, 響應: {response.text}")
+                if is_service_failure(response.status_code):
+                    return get_last_known_good_permissions(request.user.id)
                 return None
+        except requests.RequestException as e:
+            logger.error(f"獲取權限時發生連接錯誤: {str(e)}")
+            return get_last_known_good_permissions(request.user.id)
         except Exception as e:
             logger.error(f"獲取權限時發生錯誤: {str(e)}", exc_info=True)
             return None
         
     def _get_parent_module_permissions(self, permissions_data):
         """獲取父模組權限"""
-        logger.debug("開始獲取父模組權限")
-        parent_permissions = set()
-        
-        # 獲取父模組編碼
         parent_module = Module.get_parent_module()
-        
         for module_data in permissions_data.get('permissions', []):
             if module_data['code'] == parent_module:
-                parent_permissions = {perm['codename'] for perm in module_data.get('permissions', [])}
-                logger.info(f"找到父模組權限: {parent_permissions}")
-                break
-                
-        if not parent_permissions:
-            logger.warning("未找到父模組權限")
-            
-        return parent_permissions
+                return {perm['codename'] for perm in module_data.get('permissions', [])}
+        logger.warning("未找到父模組權限")
+        return set()
         
     def _collect_module_permissions(self, permissions_data):
-        """收集所有權限"""
-        logger.info("開始收集所有模組權限")
-        all_permissions = set()
-        
-        # 獲取父模組權限
-        parent_permissions = self._get_parent_module_permissions(permissions_data)
-        logger.debug(f"父模組權限: {parent_permissions}")
-        
-        # 將父模組權限添加到所有權限集合中
-        all_permissions.update(parent_permissions)
-        logger.debug(f"添加父模組權限到權限集合: {parent_permissions}")
-        
-        # 獲取父模組權限的值
-        parent_perms = Permission.get_parent_permissions()
-        
-        # 檢查父模組特殊權限
-        has_manage_system = parent_perms.get('MANAGE_SYSTEM', 'manage_default_system') in parent_permissions
-        has_view_system = parent_perms.get('VIEW_SYSTEM', 'view_default_system') in parent_permissions
-        
-        logger.debug(f"系統管理權限: {has_manage_system}, 系統查看權限: {has_view_system}")
-        
-        # 如果有系統管理權限,添加所有子模組的所有權限
-        if has_manage_system:
-            logger.info("用戶具有系統管理權限，添加所有子模組權限")
-            for module in Module.get_child_modules():
-                for perm_type in Permission.get_child_permission_types().values():
-                    permission = Permission.format_permission(module, perm_type)
-                    all_permissions.add(permission)
-                    logger.debug(f"添加權限: {permission}")
-            return all_permissions
-            
-        # 如果有系統查看權限,添加所有子模組的查看權限
-        if has_view_system:
-            logger.info("用戶具有系統查看權限，添加所有子模組的查看權限")
-            view_perm = Permission.get_child_permission_types().get('VIEW', 'view')
-            logger.info(f"添加所有子模組的查看權限: {view_perm}")
-            for module in Module.get_child_modules():
-                permission = Permission.format_permission(module, view_perm)
-                all_permissions.add(permission)
-                logger.debug(f"添加查看權限: {permission}")
-        
-        # 處理子模組權限
-        logger.info("處理子模組具體權限")
-        parent_module = Module.get_parent_module()
-        for module_data in permissions_data.get('permissions', []):
-            module_code = module_data['code']
-            if module_code == parent_module:
-                continue
-                
-            # 添加子模組的具體權限
-            for perm in module_data.get('permissions', []):
-                perm_code = f"{module_code}.{perm['codename']}"
-                all_permissions.add(perm_code)
-                logger.debug(f"添加子模組權限: {perm_code}")
-        
-        logger.info(f"收集到的所有權限: {all_permissions}")
-        return all_permissions
+        """收集所有權限，規則見 PermissionSet.from_payload"""
+        return set(PermissionSet.from_payload(permissions_data))
         
     def has_permission(self, request, view):
         """檢查權限"""
-        logger.info(f"開始檢查用戶 {request.user.username if request.user else 'AnonymousUser'} 的權限")
+        logger.debug(f"開始檢查用戶 {request.user.username if request.user else 'AnonymousUser'} 的權限")
         
         if not request.user or not request.user.is_authenticated:
             logger.warning("用戶未認證")
@@ -277,28 +225,26 @@ class SSOPermission(BasePermission):
             
         # 如果是超級用戶,直接允許訪問
         if hasattr(request.user, 'is_superuser') and request.user.is_superuser:
-            logger.info("超級用戶，允許訪問")
+            logger.debug("超級用戶，允許訪問")
             return True
             
         # 獲取視圖所需權限
         required_permissions = getattr(view, 'required_permissions', [])
         if not required_permissions:
-            logger.info("視圖未要求特定權限，允許訪問")
+            logger.debug("視圖未要求特定權限，允許訪問")
             return True
             
-        logger.info(f"視圖要求的權限: {required_permissions}")
+        logger.debug(f"視圖要求的權限: {required_permissions}")
         
-        # 獲取權限數據
-        permissions_data = self._get_user_permissions(request)
-        if not permissions_data:
+        # 獲取預編譯的權限集合並檢查
+        permission_set = _resolve_permission_set(request.user, request, self)
+        if permission_set is None:
             logger.error(f"無法獲取用戶 {request.user.username} 的權限數據")
             return False
             
-        # 收集所有權限並檢查
-        all_permissions = self._collect_module_permissions(permissions_data)
-        has_all_permissions = all(perm in all_permissions for perm in required_permissions)
+        has_all_permissions = permission_set.has_all(tuple(required_permissions))
         
-        logger.info(f"權限檢查結果: {has_all_permissions} (用戶: {request.user.username}, 要求權限: {required_permissions})")
+        logger.debug(f"權限檢查結果: {has_all_permissions} (用戶: {request.user.username}, 要求權限: {required_permissions})")
         return has_all_permissions
 
 class SSOperationPermission:
@@ -307,12 +253,50 @@ class SSOperationPermission:
     @staticmethod
     def _get_user_permissions(request):
         """獲取用戶權限數據"""
-        return SSOPermission()._get_user_permissions(request)
+        return _sso_permission._get_user_permissions(request)
     
     @staticmethod
     def _collect_module_permissions(permissions_data):
         """收集所有權限"""
-        return SSOPermission()._collect_module_permissions(permissions_data)
+        return _sso_permission._collect_module_permissions(permissions_data)
+
+# SSOPermission 沒有實例狀態，函數式的權限檢查共用一個實例
+_sso_permission = SSOPermission()
+
+
+class _UserRequest:
+    """
+    只包含用戶信息的模擬請求，供沒有請求對象的權限檢查獲取權限數據
+    
+    用戶對象有 token 時放入 cookies，使 SSOPermission._fetch_user_permissions 能夠請求 SSO。
+    """
+    
+    def __init__(self, user):
+        self.user = user
+        self.headers = {}
+        self.COOKIES = {}
+        if getattr(user, 'token', None):
+            self.COOKIES['auth_access_token'] = user.token
+
+
+def _resolve_permission_set(user, request=None, permission=None):
+    """
+    獲取用戶的權限集合，同一請求中只解析一次（包括解析失敗）
+    
+    參數:
+        user: 用戶對象
+        request (HttpRequest, optional): 請求對象，未提供時使用只包含用戶信息的模擬請求
+        permission (SSOPermission, optional): 用於獲取權限數據的實例，默認為共用實例
+        
+    返回:
+        PermissionSet or None: 無法獲取權限數據時返回 None
+    """
+    memo = get_permission_memo(user)
+    if not memo.resolved:
+        permission = permission or _sso_permission
+        memo.permission_set = permission._get_permission_set(request or _UserRequest(user))
+        memo.resolved = True
+    return memo.permission_set
 
 def check_permission(user, module, permissions):
     """
@@ -333,56 +317,98 @@ def check_permission(user, module, permissions):
     if hasattr(user, 'is_superuser') and user.is_superuser:
         return True
     
-    # 轉換為列表
+    # 轉換為元組
     if isinstance(permissions, str):
-        permissions = [permissions]
+        permissions = (permissions,)
+    else:
+        permissions = tuple(permissions)
     
     try:
-        # 優先從緩存獲取權限數據，避免依賴 MockRequest
-        permissions_data = get_user_permissions_cache(user.id)
-        
-        # 如果緩存中沒有權限數據，嘗試使用帶認證信息的模擬請求
-        if not permissions_data:
-            logger.debug(f"用戶 {user.username} (ID: {user.id}) 沒有緩存的權限數據，嘗試使用模擬請求")
-            
-            # 改進的模擬請求對象，包含真實的認證信息
-            class MockRequest:
-                def __init__(self, user):
-                    self.user = user
-                    self.headers = {}
-                    self.COOKIES = {}
-                    
-                    # 如果用戶對象有 token，添加到模擬的 cookies 中
-                    if hasattr(user, 'token') and user.token:
-                        self.COOKIES['auth_access_token'] = user.token
-                        logger.debug("模擬請求：從用戶對象添加 token 到 cookies")
-            
-            mock_request = MockRequest(user)
-            permissions_data = SSOPermission()._get_user_permissions(mock_request)
-            
-            if not permissions_data:
-                logger.warning(f"無法獲取用戶 {user.username} (ID: {user.id}) 的權限數據")
-                return False
+        # 同一請求中相同的檢查直接返回之前的結果
+        memo = get_permission_memo(user)
+        key = (module, permissions)
+        decision = memo.decisions.get(key)
+        if decision is not None:
+            return decision
         
-        # 收集所有權限
-        all_permissions = SSOPermission()._collect_module_permissions(permissions_data)
-        logger.debug(f"用戶 {user.username} 的所有權限: {sorted(list(all_permissions))}")
-        
-        # 檢查具體權限
-        for perm in permissions:
-            # 格式化權限
-            formatted_perm = Permission.format_permission(module, perm)
-            logger.debug(f"檢查權限: {formatted_perm}")
-            if formatted_perm not in all_permissions:
-                logger.warning(f"用戶 {user.username} 缺少權限: {formatted_perm}")
-                return False
-                
-        logger.info(f"用戶 {user.username} 權限檢查通過")
-        return True
+        # 優先從緩存獲取，未命中時以用戶對象中的 token 向 SSO 請求
+        permission_set = _resolve_permission_set(user)
+        if permission_set is None:
+            logger.warning(f"無法獲取用戶 {user.username} (ID: {user.id}) 的權限數據")
+            decision = False
+        elif not permission_set.has_module_permissions(module, permissions):
+            logger.warning(f"用戶 {user.username} 缺少模組 {module} 的權限: {permissions}")
+            decision = False
+        else:
+            logger.debug(f"用戶 {user.username} 權限檢查通過")
+            decision = True
+        memo.decisions[key] = decision
+        return decision
     except Exception as e:
         logger.error(f"檢查權限時發生錯誤: {str(e)}", exc_info=True)
         return False
 
+def check_permissions_many(user, checks):
+    """
+    批量檢查用戶權限，只解析一次權限集合，適用於導航菜單等需要大量檢查的場景
+    
+    Args:
+        user: Django 用戶對象
+        checks: (模組名稱, 權限) 元組的可迭代對象，權限可以是字符串或列表，規則同 check_permission
+        
+    Returns:
+        dict: {(模組名稱, 權限): 是否具有權限}，權限為列表時鍵中轉換為元組
+    """
+    checks = [
+        (module, permissions if isinstance(permissions, str) else tuple(permissions))
+        for module, permissions in checks
+    ]
+    if not user or not user.is_authenticated:
+        return dict.fromkeys(checks, False)
+    
+    # 如果是超級用戶,直接允許訪問
+    if hasattr(user, 'is_superuser') and user.is_superuser:
+        return dict.fromkeys(checks, True)
+    
+    try:
+        memo = get_permission_memo(user)
+        permission_set = _resolve_permission_set(user)
+        if permission_set is None:
+            logger.warning(f"無法獲取用戶 {user.username} (ID: {user.id}) 的權限數據")
+            return dict.fromkeys(checks, False)
+        
+        decisions = memo.decisions
+        results = {}
+        for check in checks:
+            module, permissions = check
+            key = (module, (permissions,)) if isinstance(permissions, str) else check
+            decision = decisions.get(key)
+            if decision is None:
+                decision = decisions[key] = permission_set.has_module_permissions(*key)
+            results[check] = decision
+        return results
+    except Exception as e:
+        logger.error(f"批量檢查權限時發生錯誤: {str(e)}", exc_info=True)
+        return dict.fromkeys(checks, False)
+
+def _normalize_permissions(permissions):
+    """
+    將裝飾器的權限參數轉換為完整權限字符串的元組
+    
+    (module, action) 元組中父模組權限直接使用 action 值，子模組權限使用 Permission.format_permission。
+    """
+    config = get_sso_config()
+    required = []
+    for perm in permissions:
+        if isinstance(perm, tuple) and len(perm) == 2:
+            module, action = perm
+            if module == config.parent_module:
+                perm = action if isinstance(action, str) else action.value
+            else:
+                perm = config.format_permission(module, action)
+        required.append(perm)
+    return tuple(required)
+
 def module_permission_required(*permissions):
     """權限裝飾器"""
     def decorator(view_func):
@@ -395,38 +421,24 @@ def module_permission_required(*permissions):
                 logger.info(f"用戶 {request.user.username} 是超級用戶，允許訪問")
                 return view_func(viewset, request, *args, **kwargs)
             
-            # 獲取權限數據
-            permissions_data = SSOPermission()._get_user_permissions(request)
-            if not permissions_data:
+            # 獲取預編譯的權限集合
+            permission_set = _resolve_permission_set(request.user, request)
+            if permission_set is None:
                 logger.error(f"無法獲取用戶 {request.user.username} 的權限數據")
                 
                 # 使用 PermissionDeniedError
                 error = PermissionDeniedError('無法獲取權限數據')
                 return render(request, 'portal/403.html', {'error': error.message}, status=403)
                 
-            # 收集所有權限
-            all_permissions = SSOPermission()._collect_module_permissions(permissions_data)
-            logger.debug(f"用戶 {request.user.username} 的所有權限: {all_permissions}")
-            
             # 檢查具體權限
-            parent_module = Module.get_parent_module()
-            for perm in permissions:
-                # 轉換權限格式
-                if isinstance(perm, tuple) and len(perm) == 2:
-                    module, action = perm
-                    if module == parent_module:
-                        # 父模組權限直接使用 action 值
-                        perm = action if isinstance(action, str) else action.value
-                    else:
-                        # 子模組權限使用格式化方法
-                        perm = Permission.format_permission(module, action)
+            required = _normalize_permissions(permissions)
+            if not permission_set.has_all(required):
+                missing = next(perm for perm in required if perm not in permission_set)
+                logger.warning(f"用戶 {request.user.username} 缺少權限: {missing}")
                 
-                if perm not in all_permissions:
-                    logger.warning(f"用戶 {request.user.username} 缺少權限: {perm}")
-                    
-                    # 使用 PermissionDeniedError
-                    error = PermissionDeniedError(f'缺少所需權限: {perm}')
-                    return render(request, 'portal/403.html', {'error': error.message}, status=403)
+                # 使用 PermissionDeniedError
+                error = PermissionDeniedError(f'缺少所需權限: {missing}')
+                return render(request, 'portal/403.html', {'error': error.message}, status=403)
                     
             logger.info(f"用戶 {request.user.username} 通過權限檢查")
             return view_func(viewset, request, *args, **kwargs)
@@ -64,6 +64,7 @@ def configure_sso_settings(settings_dict, sso_config=None):
         'PERMISSION_CHECK_URL': '/api/core/permissions/check/',
         'MODULES_URL': '/api/core/modules/',
         'MODULE_CHECK_URL': '/api/core/modules/check/',
+        'JWKS_URL': '/api/auth/jwks/',
     }
     
     # 設置模組配置
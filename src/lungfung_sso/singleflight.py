@@ -0,0 +1,139 @@
+# lungfung_sso/singleflight.py
+"""
+進程內請求合併 (single-flight)
+
+同一個 key 同時只執行一次調用，其他並發調用方等待並共享同一結果
+（包括拋出的異常）。用於在緩存過期瞬間合併對 SSO 服務的重複請求。
+SingleFlight 用於線程，AsyncSingleFlight 用於 asyncio 協程。
+"""
+import asyncio
+import functools
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    """一次進行中的調用"""
+
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    按 key 合併並發調用
+
+    使用示例:
+        flight = SingleFlight()
+        result = flight.do(token_value, verify_remote, token_value)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        執行 fn，如果相同 key 的調用正在進行則等待其結果
+
+        參數:
+            key: 合併鍵，需可哈希
+            fn (callable): 實際執行的函數
+            *args, **kwargs: 傳給 fn 的參數
+
+        返回:
+            fn 的返回值
+
+        可能引發的異常:
+            fn 拋出的異常會傳遞給所有等待者
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not is_leader:
+            logger.debug("相同請求正在進行，等待共享結果")
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+        return call.result
+
+    def in_flight(self):
+        """返回當前進行中的調用數量"""
+        with self._lock:
+            return len(self._calls)
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight 的 asyncio 版本
+
+    同一事件循環中相同 key 的並發協程共享一次調用的結果或異常。
+    調用在獨立的任務中執行，不屬於任何一個調用方：某個調用方被取消（如客戶端斷開連接）
+    只有它自己收到 CancelledError，調用繼續進行，其他調用方照常得到結果。
+
+    使用示例:
+        flight = AsyncSingleFlight()
+        result = await flight.do(token_value, averify_remote, token_value)
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn, *args, **kwargs):
+        """
+        執行協程函數 fn，如果相同 key 的調用正在進行則等待其結果
+
+        參數:
+            key: 合併鍵，需可哈希
+            fn (callable): 返回協程的函數
+            *args, **kwargs: 傳給 fn 的參數
+
+        返回:
+            fn 的返回值
+
+        可能引發的異常:
+            fn 拋出的異常會傳遞給所有等待者
+        """
+        loop = asyncio.get_running_loop()
+        call_key = (id(loop), key)
+
+        task = self._calls.get(call_key)
+        if task is None:
+            task = loop.create_task(fn(*args, **kwargs))
+            self._calls[call_key] = task
+            task.add_done_callback(functools.partial(self._finish, call_key))
+        else:
+            logger.debug("相同請求正在進行，等待共享結果")
+        return await asyncio.shield(task)
+
+    def _finish(self, call_key, task):
+        if self._calls.get(call_key) is task:
+            del self._calls[call_key]
+        if not task.cancelled():
+            # 標記異常已讀取，所有調用方都已取消時不產生警告
+            task.exception()
+
+    def in_flight(self):
+        """返回當前進行中的調用數量"""
+        return len(self._calls)
@@ -0,0 +1,91 @@
+# lungfung_sso/warmup.py
+"""
+緩存預熱
+
+部署或清空緩存後每個用戶的第一個請求、以及登錄後的第一個請求，
+都需要同步請求 SSO 的 USER_PERMISSIONS_URL。這裡提供兩種預熱方式:
+    warm_up_permissions: 以有界並發為一批用戶預取權限數據（sso_warm_cache 管理命令）
+    warm_up_login: 登錄回調完成後立即填充令牌驗證和權限緩存
+    schedule_login_warm_up: 在後台線程池中執行 warm_up_login，不阻塞登錄回調的響應
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from .exceptions import TokenError, TokenExpiredError
+
+logger = logging.getLogger(__name__)
+
+# 預熱時同時請求 SSO 的默認並發數
+DEFAULT_CONCURRENCY = 4
+
+
+def warm_up_permissions(user_ids, token, concurrency=DEFAULT_CONCURRENCY):
+    """
+    預取一批用戶的權限數據並存入緩存
+
+    參數:
+        user_ids (iterable): 用戶ID
+        token (str): 請求 USER_PERMISSIONS_URL 使用的令牌，需有權讀取這些用戶的權限
+        concurrency (int): 同時請求 SSO 的最大數量
+
+    返回:
+        tuple: (succeeded, failed) - 成功和失敗的用戶ID列表
+    """
+    from .authentication import SSOAuthentication
+
+    auth = SSOAuthentication()
+    user_ids = list(dict.fromkeys(user_ids))
+    succeeded, failed = [], []
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='lungfung-sso-warmup') as executor:
+        results = executor.map(lambda user_id: auth._fetch_user_permissions(user_id, token), user_ids)
+        for user_id, permissions_data in zip(user_ids, results):
+            (succeeded if permissions_data else failed).append(user_id)
+
+    logger.info(f"權限緩存預熱完成: 成功 {len(succeeded)}，失敗 {len(failed)}")
+    return succeeded, failed
+
+
+def warm_up_login(access_token):
+    """
+    登錄回調完成後驗證新的 access token，並填充令牌驗證和權限緩存
+
+    失敗時只記錄日誌，不影響登錄流程。
+
+    參數:
+        access_token (str): 登錄得到的 access token
+
+    返回:
+        User or None: 驗證成功時返回用戶對象
+    """
+    from .authentication import SSOAuthentication
+
+    auth = SSOAuthentication()
+    try:
+        user = auth._get_user_from_token(access_token)
+        auth._load_user_permissions(user)
+    except (TokenError, TokenExpiredError) as e:
+        logger.warning(f"登錄後緩存預熱失敗: {str(e)}")
+        return None
+    except Exception as e:
+        logger.error(f"登錄後緩存預熱發生意外錯誤: {str(e)}", exc_info=True)
+        return None
+
+    logger.debug(f"登錄後緩存預熱完成，用戶: {user.username}")
+    return user
+
+
+def schedule_login_warm_up(access_token):
+    """
+    在後台重新驗證線程池中執行 warm_up_login，同一 token 同時只有一個預熱任務
+
+    線程池已滿（SSO_CACHE_REVALIDATE_MAX_PENDING）時放棄預熱，用戶的第一個請求照常同步驗證。
+
+    參數:
+        access_token (str): 登錄得到的 access token
+
+    返回:
+        bool: 是否已調度
+    """
+    from .cache import _schedule_revalidation, get_token_cache_key
+
+    return _schedule_revalidation(f"{get_token_cache_key(access_token)}:warm_up", warm_up_login, access_token)
@@ -0,0 +1,91 @@
+# tests/conftest.py
+import json
+import threading
+import time
+
+import jwt
+import pytest
+from django.core.cache import cache as django_cache
+
+from lungfung_sso import cache as sso_cache
+from lungfung_sso import middleware
+
+
+class FakeResponse:
+    def __init__(self, status_code, data=None):
+        self.status_code = status_code
+        self._data = data if data is not None else {}
+        self.text = json.dumps(self._data)
+
+    def json(self):
+        return self._data
+
+
+class FakeSSOSession:
+    """
+    模擬 SSO 服務的 requests Session，記錄每次請求的 URL
+
+    verify_status / refresh_status 控制驗證和刷新接口的響應狀態碼，delay 模擬網絡延遲。
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.delay = 0
+        self.verify_status = 200
+        self.refresh_status = 200
+        self._lock = threading.Lock()
+
+    def _record(self, url):
+        with self._lock:
+            self.calls.append(url)
+        if self.delay:
+            time.sleep(self.delay)
+
+    def count(self, suffix):
+        with self._lock:
+            return sum(1 for url in self.calls if url.endswith(suffix))
+
+    def post(self, url, json=None, **kwargs):
+        self._record(url)
+        if url.endswith('/verify/'):
+            if self.verify_status == 200:
+                return FakeResponse(200, {'id': 7, 'username': 'alice'})
+            return FakeResponse(self.verify_status, {'code': 'token_not_valid'})
+        if url.endswith('/refresh/'):
+            if self.refresh_status == 200:
+                return FakeResponse(200, {'access': make_token(jti=f'refreshed-{time.time()}')})
+            return FakeResponse(self.refresh_status)
+        return FakeResponse(404)
+
+    def get(self, url, **kwargs):
+        self._record(url)
+        return FakeResponse(200, {'permissions': []})
+
+    def request(self, method, url, **kwargs):
+        return self.get(url, **kwargs) if method == 'GET' else self.post(url, **kwargs)
+
+
+def make_token(exp_in=300, **claims):
+    """生成未簽名校驗的測試 JWT（中間件只在本地驗證時校驗簽名）"""
+    payload = {'user_id': 7, 'username': 'alice', 'exp': int(time.time()) + exp_in, **claims}
+    return jwt.encode(payload, 'lungfung-sso-test-signing-secret-key', algorithm='HS256')
+
+
+@pytest.fixture(autouse=True)
+def clean_caches():
+    """每個測試使用空的共享緩存、L1 緩存和世代計數器"""
+    django_cache.clear()
+    sso_cache.clear_local_cache()
+    sso_cache._local_generations.clear()
+    yield
+    django_cache.clear()
+    sso_cache.clear_local_cache()
+    sso_cache._local_generations.clear()
+
+
+@pytest.fixture
+def sso_session(monkeypatch):
+    """以 FakeSSOSession 替換中間件使用的 SSO 會話"""
+    session = FakeSSOSession()
+    monkeypatch.setattr(middleware, 'sso_session', session)
+    return session
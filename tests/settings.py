@@ -0,0 +1,27 @@
+# tests/settings.py
+"""測試用的 Django 設置"""
+from lungfung_sso import configure_sso_settings
+
+DEBUG = False
+SECRET_KEY = 'lungfung-sso-tests'
+ALLOWED_HOSTS = ['*']
+USE_TZ = True
+
+INSTALLED_APPS = [
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'django.contrib.sessions',
+    'django.contrib.messages',
+    'lungfung_sso',
+]
+
+DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}}
+CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+ROOT_URLCONF = 'lungfung_sso.urls'
+
+configure_sso_settings(globals(), {
+    'SSO_SERVER_URL': 'http://sso.test',
+    'MODULE_CODE': 'TCS',
+    'CHILD_MODULES': {'INV': 'tc_inv', 'CUS': 'tc_cus'},
+    'PARENT_PERMISSIONS': {'VIEW_SYSTEM': 'view_tcs', 'MANAGE_SYSTEM': 'manage_tcs'},
+})
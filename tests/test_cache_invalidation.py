@@ -0,0 +1,119 @@
+# tests/test_cache_invalidation.py
+import threading
+import time
+
+from django.core.cache import cache as django_cache
+from django.core.cache.backends.locmem import LocMemCache
+
+from lungfung_sso import cache as sso_cache
+from lungfung_sso.models import User
+
+
+def make_user(user_id=42):
+    return User({'id': user_id, 'username': f'user{user_id}'})
+
+
+def test_invalidate_user_cache_clears_every_indexed_token():
+    tokens = [f'token-{i}' for i in range(3)]
+    for token in tokens:
+        sso_cache.set_token_verification_cache(token, make_user())
+    sso_cache.set_token_verification_cache('other-user-token', make_user(43))
+    sso_cache.set_user_permissions_cache(42, {'permissions': []})
+
+    sso_cache.invalidate_user_cache(42)
+
+    for token in tokens:
+        assert sso_cache.get_token_verification_cache(token) is None
+    assert sso_cache.get_user_permissions_cache(42) is None
+    assert sso_cache.get_token_verification_cache('other-user-token').id == 43
+
+
+def test_invalidate_user_cache_clears_tokens_missing_from_local_cache():
+    sso_cache.set_token_verification_cache('token', make_user())
+    sso_cache.clear_local_cache()
+
+    sso_cache.invalidate_user_cache(42)
+
+    assert sso_cache.get_token_verification_cache('token') is None
+    assert sso_cache.get_token_and_permissions_cache('token') == (None, None)
+
+
+def test_concurrent_logins_are_all_indexed(monkeypatch):
+    original_get = LocMemCache.get
+
+    def slow_get(self, key, *args, **kwargs):
+        value = original_get(self, key, *args, **kwargs)
+        if sso_cache.CACHE_TYPE_USER_TOKENS in key and not key.endswith(':lock'):
+            # 放大讀取-修改-寫回之間的窗口
+            time.sleep(0.02)
+        return value
+
+    monkeypatch.setattr(LocMemCache, 'get', slow_get)
+    tokens = [f'token-{i}' for i in range(8)]
+    start = threading.Barrier(len(tokens))
+
+    def login(token):
+        start.wait()
+        sso_cache.set_token_verification_cache(token, make_user())
+
+    threads = [threading.Thread(target=login, args=(token,)) for token in tokens]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    monkeypatch.setattr(LocMemCache, 'get', original_get)
+
+    assert len(django_cache.get(sso_cache.get_user_tokens_cache_key(42))) == len(tokens)
+    sso_cache.invalidate_user_cache(42)
+    sso_cache.clear_local_cache()
+    for token in tokens:
+        assert sso_cache.get_token_verification_cache(token) is None
+
+
+def test_index_failure_does_not_fail_token_cache(monkeypatch):
+    def broken_add(self, *args, **kwargs):
+        raise ConnectionError('cache down')
+
+    monkeypatch.setattr(LocMemCache, 'add', broken_add)
+    assert sso_cache.set_token_verification_cache('token', make_user()) is True
+    assert sso_cache.get_token_verification_cache('token').id == 42
+
+
+def test_generation_bump_invalidates_only_that_cache_type():
+    sso_cache.set_user_permissions_cache(42, {'permissions': []})
+    sso_cache.set_token_verification_cache('token', make_user())
+
+    sso_cache.invalidate_cache_type(sso_cache.CACHE_TYPE_PERMISSIONS)
+
+    assert sso_cache.get_user_permissions_cache(42) is None
+    assert sso_cache.get_token_verification_cache('token').id == 42
+
+
+def test_generation_bump_invalidates_token_cache_including_local_entries():
+    sso_cache.set_token_verification_cache('token', make_user())
+
+    sso_cache.invalidate_cache_type(sso_cache.CACHE_TYPE_TOKEN)
+
+    assert sso_cache.get_token_verification_cache('token') is None
+
+
+def test_invalidate_module_cache_invalidates_permissions():
+    sso_cache.set_user_permissions_cache(42, {'permissions': []})
+
+    sso_cache.invalidate_module_cache('TCS')
+
+    assert sso_cache.get_user_permissions_cache(42) is None
+
+
+def test_bump_from_other_process_applies_after_local_generation_expires():
+    sso_cache.set_user_permissions_cache(42, {'permissions': []})
+    generation = sso_cache.get_generation(sso_cache.CACHE_TYPE_PERMISSIONS)
+
+    # 其他工作進程直接遞增共享緩存中的計數器
+    django_cache.incr(sso_cache._get_generation_key(sso_cache.CACHE_TYPE_PERMISSIONS))
+    assert sso_cache.get_generation(sso_cache.CACHE_TYPE_PERMISSIONS) == generation
+    assert sso_cache.get_user_permissions_cache(42) is not None
+
+    sso_cache._local_generations.clear()
+    assert sso_cache.get_generation(sso_cache.CACHE_TYPE_PERMISSIONS) == generation + 1
+    assert sso_cache.get_user_permissions_cache(42) is None
@@ -0,0 +1,129 @@
+# tests/test_circuit_breaker.py
+import time
+
+import pytest
+import requests
+
+from lungfung_sso.circuit_breaker import CircuitBreaker, CircuitBreakerSession, CircuitOpenError
+
+from .conftest import FakeResponse
+
+
+def make_breaker(**kwargs):
+    options = dict(window_size=4, min_calls=2, failure_rate=0.5, slow_call_threshold=1, reset_timeout=0.05)
+    options.update(kwargs)
+    return CircuitBreaker(**options)
+
+
+def open_breaker(breaker):
+    breaker.record(False, 0)
+    breaker.record(False, 0)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_opens_when_failure_rate_reaches_threshold():
+    breaker = make_breaker()
+    breaker.record(True, 0)
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record(False, 0)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.allow_request() is False
+
+
+def test_stays_closed_below_min_calls():
+    breaker = make_breaker(min_calls=3)
+    breaker.record(False, 0)
+    breaker.record(False, 0)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_slow_calls_count_as_failures():
+    breaker = make_breaker()
+    breaker.record(True, 2)
+    breaker.record(True, 2)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_half_open_allows_exactly_one_probe():
+    breaker = make_breaker()
+    open_breaker(breaker)
+    time.sleep(0.06)
+
+    assert breaker.allow_request() == CircuitBreaker.PROBE
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow_request() is False
+
+
+def test_probe_success_closes_and_failure_reopens():
+    breaker = make_breaker()
+    open_breaker(breaker)
+    time.sleep(0.06)
+    breaker.allow_request()
+    breaker.record(False, 0, probe=True)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    time.sleep(0.06)
+    breaker.allow_request()
+    breaker.record(True, 0, probe=True)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow_request() is True
+
+
+def test_late_results_do_not_decide_half_open_state():
+    breaker = make_breaker()
+    open_breaker(breaker)
+    time.sleep(0.06)
+    breaker.allow_request()
+
+    # 打開前發出的請求此時才失敗
+    breaker.record(False, 0)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+    breaker.record(True, 0, probe=True)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+class StubSession:
+    def __init__(self, status_code=200, error=None):
+        self.status_code = status_code
+        self.error = error
+
+    def request(self, method, url, **kwargs):
+        if self.error is not None:
+            raise self.error
+        return FakeResponse(self.status_code)
+
+
+@pytest.mark.parametrize('status_code', [500, 503, 408, 429])
+def test_session_counts_service_failures(status_code):
+    breaker = make_breaker()
+    session = CircuitBreakerSession(StubSession(status_code), breaker)
+    session.get('http://sso.test/x')
+    session.get('http://sso.test/x')
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        session.get('http://sso.test/x')
+
+
+@pytest.mark.parametrize('status_code', [200, 400, 401, 403])
+def test_session_does_not_count_token_rejections(status_code):
+    breaker = make_breaker()
+    session = CircuitBreakerSession(StubSession(status_code), breaker)
+    for _ in range(4):
+        session.post('http://sso.test/x')
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_session_counts_connection_errors_and_recovers_through_probe():
+    breaker = make_breaker()
+    stub = StubSession(error=requests.ConnectionError('refused'))
+    session = CircuitBreakerSession(stub, breaker)
+    for _ in range(2):
+        with pytest.raises(requests.ConnectionError):
+            session.get('http://sso.test/x')
+    assert breaker.state == CircuitBreaker.OPEN
+
+    time.sleep(0.06)
+    stub.error = None
+    assert session.get('http://sso.test/x').status_code == 200
+    assert breaker.state == CircuitBreaker.CLOSED
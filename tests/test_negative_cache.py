@@ -0,0 +1,67 @@
+# tests/test_negative_cache.py
+import time
+
+import pytest
+from django.http import HttpResponse
+
+from lungfung_sso import cache as sso_cache
+from lungfung_sso.middleware import JWTAuthenticationMiddleware
+
+from .conftest import make_token
+
+
+@pytest.fixture
+def auth_middleware(sso_session):
+    return JWTAuthenticationMiddleware(lambda request: HttpResponse('ok'))
+
+
+@pytest.mark.parametrize('status_code, reason', [
+    (400, sso_cache.REJECTION_INVALID),
+    (401, sso_cache.REJECTION_EXPIRED),
+    (403, sso_cache.REJECTION_INVALID),
+])
+def test_definite_rejections_are_cached(auth_middleware, sso_session, status_code, reason):
+    sso_session.verify_status = status_code
+    token = make_token()
+
+    assert auth_middleware._verify_token(token)[0] == status_code
+    assert sso_cache.get_token_rejection_cache(token) == reason
+
+    # 負緩存命中時不再請求 SSO，400/403 都按無效令牌返回 400
+    assert auth_middleware._verify_token(token)[0] == (401 if status_code == 401 else 400)
+    assert sso_session.count('/verify/') == 1
+
+
+@pytest.mark.parametrize('status_code', [408, 429, 500, 503])
+def test_service_failures_are_not_cached(auth_middleware, sso_session, status_code):
+    sso_session.verify_status = status_code
+    token = make_token()
+
+    auth_middleware._verify_token(token)
+    assert sso_cache.get_token_rejection_cache(token) is None
+
+    auth_middleware._verify_token(token)
+    assert sso_session.count('/verify/') == 2
+
+
+def test_rejection_expires_after_negative_cache_ttl(auth_middleware, sso_session, monkeypatch):
+    monkeypatch.setattr(sso_cache, 'REJECTION_CACHE_TTL', 0.2)
+    sso_session.verify_status = 403
+    token = make_token()
+
+    auth_middleware._verify_token(token)
+    assert sso_cache.get_token_rejection_cache(token) == sso_cache.REJECTION_INVALID
+
+    time.sleep(0.3)
+    assert sso_cache.get_token_rejection_cache(token) is None
+    auth_middleware._verify_token(token)
+    assert sso_session.count('/verify/') == 2
+
+
+def test_explicit_timeout_overrides_default_ttl(monkeypatch):
+    monkeypatch.setattr(sso_cache, 'REJECTION_CACHE_TTL', 60)
+    sso_cache.set_token_rejection_cache('refresh-token', sso_cache.REJECTION_REFRESH_COOLDOWN, 0.2)
+    assert sso_cache.get_token_rejection_cache('refresh-token') == sso_cache.REJECTION_REFRESH_COOLDOWN
+
+    time.sleep(0.3)
+    assert sso_cache.get_token_rejection_cache('refresh-token') is None
@@ -0,0 +1,98 @@
+# tests/test_refresh.py
+import threading
+
+import pytest
+from django.test import override_settings
+
+from lungfung_sso import cache as sso_cache
+from lungfung_sso.middleware import coalesced_refresh_access_token
+
+
+def refresh_concurrently(session, refresh_token, count=5):
+    start = threading.Barrier(count)
+    results = []
+
+    def worker():
+        start.wait()
+        results.append(coalesced_refresh_access_token(refresh_token, session))
+
+    threads = [threading.Thread(target=worker) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_refreshes_call_sso_once(sso_session):
+    sso_session.delay = 0.1
+    results = refresh_concurrently(sso_session, 'refresh-token')
+
+    assert sso_session.count('/refresh/') == 1
+    assert len({access_token for access_token, _ in results}) == 1
+    assert all(access_token and error is None for access_token, error in results)
+
+
+def test_refresh_result_is_reused_by_later_requests(sso_session):
+    first, _ = coalesced_refresh_access_token('refresh-token', sso_session)
+    second, _ = coalesced_refresh_access_token('refresh-token', sso_session)
+
+    assert first == second
+    assert sso_session.count('/refresh/') == 1
+
+
+def test_waiter_uses_result_of_other_worker(sso_session):
+    # 模擬另一個工作進程持有刷新鎖並寫入結果
+    assert sso_cache.acquire_refresh_lock('refresh-token')
+    timer = threading.Timer(0.1, sso_cache.set_refresh_result, ('refresh-token', 'new-access-token'))
+    timer.start()
+    try:
+        result = coalesced_refresh_access_token('refresh-token', sso_session)
+    finally:
+        timer.join()
+
+    assert result == ('new-access-token', None)
+    assert sso_session.count('/refresh/') == 0
+
+
+@pytest.mark.parametrize('status_code', [500, 503])
+def test_failed_refresh_is_published_to_waiters(sso_session, status_code):
+    sso_session.refresh_status = status_code
+    sso_session.delay = 0.1
+    results = refresh_concurrently(sso_session, 'refresh-token')
+
+    assert sso_session.count('/refresh/') == 1
+    assert all(access_token is None and error for access_token, error in results)
+
+    # 失敗結果在 SSO_REFRESH_FAILURE_TTL 內直接返回
+    coalesced_refresh_access_token('refresh-token', sso_session)
+    assert sso_session.count('/refresh/') == 1
+
+
+def test_waiter_returns_failure_of_other_worker(sso_session):
+    assert sso_cache.acquire_refresh_lock('refresh-token')
+    timer = threading.Timer(0.1, sso_cache.set_refresh_failure, ('refresh-token', '刷新失敗: HTTP 503'))
+    timer.start()
+    try:
+        result = coalesced_refresh_access_token('refresh-token', sso_session)
+    finally:
+        timer.join()
+
+    assert result == (None, '刷新失敗: HTTP 503')
+    assert sso_session.count('/refresh/') == 0
+
+
+def test_wait_for_other_worker_is_bounded_by_request_timeout(sso_session):
+    assert sso_cache.acquire_refresh_lock('refresh-token')
+    with override_settings(SSO_REQUEST_TIMEOUT=0.2):
+        access_token, error = coalesced_refresh_access_token('refresh-token', sso_session)
+
+    # 沒有等到結果，自行刷新
+    assert access_token and error is None
+    assert sso_session.count('/refresh/') == 1
+
+
+def test_rejected_refresh_token_is_negative_cached(sso_session):
+    sso_session.refresh_status = 401
+    assert coalesced_refresh_access_token('refresh-token', sso_session) == (None, 'refresh_token_expired')
+    assert sso_cache.get_token_rejection_cache('refresh-token') == sso_cache.REJECTION_REFRESH_FAILED
@@ -0,0 +1,121 @@
+# tests/test_singleflight.py
+import asyncio
+import threading
+import time
+
+import pytest
+
+from lungfung_sso.singleflight import AsyncSingleFlight, SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight()
+    calls = []
+    start = threading.Barrier(5)
+    results = []
+
+    def fetch():
+        calls.append(1)
+        time.sleep(0.1)
+        return 'value'
+
+    def worker():
+        start.wait()
+        results.append(flight.do('key', fetch))
+
+    threads = [threading.Thread(target=worker) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ['value'] * 5
+    assert len(calls) == 1
+    assert flight.in_flight() == 0
+
+
+def test_error_is_propagated_to_every_waiter():
+    flight = SingleFlight()
+    start = threading.Barrier(3)
+    errors = []
+
+    def fail():
+        time.sleep(0.1)
+        raise ValueError('sso down')
+
+    def worker():
+        start.wait()
+        try:
+            flight.do('key', fail)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(errors) == 3
+    assert len({id(e) for e in errors}) == 1
+
+
+def test_different_keys_are_not_coalesced():
+    flight = SingleFlight()
+    assert flight.do('a', lambda: 1) == 1
+    assert flight.do('b', lambda: 2) == 2
+
+
+def test_async_concurrent_calls_share_one_execution():
+    flight = AsyncSingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'value'
+
+    async def main():
+        return await asyncio.gather(*(flight.do('key', fetch) for _ in range(5)))
+
+    assert asyncio.run(main()) == ['value'] * 5
+    assert len(calls) == 1
+    assert flight.in_flight() == 0
+
+
+def test_async_error_is_propagated_to_every_waiter():
+    flight = AsyncSingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError('sso down')
+
+    async def main():
+        return await asyncio.gather(*(flight.do('key', fail) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+def test_async_leader_cancellation_does_not_cancel_waiters():
+    flight = AsyncSingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'value'
+
+    async def main():
+        leader = asyncio.create_task(flight.do('key', fetch))
+        await asyncio.sleep(0)
+        waiters = [asyncio.create_task(flight.do('key', fetch)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await asyncio.gather(*waiters)
+
+    assert asyncio.run(main()) == ['value'] * 3
+    assert len(calls) == 1
+    assert flight.in_flight() == 0